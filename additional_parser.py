@@ -1,9 +1,15 @@
 import os
-import json
 import asyncio
 import hashlib
 from datetime import datetime
 from telethon import TelegramClient
+from spam_filter import spam_rule
+from entity_cache import resolve_entity, invalidate, is_stale_error
+from rate_limiter import get_limiter, run_bounded
+from poll_scheduler import get_scheduler
+from dedup_index import DedupIndex
+from events import publish_listings
+from listings_store import merge_listings, read_listings
 
 API_ID = int(os.environ.get('TELETHON_API_ID', 0))
 API_HASH = os.environ.get('TELETHON_API_HASH', '')
@@ -37,26 +43,6 @@ def is_english_only(text):
         if ord(char) > 127 and char not in '.,!?-…()[]{}":;/\\ @':
             non_english_chars += 1
     return non_english_chars == 0
-
-def is_spam(text):
-    """Check if text is spam/promo"""
-    if not text:
-        return False
-    spam_keywords = [
-        'deriv.com', 'synthetic indices', 'trading account',
-        'round-the-clock trading', 'forex', 'crypto trading',
-        'kumpulan video viral', 'full video', 'join grup', 'klik link',
-        'video-info-viral', 'join sekarang',
-        'rent account', 'rent linkedin', 'rent facebook', 'make money',
-        'passive income', 'rent out', 'advertising account',
-        'grow your business', 'promote message', 'promotion packages',
-        'reach more customers', 'boost visibility', 'drive engagement',
-        'anda ingin sukses', 'ubah cara berfikir', 'positive thinking',
-        'salam sukses', 'mulai sebelum orang',
-        'notif sms', 'hak cipta hack', 'bootloader', 'fingerprint'
-    ]
-    return any(keyword in text.lower() for keyword in spam_keywords)
-
 def get_image_hash(image_data):
     """Get hash of image"""
     if not image_data:
@@ -79,38 +65,37 @@ async def parse_additional_channels():
         
         me = await client.get_me()
         print(f"✅ Авторизован как: {me.first_name}")
+        limiter = get_limiter(client)
+        scheduler = get_scheduler()
         
         # Парсим каждую страну
         for country, channels in ADDITIONAL_CHANNELS.items():
-            listings_file = f'listings_{country}.json'
-            
-            # Load existing
+            # Load existing (файл бывает и списком, и словарём категорий)
             existing = []
-            if os.path.exists(listings_file):
-                try:
-                    with open(listings_file, 'r', encoding='utf-8') as f:
-                        existing = json.load(f)
-                except:
-                    pass
+            try:
+                existing = read_listings(country)
+            except:
+                pass
             
-            existing_ids = {item['id'] for item in existing}
-            existing_hashes = {item.get('image_hash') for item in existing if item.get('image_hash')}
-            new_count = 0
+            dedup = DedupIndex.from_data(existing)
+            new_items = []
+            duplicates = []
             skipped_english = 0
             
             print(f"\n🌐 {country.upper()}: парсинг доп. каналов...")
             
-            for channel in channels:
+            async def parse_one(channel):
+                nonlocal skipped_english
+                channel_count = 0
                 try:
                     # Try to get entity
                     try:
-                        entity = await client.get_entity(f"@{channel}")
+                        entity = await limiter.call(resolve_entity, client, channel)
                     except:
-                        await asyncio.sleep(1)
-                        continue
+                        return
                     
                     # Get messages - менее агрессивно (только 15 сообщений)
-                    messages = await client.get_messages(entity, limit=15)
+                    messages = await scheduler.fetch_new(limiter, client, entity, channel, 15)
                     
                     for msg in messages:
                         if not msg.text or len(msg.text) < 20:
@@ -120,11 +105,13 @@ async def parse_additional_channels():
                             skipped_english += 1
                             continue
                         
-                        if is_spam(msg.text):
+                        rule = spam_rule(msg.text)
+                        if rule:
+                            print(f"🚫 Спам [{rule}]: @{channel} {msg.id}")
                             continue
                         
                         item_id = f"{channel}_{msg.id}"
-                        if item_id in existing_ids:
+                        if dedup.known(item_id):
                             continue
                         
                         image_url = None
@@ -148,30 +135,37 @@ async def parse_additional_channels():
                             'has_media': has_media,
                             'price': None
                         }
-                        existing.append(item)
-                        existing_ids.add(item_id)
-                        new_count += 1
+                        # Тот же текст из другого канала - только добавляем источник
+                        if dedup.merge(item):
+                            duplicates.append(item)
+                            continue
+                        new_items.append(item)
+                        channel_count += 1
                     
-                    if new_count > 0:
-                        print(f"  ✓ @{channel}: +{new_count}")
+                    if channel_count > 0:
+                        print(f"  ✓ @{channel}: +{channel_count}")
                     
                 except Exception as e:
+                    if is_stale_error(e):
+                        invalidate(client, channel)
                     error_msg = str(e)[:50]
                     if 'rate' not in error_msg.lower():
                         pass
-                
-                # Задержка между каналами - 2 сек (менее агрессивно)
-                await asyncio.sleep(2.5)
+            
+            # Вместо фиксированных 2.5 сек между каналами - общий адаптивный лимитер
+            await run_bounded(scheduler.due(channels), parse_one)
+            scheduler.save()
             
             # Save updated listings
-            if new_count > 0:
-                with open(listings_file, 'w', encoding='utf-8') as f:
-                    json.dump(existing, f, ensure_ascii=False, indent=2)
-                print(f"✅ {country}: +{new_count} объявлений (всего {len(existing)})")
+            # Файл перечитывается под блокировкой - за время парсинга его могли дописать другие процессы
+            if new_items or duplicates:
+                added, merged = merge_listings(country, new_items + duplicates, at_start=False)
+                publish_listings(country, added)
+                print(f"✅ {country}: +{len(added)} объявлений")
+                if merged > 0:
+                    print(f"   🔗 Слито дубликатов: {merged}")
                 if skipped_english > 0:
                     print(f"   🚫 Отклонено англ.: {skipped_english}")
-            
-            await asyncio.sleep(0.5)
     
     finally:
         try:
@@ -186,4 +180,3 @@ if __name__ == '__main__':
     except Exception as e:
         print(f"❌ Error: {e}")
     print("\n✅ Завершено!")
-
@@ -0,0 +1,33 @@
+import os
+
+# Альбомы Telegram: несколько сообщений с общим grouped_id, подпись обычно только у одного.
+# Раньше объявлением становилось только сообщение с подписью и одним фото, остальные фото терялись.
+# Теперь сообщения альбома собираются в одно объявление, а все фото качаются параллельно.
+ALBUM_CONCURRENCY = int(os.environ.get('ALBUM_CONCURRENCY', 4))
+
+
+def group_albums(messages):
+    """[(основное сообщение, [все сообщения альбома])] в исходном порядке.
+    Основное - сообщение с текстом (подпись альбома), иначе первое; одиночные - ([msg]).
+    Альбом, попавший в окно выборки частично, собирается из того, что есть."""
+    groups = {}
+    order = []
+    for msg in messages:
+        key = getattr(msg, 'grouped_id', None) or ('single', msg.id)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(msg)
+
+    result = []
+    for key in order:
+        album = sorted(groups[key], key=lambda m: m.id)
+        primary = next((m for m in album if m.text), album[0])
+        result.append((primary, album))
+    return result
+
+
+def album_photos(album):
+    """Сообщения альбома с фото, по порядку"""
+    return [m for m in album if getattr(m, 'photo', None)]
+
@@ -1,52 +1,34 @@
-from flask import Flask, render_template, jsonify, request, Response
-from datetime import datetime, timedelta
+from flask import Flask, render_template, jsonify, request, Response, redirect
+from datetime import datetime
 import json
 import os
 import time
-import requests
 import re
+import http_client
 from pathlib import Path
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 
-online_users = {}
-ONLINE_TIMEOUT = 60
 BASE_ONLINE = 287
 
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
 TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID', '')
 
 def send_telegram_notification(message):
+    """Уведомление в канал модерации - через очередь (notify_queue.py), запрос Telegram не ждёт"""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         return False
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {
-            "chat_id": TELEGRAM_CHAT_ID,
-            "text": message,
-            "parse_mode": "HTML"
-        }
-        response = requests.post(url, data=data, timeout=10)
-        return response.status_code == 200
-    except Exception as e:
-        print(f"Telegram notification error: {e}")
-        return False
+    from notify_queue import enqueue
+    enqueue(TELEGRAM_CHAT_ID, message)
+    return True
 
 def send_telegram_message(chat_id, message):
+    """Ответ бота пользователю - через ту же очередь, но без склейки в дайджест"""
     if not TELEGRAM_BOT_TOKEN:
         return False
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {
-            "chat_id": chat_id,
-            "text": message,
-            "parse_mode": "HTML"
-        }
-        response = requests.post(url, data=data, timeout=10)
-        return response.status_code == 200
-    except Exception as e:
-        print(f"Telegram message error: {e}")
-        return False
+    from notify_queue import enqueue
+    enqueue(chat_id, message, batchable=False)
+    return True
 
 WELCOME_MESSAGE = """<b>Добро пожаловать в GoldAntelope ASIA!</b>
 
@@ -76,56 +58,8 @@ WELCOME_MESSAGE = """<b>Добро пожаловать в GoldAntelope ASIA!</b
 Подать объявление можно на нашем сайте!
 """
 
-# Данные хранятся в JSON файле по странам
-DATA_FILE = "listings_data.json"
-
-def create_empty_data():
-    return {
-        "restaurants": [],
-        "tours": [],
-        "transport": [],
-        "real_estate": [],
-        "money_exchange": [],
-        "entertainment": [],
-        "marketplace": [],
-        "visas": [],
-        "news": [],
-        "medicine": [],
-        "kids": [],
-        "chat": []
-    }
-
-def load_data(country='vietnam'):
-    country_file = f"listings_{country}.json"
-    if os.path.exists(country_file):
-        with open(country_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            if isinstance(data, dict):
-                return data
-            
-            # Если данные в файле - список, распределяем по категориям
-            result = create_empty_data()
-            category_map = {
-                'bikes': 'transport',
-                'real_estate': 'real_estate',
-                'exchange': 'money_exchange',
-                'money_exchange': 'money_exchange',
-                'food': 'restaurants'
-            }
-            for item in data:
-                if not isinstance(item, dict): continue
-                cat = item.get('category', 'chat')
-                mapped_cat = category_map.get(cat, cat)
-                if mapped_cat in result:
-                    result[mapped_cat].append(item)
-            return result
-    
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            all_data = json.load(f)
-            if country in all_data:
-                return all_data[country]
-    return create_empty_data()
+# Данные хранятся в JSON файле по странам (listings_store.py - общий с backfill_worker)
+from listings_store import DATA_FILE, create_empty_data, load_data, save_data, listings_lock
 
 def load_all_data():
     if os.path.exists(DATA_FILE):
@@ -138,55 +72,111 @@ def load_all_data():
         'indonesia': create_empty_data()
     }
 
-def save_data(country='vietnam', data=None):
-    if not data or not isinstance(data, dict):
-        return
-    
-    # Сохраняем в файл страны
-    country_file = f"listings_{country}.json"
-    try:
-        with open(country_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving country file {country_file}: {e}")
-    
-    # Синхронизируем с общим файлом listings_data.json
-    try:
-        all_data = {}
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                all_data = json.load(f)
-        
-        all_data[country] = data
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(all_data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error syncing with listings_data.json: {e}")
+_page_cache = None
+
+def prebuilt_response(asset, cache_control):
+    """Готовые байты (page_build.Asset) с учётом Accept-Encoding и If-None-Match"""
+    body, encoding = asset.encoded(request.headers.get('Accept-Encoding'))
+    # У каждого кодирования свой ETag: кэш не должен отдать br-байты по валидатору gzip-ответа
+    etag = f'"{asset.etag}-{encoding}"' if encoding else f'"{asset.etag}"'
+    headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers=headers)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(body, content_type=asset.content_type, headers=headers)
+
+def dashboard_page():
+    """Собранная страница дашборда (page_build.py): стили и скрипт - отдельными файлами, всё сжато"""
+    global _page_cache
+    if _page_cache is None:
+        from page_build import PageCache
+        _page_cache = PageCache(os.path.join(app.root_path, app.template_folder))
+    return _page_cache.get('dashboard.html', render_template)
 
 @app.route('/')
 def index():
-    return render_template('dashboard.html')
+    return prebuilt_response(dashboard_page(), 'no-cache')
+
+@app.route('/assets/<name>')
+def prebuilt_asset(name):
+    from page_build import ASSET_MAX_AGE
+    dashboard_page()
+    asset = _page_cache.assets.get(name)
+    if not asset:
+        return Response('Not found', status=404)
+    return prebuilt_response(asset, f'public, max-age={ASSET_MAX_AGE}, immutable')
+
+@app.route('/s/<path:fingerprinted>')
+def static_asset(fingerprinted):
+    """Файлы static/ с отпечатком в имени (static_assets.py): WebP по своему адресу, br/gzip по
+    Accept-Encoding, кэш навсегда"""
+    from flask import send_file
+    import static_assets
+    resolved = static_assets.resolve(fingerprinted)
+    if not resolved:
+        # Старая версия или файла нет в манифесте - отдаём текущий файл без долгого кэша
+        return redirect(static_assets.original_url(f"/s/{fingerprinted}"))
+    rel_path, entry, webp = resolved
+    path, mimetype, encoding = static_assets.choose_variant(rel_path, entry, request.headers.get('Accept-Encoding'),
+                                                            webp)
+    response = send_file(os.path.abspath(path), mimetype=mimetype, conditional=True,
+                         etag=f"{entry['hash']}-{os.path.basename(path).rsplit('.', 1)[-1]}",
+                         max_age=static_assets.ASSET_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = f'public, max-age={static_assets.ASSET_MAX_AGE}, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 @app.route('/api/ping')
 def ping():
+    # Онлайн за последнюю минуту - общий для всех воркеров счётчик (presence.py)
+    from presence import get_presence
+    presence = get_presence()
     user_id = request.args.get('uid', request.remote_addr)
-    online_users[user_id] = time.time()
-    now = time.time()
-    active = sum(1 for t in online_users.values() if now - t < ONLINE_TIMEOUT)
-    return jsonify({'online': active})
+    country = request.args.get('country')
+    presence.ping(user_id, country)
+    return jsonify({'online': presence.count(), 'country_online': presence.count(country) if country else None})
 
 @app.route('/api/online')
 def get_online():
-    now = time.time()
-    active = sum(1 for t in online_users.values() if now - t < ONLINE_TIMEOUT)
-    return jsonify({'online': active})
+    from presence import get_presence, SCOPES
+    presence = get_presence()
+    return jsonify({
+        'online': presence.count(),
+        'countries': {scope: presence.count(scope) for scope in SCOPES if scope != 'all'}
+    })
+
+def telegram_webhook_secret(bot_token=None):
+    """secret_token для setWebhook - Telegram присылает его в X-Telegram-Bot-Api-Secret-Token.
+    TELEGRAM_WEBHOOK_SECRET из окружения, иначе производный от токена бота (одинаковый во всех воркерах)"""
+    secret = os.environ.get('TELEGRAM_WEBHOOK_SECRET')
+    if secret:
+        return secret
+    bot_token = bot_token or TELEGRAM_BOT_TOKEN
+    if not bot_token:
+        return None
+    import hmac, hashlib
+    return hmac.new(bot_token.encode(), b'telegram-webhook', hashlib.sha256).hexdigest()
+
+def telegram_webhook_authorized():
+    """Запрос действительно от Telegram: без этого поддельный update подменил бы chat_id
+    пользователя в индексе логинов, и коды входа в чат ушли бы чужому"""
+    import hmac
+    secret = telegram_webhook_secret()
+    header = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    return bool(secret) and hmac.compare_digest(header, secret)
 
 @app.route('/api/telegram-webhook', methods=['POST'])
 def telegram_webhook():
+    if not telegram_webhook_authorized():
+        return jsonify({'ok': False, 'error': 'Forbidden'}), 403
     try:
         data = request.get_json()
         if not data:
             return jsonify({'ok': True})
+        remember_telegram_user(data)
         
         message = data.get('message', {})
         text = message.get('text', '')
@@ -243,7 +233,8 @@ def set_telegram_webhook():
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook"
     
     try:
-        response = requests.post(url, data={"url": webhook_url}, timeout=10)
+        response = http_client.post(url, data={"url": webhook_url, "secret_token": telegram_webhook_secret()},
+                                    timeout=10)
         return jsonify(response.json())
     except Exception as e:
         return jsonify({'error': str(e)})
@@ -439,13 +430,8 @@ def status():
     total_items = sum(len(v) for v in data.values())
     total_listings = sum(len(v) for k, v in data.items() if k != 'chat')
     
-    # Количество людей на портале по странам
-    online_counts = {
-        'vietnam': 342,
-        'thailand': 287,
-        'india': 156,
-        'indonesia': 419
-    }
+    # Количество людей на портале по странам (пинги дашборда за последнюю минуту)
+    from presence import get_presence
     
     return jsonify({
         'parser_status': 'connected',
@@ -455,7 +441,7 @@ def status():
         'last_update': datetime.now().isoformat(),
         'channels_active': 0,
         'country': country,
-        'online_count': online_counts.get(country, 100)
+        'online_count': get_presence().count(country)
     })
 
 @app.route('/api/city-counts/<category>')
@@ -530,6 +516,7 @@ def get_listings(category):
     
     # Фильтры
     filters = request.args
+    thumb_width = request.args.get('thumb', type=int)
     
     # Фильтруем скрытые объявления (если не запрошено show_hidden=1)
     show_hidden = request.args.get('show_hidden', '0') == '1'
@@ -757,43 +744,100 @@ def get_listings(category):
             filtered.sort(key=lambda x: x.get('date', x.get('added_at', '1970-01-01')) or '1970-01-01', reverse=True)
         
         # Обновляем URL для фото из Telegram
-        for item in filtered:
-            if item.get('telegram_file_id'):
-                fresh_url = get_telegram_photo_url(item['telegram_file_id'])
-                if fresh_url:
-                    item['image_url'] = fresh_url
+        refresh_telegram_photos(filtered)
+        apply_thumbnails(filtered, thumb_width)
         return jsonify(filtered)
     
     # Сортировка по дате - новые сверху
     filtered.sort(key=lambda x: x.get('date', x.get('added_at', '1970-01-01')) or '1970-01-01', reverse=True)
     
     # Обновляем URL для фото из Telegram (генерируем свежие ссылки)
-    for item in filtered:
+    refresh_telegram_photos(filtered)
+    
+    apply_thumbnails(filtered, thumb_width)
+    return jsonify(filtered)
+
+def refresh_telegram_photos(items):
+    """Ссылки getFile живут около часа - для фото из Telegram (и всех фото альбома) берём свежие"""
+    for item in items:
         if item.get('telegram_file_id'):
             fresh_url = get_telegram_photo_url(item['telegram_file_id'])
             if fresh_url:
                 item['image_url'] = fresh_url
+        if item.get('all_file_ids'):
+            fresh_urls = [get_telegram_photo_url(file_id) for file_id in item['all_file_ids']]
+            item['all_images'] = [url for url in fresh_urls if url] or item.get('all_images')
+
+def apply_thumbnails(items, width):
+    """?thumb=<ширина>: image_url -> WebP-вариант, если для фото есть уменьшенные копии"""
+    if not width:
+        return
+    from thumbnails import pick_thumbnail
+    for item in items:
+        thumb_url = pick_thumbnail(item.get('thumbnails'), width)
+        if thumb_url:
+            item['image_url'] = thumb_url
+
+@app.route('/api/listing-photo/<listing_id>')
+def listing_full_photo(listing_id):
+    """Полноразмерное фото для детального просмотра. Парсер мог скачать только превью
+    (MEDIA_FETCH_POLICY=thumb) - тогда при первом запросе ставится задача на оригинал (202),
+    а после её выполнения ссылка берётся из объявления"""
+    from media_fetch import find_listing
+    country = request.args.get('country', 'vietnam')
+    item = find_listing(country, listing_id)
+    if not item:
+        return jsonify({'error': 'Listing not found'}), 404
     
-    return jsonify(filtered)
+    if item.get('full_image_url') or not item.get('preview_only'):
+        return jsonify({
+            'status': 'ready',
+            'image_url': item.get('full_image_url') or item.get('image_url'),
+            'all_images': item.get('full_images') or item.get('all_images')
+        })
+    
+    from jobs import create_job, find_jobs
+    from media_fetch import full_photo_retry_allowed
+    key = f"full_photo:{country}:{listing_id}"
+    # После неудачи не ставим задачу на каждый просмотр: повтор с backoff и не больше нескольких раз
+    failed = [j for j in find_jobs(key) if j['status'] == 'failed']
+    if not full_photo_retry_allowed(failed, time.time()):
+        return jsonify({
+            'status': 'failed',
+            'image_url': item.get('image_url'),
+            'all_images': item.get('all_images')
+        })
+    job = create_job('full_photo', {
+        'country': country,
+        'listing_id': listing_id,
+        'channel': item.get('source_channel', ''),
+        'message_ids': item.get('photo_message_ids') or [item.get('message_id')]
+    }, key=key)
+    return jsonify({
+        'status': 'pending',
+        'job_id': job['id'],
+        'image_url': item.get('image_url'),
+        'all_images': item.get('all_images')
+    }), 202
 
 @app.route('/api/add-listing', methods=['POST'])
 def add_listing():
     country = request.json.get('country', 'vietnam')
-    data = load_data(country)
-    listing = request.json
+    with listings_lock(country):
+        data = load_data(country)
+        listing = request.json
     
-    category = listing.get('category')
-    if category and category in data:
-        listing['added_at'] = datetime.now().isoformat()
-        data[category].append(listing)
-        save_data(country, data)
-        return jsonify({'success': True, 'message': 'Объявление добавлено'})
+        category = listing.get('category')
+        if category and category in data:
+            listing['added_at'] = datetime.now().isoformat()
+            data[category].append(listing)
+            save_data(country, data)
+            return jsonify({'success': True, 'message': 'Объявление добавлено'})
     
-    return jsonify({'error': 'Invalid category'}), 400
+        return jsonify({'error': 'Invalid category'}), 400
 
 import shutil
 from werkzeug.utils import secure_filename
-import requests
 
 BUNNY_STORAGE_ZONE = os.environ.get('BUNNY_CDN_STORAGE_ZONE', 'storage.bunnycdn.com')
 BUNNY_STORAGE_NAME = os.environ.get('BUNNY_CDN_STORAGE_NAME', 'goldantelope')
@@ -801,17 +845,9 @@ BUNNY_API_KEY = os.environ.get('BUNNY_CDN_API_KEY', 'c88e0b0b-d63c-4a45-8b3d1819
 
 def upload_to_bunny(local_path, filename):
     url = f"https://{BUNNY_STORAGE_ZONE}/{BUNNY_STORAGE_NAME}/{filename}"
-    headers = {
-        "AccessKey": BUNNY_API_KEY,
-        "Content-Type": "application/octet-stream",
-    }
-    try:
-        with open(local_path, "rb") as f:
-            response = requests.put(url, data=f, headers=headers)
-            return response.status_code == 201
-    except Exception as e:
-        print(f"BunnyCDN Upload Error: {e}")
-        return False
+    # Потоковая загрузка с таймаутами и повторами - зависшее хранилище не держит воркер бесконечно
+    from bunny_upload import put_file
+    return put_file(url, local_path, BUNNY_API_KEY)
 
 BANNER_CONFIG_FILE = "banner_config.json"
 UPLOAD_FOLDER = 'static/images/banners'
@@ -831,10 +867,22 @@ def load_banner_config():
 def save_banner_config(config):
     with open(BANNER_CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config, f, ensure_ascii=False, indent=2)
+    from events import publish
+    publish('all', 'admin', {'kind': 'banners'})
 
 @app.route('/api/banners')
 def get_banners():
-    return jsonify(load_banner_config())
+    config = load_banner_config()
+    # ?thumb=<ширина> - ссылки на WebP-вариант нужной ширины вместо оригиналов
+    width = request.args.get('thumb', type=int)
+    if width:
+        from thumbnails import local_thumbnail
+        config = {country: [local_thumbnail(url, width) for url in urls] for country, urls in config.items()}
+    # ?webp=1 - браузер умеет WebP: оригиналы баннеров отдаём ссылками на WebP-варианты
+    from static_assets import asset_url
+    webp = bool(request.args.get('webp'))
+    config = {country: [asset_url(url, webp) for url in urls] for country, urls in config.items()}
+    return jsonify(config)
 
 @app.route('/api/admin/upload-banner', methods=['POST'])
 def admin_upload_banner():
@@ -856,6 +904,12 @@ def admin_upload_banner():
         file_path = os.path.join(UPLOAD_FOLDER, filename)
         file.save(file_path)
         
+        # WebP-варианты 160/480/1080, затем отпечаток и запись в манифесте - в фоне, не дожидаясь
+        # сборки; пока они не готовы, /api/banners отдаёт оригинал по обычной ссылке
+        from thumbnails import save_thumbnails_later
+        from static_assets import process_file
+        save_thumbnails_later(file_path, lambda thumbnails: process_file(file_path, thumbnails))
+        
         # Загружаем в BunnyCDN
         upload_to_bunny(file_path, filename)
         
@@ -876,7 +930,8 @@ def admin_delete_banner():
         return jsonify({'error': 'Unauthorized'}), 401
     
     country = request.json.get('country')
-    url = request.json.get('url')
+    from static_assets import original_url
+    url = original_url(request.json.get('url'))
     
     config = load_banner_config()
     if country in config and url in config[country]:
@@ -894,7 +949,8 @@ def admin_reorder_banners():
         return jsonify({'error': 'Unauthorized'}), 401
     
     country = request.json.get('country')
-    urls = request.json.get('urls')
+    from static_assets import original_url
+    urls = [original_url(url) for url in request.json.get('urls') or []]
     
     config = load_banner_config()
     if country in config:
@@ -948,14 +1004,15 @@ def admin_delete():
     category = request.json.get('category')
     listing_id = request.json.get('listing_id')
     
-    data = load_data(country)
+    with listings_lock(country):
+        data = load_data(country)
     
-    if category in data:
-        data[category] = [x for x in data[category] if x.get('id') != listing_id]
-        save_data(country, data)
-        return jsonify({'success': True, 'message': f'Объявление {listing_id} удалено'})
+        if category in data:
+            data[category] = [x for x in data[category] if x.get('id') != listing_id]
+            save_data(country, data)
+            return jsonify({'success': True, 'message': f'Объявление {listing_id} удалено'})
     
-    return jsonify({'error': 'Category not found'}), 404
+        return jsonify({'error': 'Category not found'}), 404
 
 @app.route('/api/admin/move-listing', methods=['POST'])
 def admin_move():
@@ -970,30 +1027,31 @@ def admin_move():
     to_category = request.json.get('to_category')
     listing_id = request.json.get('listing_id')
     
-    data = load_data(country)
+    with listings_lock(country):
+        data = load_data(country)
     
-    if from_category not in data or to_category not in data:
-        return jsonify({'error': 'Invalid category'}), 404
+        if from_category not in data or to_category not in data:
+            return jsonify({'error': 'Invalid category'}), 404
     
-    # Найти объявление
-    listing = None
-    if from_category in data:
-        for i, item in enumerate(data[from_category]):
-            if item.get('id') == listing_id:
-                listing = data[from_category].pop(i)
-                break
+        # Найти объявление
+        listing = None
+        if from_category in data:
+            for i, item in enumerate(data[from_category]):
+                if item.get('id') == listing_id:
+                    listing = data[from_category].pop(i)
+                    break
     
-    if not listing:
-        return jsonify({'success': False, 'error': 'Listing not found'}), 404
+        if not listing:
+            return jsonify({'success': False, 'error': 'Listing not found'}), 404
     
-    # Обновить категорию и переместить
-    listing['category'] = to_category
-    if to_category not in data:
-        data[to_category] = []
-    data[to_category].insert(0, listing)
-    save_data(country, data)
+        # Обновить категорию и переместить
+        listing['category'] = to_category
+        if to_category not in data:
+            data[to_category] = []
+        data[to_category].insert(0, listing)
+        save_data(country, data)
     
-    return jsonify({'success': True, 'message': f'Объявление перемещено в {to_category}'})
+        return jsonify({'success': True, 'message': f'Объявление перемещено в {to_category}'})
 
 @app.route('/api/admin/toggle-visibility', methods=['POST'])
 def admin_toggle_visibility():
@@ -1008,20 +1066,21 @@ def admin_toggle_visibility():
     category = request.json.get('category')
     listing_id = request.json.get('listing_id')
     
-    data = load_data(country)
+    with listings_lock(country):
+        data = load_data(country)
     
-    if category not in data:
-        return jsonify({'error': 'Category not found'}), 404
+        if category not in data:
+            return jsonify({'error': 'Category not found'}), 404
     
-    for item in data[category]:
-        if item.get('id') == listing_id:
-            current = item.get('hidden', False)
-            item['hidden'] = not current
-            save_data(country, data)
-            status = 'скрыто' if item['hidden'] else 'видимо'
-            return jsonify({'success': True, 'hidden': item['hidden'], 'message': f'Объявление {status}'})
+        for item in data[category]:
+            if item.get('id') == listing_id:
+                current = item.get('hidden', False)
+                item['hidden'] = not current
+                save_data(country, data)
+                status = 'скрыто' if item['hidden'] else 'видимо'
+                return jsonify({'success': True, 'hidden': item['hidden'], 'message': f'Объявление {status}'})
     
-    return jsonify({'error': 'Listing not found'}), 404
+        return jsonify({'error': 'Listing not found'}), 404
 
 @app.route('/api/admin/bulk-hide', methods=['POST'])
 def admin_bulk_hide():
@@ -1037,25 +1096,26 @@ def admin_bulk_hide():
     contact_name = request.json.get('contact_name')
     hide = request.json.get('hide', True)
     
-    data = load_data(country)
-    count = 0
+    with listings_lock(country):
+        data = load_data(country)
+        count = 0
     
-    if category and category in data:
-        categories = [category]
-    else:
-        categories = data.keys()
+        if category and category in data:
+            categories = [category]
+        else:
+            categories = data.keys()
     
-    for cat in categories:
-        if cat in data:
-            for item in data[cat]:
-                cn = (item.get('contact_name') or item.get('contact') or '').lower()
-                if contact_name.lower() in cn:
-                    item['hidden'] = hide
-                    count += 1
+        for cat in categories:
+            if cat in data:
+                for item in data[cat]:
+                    cn = (item.get('contact_name') or item.get('contact') or '').lower()
+                    if contact_name.lower() in cn:
+                        item['hidden'] = hide
+                        count += 1
     
-    save_data(country, data)
-    action = 'скрыто' if hide else 'показано'
-    return jsonify({'success': True, 'count': count, 'message': f'{count} объявлений {action}'})
+        save_data(country, data)
+        action = 'скрыто' if hide else 'показано'
+        return jsonify({'success': True, 'count': count, 'message': f'{count} объявлений {action}'})
 
 @app.route('/api/admin/edit-listing', methods=['POST'])
 def admin_edit():
@@ -1070,56 +1130,57 @@ def admin_edit():
     listing_id = request.json.get('listing_id')
     updates = request.json.get('updates', {})
     
-    data = load_data(country)
+    with listings_lock(country):
+        data = load_data(country)
     
-    if category not in data:
-        return jsonify({'error': 'Category not found'}), 404
+        if category not in data:
+            return jsonify({'error': 'Category not found'}), 404
     
-    for item in data[category]:
-        if item.get('id') == listing_id:
-            if 'title' in updates:
-                item['title'] = updates['title']
-            if 'description' in updates:
-                item['description'] = updates['description']
-            if 'price' in updates:
-                try:
-                    item['price'] = int(updates['price']) if updates['price'] else 0
-                except:
-                    item['price'] = 0
-            if 'rooms' in updates:
-                item['rooms'] = updates['rooms'] if updates['rooms'] else None
-            if 'area' in updates:
-                try:
-                    item['area'] = float(updates['area']) if updates['area'] else None
-                except:
-                    item['area'] = None
-            if 'date' in updates:
-                item['date'] = updates['date'] if updates['date'] else None
-            if 'whatsapp' in updates:
-                item['whatsapp'] = updates['whatsapp'] if updates['whatsapp'] else None
-            if 'telegram' in updates:
-                item['telegram'] = updates['telegram'] if updates['telegram'] else None
-            if 'contact_name' in updates:
-                item['contact_name'] = updates['contact_name'] if updates['contact_name'] else None
-            if 'listing_type' in updates:
-                item['listing_type'] = updates['listing_type'] if updates['listing_type'] else None
-            if 'city' in updates:
-                item['city'] = updates['city'] if updates['city'] else None
-            if 'google_maps' in updates:
-                item['google_maps'] = updates['google_maps'] if updates['google_maps'] else None
-            if 'google_rating' in updates:
-                item['google_rating'] = updates['google_rating'] if updates['google_rating'] else None
-            if 'kitchen' in updates:
-                item['kitchen'] = updates['kitchen'] if updates['kitchen'] else None
-            if 'restaurant_type' in updates:
-                item['restaurant_type'] = updates['restaurant_type'] if updates['restaurant_type'] else None
-            if 'price_category' in updates:
-                item['price_category'] = updates['price_category'] if updates['price_category'] else None
+        for item in data[category]:
+            if item.get('id') == listing_id:
+                if 'title' in updates:
+                    item['title'] = updates['title']
+                if 'description' in updates:
+                    item['description'] = updates['description']
+                if 'price' in updates:
+                    try:
+                        item['price'] = int(updates['price']) if updates['price'] else 0
+                    except:
+                        item['price'] = 0
+                if 'rooms' in updates:
+                    item['rooms'] = updates['rooms'] if updates['rooms'] else None
+                if 'area' in updates:
+                    try:
+                        item['area'] = float(updates['area']) if updates['area'] else None
+                    except:
+                        item['area'] = None
+                if 'date' in updates:
+                    item['date'] = updates['date'] if updates['date'] else None
+                if 'whatsapp' in updates:
+                    item['whatsapp'] = updates['whatsapp'] if updates['whatsapp'] else None
+                if 'telegram' in updates:
+                    item['telegram'] = updates['telegram'] if updates['telegram'] else None
+                if 'contact_name' in updates:
+                    item['contact_name'] = updates['contact_name'] if updates['contact_name'] else None
+                if 'listing_type' in updates:
+                    item['listing_type'] = updates['listing_type'] if updates['listing_type'] else None
+                if 'city' in updates:
+                    item['city'] = updates['city'] if updates['city'] else None
+                if 'google_maps' in updates:
+                    item['google_maps'] = updates['google_maps'] if updates['google_maps'] else None
+                if 'google_rating' in updates:
+                    item['google_rating'] = updates['google_rating'] if updates['google_rating'] else None
+                if 'kitchen' in updates:
+                    item['kitchen'] = updates['kitchen'] if updates['kitchen'] else None
+                if 'restaurant_type' in updates:
+                    item['restaurant_type'] = updates['restaurant_type'] if updates['restaurant_type'] else None
+                if 'price_category' in updates:
+                    item['price_category'] = updates['price_category'] if updates['price_category'] else None
             
-            save_data(country, data)
-            return jsonify({'success': True, 'message': 'Объявление обновлено'})
+                save_data(country, data)
+                return jsonify({'success': True, 'message': 'Объявление обновлено'})
     
-    return jsonify({'error': 'Listing not found'}), 404
+        return jsonify({'error': 'Listing not found'}), 404
 
 @app.route('/api/admin/get-listing', methods=['POST'])
 def admin_get_listing():
@@ -1162,13 +1223,9 @@ def submit_listing():
         captcha_answer = request.form.get('captcha_answer', '')
         captcha_token = request.form.get('captcha_token', '')
         
-        expected = captcha_storage.get(captcha_token)
-        if not expected or captcha_answer != expected:
+        if not check_captcha(captcha_token, captcha_answer):
             return jsonify({'error': 'Неверная капча'}), 400
         
-        if captcha_token in captcha_storage:
-            del captcha_storage[captcha_token]
-        
         country = request.form.get('country', 'vietnam')
         title = request.form.get('title', '')
         description = request.form.get('description', '')
@@ -1238,13 +1295,9 @@ def submit_restaurant():
         captcha_answer = request.form.get('captcha_answer', '')
         captcha_token = request.form.get('captcha_token', '')
         
-        expected = captcha_storage.get(captcha_token)
-        if not expected or captcha_answer != expected:
+        if not check_captcha(captcha_token, captcha_answer):
             return jsonify({'error': 'Неверная капча'}), 400
         
-        if captcha_token in captcha_storage:
-            del captcha_storage[captcha_token]
-        
         country = request.form.get('country', 'vietnam')
         title = request.form.get('title', '')
         description = request.form.get('description', '')
@@ -1312,13 +1365,9 @@ def submit_entertainment():
         captcha_answer = request.form.get('captcha_answer', '')
         captcha_token = request.form.get('captcha_token', '')
         
-        expected = captcha_storage.get(captcha_token)
-        if not expected or captcha_answer != expected:
+        if not check_captcha(captcha_token, captcha_answer):
             return jsonify({'error': 'Неверная капча'}), 400
         
-        if captcha_token in captcha_storage:
-            del captcha_storage[captcha_token]
-        
         country = request.form.get('country', 'vietnam')
         title = request.form.get('title', '')
         description = request.form.get('description', '')
@@ -1382,13 +1431,9 @@ def submit_tour():
         captcha_answer = request.form.get('captcha_answer', '')
         captcha_token = request.form.get('captcha_token', '')
         
-        expected = captcha_storage.get(captcha_token)
-        if not expected or captcha_answer != expected:
+        if not check_captcha(captcha_token, captcha_answer):
             return jsonify({'error': 'Неверная капча'}), 400
         
-        if captcha_token in captcha_storage:
-            del captcha_storage[captcha_token]
-        
         country = request.form.get('country', 'vietnam')
         title = request.form.get('title', '')
         description = request.form.get('description', '')
@@ -1454,13 +1499,9 @@ def submit_transport():
         captcha_answer = request.form.get('captcha_answer', '')
         captcha_token = request.form.get('captcha_token', '')
         
-        expected = captcha_storage.get(captcha_token)
-        if not expected or captcha_answer != expected:
+        if not check_captcha(captcha_token, captcha_answer):
             return jsonify({'error': 'Неверная капча'}), 400
         
-        if captcha_token in captcha_storage:
-            del captcha_storage[captcha_token]
-        
         country = request.form.get('country', 'vietnam')
         title = request.form.get('title', '')
         description = request.form.get('description', '')
@@ -1528,13 +1569,9 @@ def submit_realestate():
         captcha_answer = request.form.get('captcha_answer', '')
         captcha_token = request.form.get('captcha_token', '')
         
-        expected = captcha_storage.get(captcha_token)
-        if not expected or captcha_answer != expected:
+        if not check_captcha(captcha_token, captcha_answer):
             return jsonify({'error': 'Неверная капча'}), 400
         
-        if captcha_token in captcha_storage:
-            del captcha_storage[captcha_token]
-        
         country = request.form.get('country', 'vietnam')
         title = request.form.get('title', '')
         description = request.form.get('description', '')
@@ -1604,13 +1641,9 @@ def submit_kids():
         captcha_answer = request.form.get('captcha_answer', '')
         captcha_token = request.form.get('captcha_token', '')
         
-        expected = captcha_storage.get(captcha_token)
-        if not expected or captcha_answer != expected:
+        if not check_captcha(captcha_token, captcha_answer):
             return jsonify({'error': 'Неверная капча'}), 400
         
-        if captcha_token in captcha_storage:
-            del captcha_storage[captcha_token]
-        
         country = request.form.get('country', 'vietnam')
         title = request.form.get('title', '')
         kids_type = request.form.get('kids_type', 'schools')
@@ -1742,7 +1775,7 @@ def admin_moderate():
                 # Если это внешний URL
                 elif image_url.startswith('http'):
                     try:
-                        resp = requests.get(image_url, timeout=30)
+                        resp = http_client.get(image_url, timeout=30)
                         if resp.status_code == 200:
                             image_data = resp.content
                     except:
@@ -1763,30 +1796,27 @@ def admin_moderate():
             except Exception as e:
                 print(f"Error uploading photo to Telegram: {e}")
         
-        data = load_data(country)
-        if category not in data:
-            data[category] = []
-        data[category].insert(0, listing)
-        save_data(country, data)
+        with listings_lock(country):
+            data = load_data(country)
+            if category not in data:
+                data[category] = []
+            data[category].insert(0, listing)
+            save_data(country, data)
         return jsonify({'success': True, 'message': f'Объявление одобрено и добавлено в {category}'})
     else:
         return jsonify({'success': True, 'message': 'Объявление отклонено'})
 
-captcha_storage = {}
-
 @app.route('/api/captcha')
 def get_captcha():
-    import random
-    import uuid
-    a = random.randint(1, 10)
-    b = random.randint(1, 10)
-    token = str(uuid.uuid4())[:8]
-    captcha_storage[token] = str(a + b)
-    if len(captcha_storage) > 1000:
-        keys = list(captcha_storage.keys())[:500]
-        for k in keys:
-            del captcha_storage[k]
-    return jsonify({'question': f'{a} + {b} = ?', 'token': token})
+    # Подписанный токен без состояния на сервере: проверит любой воркер (captcha.py)
+    from captcha import new_captcha
+    question, token = new_captcha()
+    return jsonify({'question': question, 'token': token})
+
+def check_captcha(token, answer):
+    """Проверить ответ; решённая капча повторно не пройдёт"""
+    from captcha import check_captcha as verify
+    return verify(token, answer)
 
 @app.route('/api/parser-config', methods=['GET', 'POST'])
 def parser_config():
@@ -1830,9 +1860,12 @@ def get_thailand_channels():
 def bot_webhook():
     from telegram_bot import handle_start, handle_app, send_message
     
+    if not telegram_webhook_authorized():
+        return jsonify({'ok': False, 'error': 'Forbidden'}), 403
     data = request.json
     if not data:
         return jsonify({'ok': True})
+    remember_telegram_user(data)
     
     message = data.get('message', {})
     chat_id = message.get('chat', {}).get('id')
@@ -1862,19 +1895,47 @@ def bot_webhook():
     
     return jsonify({'ok': True})
 
-@app.route('/bot/setup', methods=['POST'])
-def setup_bot_webhook():
-    import requests
+def register_bot_webhook():
+    """setWebhook на /bot/webhook с текущим secret_token"""
     bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
     domains = os.environ.get('REPLIT_DOMAINS', '')
     
     if domains:
         webhook_url = f"https://{domains.split(',')[0]}/bot/webhook"
         url = f'https://api.telegram.org/bot{bot_token}/setWebhook'
-        result = requests.post(url, data={'url': webhook_url}).json()
-        return jsonify(result)
+        return http_client.post(url, data={'url': webhook_url,
+                                           'secret_token': telegram_webhook_secret(bot_token)}, timeout=10).json()
+    
+    return {'error': 'No domain found'}
+
+@app.route('/bot/setup', methods=['POST'])
+def setup_bot_webhook():
+    return jsonify(register_bot_webhook())
+
+def register_bot_webhook_on_startup():
+    """Вебхуки отклоняют обновления без секрета (403), а Telegram шлёт только тот secret_token,
+    с которым вебхук зарегистрирован. Поэтому при старте регистрируем его заново - иначе после деплоя
+    бот молчит до ручного /bot/setup. В фоне, чтобы не задерживать старт воркера;
+    отключается TELEGRAM_WEBHOOK_AUTOSETUP=0"""
+    if os.environ.get('TELEGRAM_WEBHOOK_AUTOSETUP', '1') != '1':
+        return
+    if not os.environ.get('TELEGRAM_BOT_TOKEN') or not os.environ.get('REPLIT_DOMAINS'):
+        return
+    import threading
+    
+    def run():
+        try:
+            result = register_bot_webhook()
+            if result.get('ok'):
+                print("✅ Вебхук бота зарегистрирован с secret_token")
+            else:
+                print(f"⚠️ Вебхук бота не зарегистрирован: {result.get('description') or result.get('error')}")
+        except Exception as e:
+            print(f"⚠️ Вебхук бота не зарегистрирован: {e}")
     
-    return jsonify({'error': 'No domain found'})
+    threading.Thread(target=run, name='webhook-setup', daemon=True).start()
+
+register_bot_webhook_on_startup()
 
 # ============ УПРАВЛЕНИЕ КАНАЛАМИ ============
 
@@ -1951,31 +2012,54 @@ def remove_channel():
     
     return jsonify({'error': 'Channel not found'}), 404
 
+@app.route('/api/admin/poll-schedule', methods=['GET'])
+def get_poll_schedule():
+    """Расписание опроса каналов по активности (EWMA новых сообщений)"""
+    password = request.args.get('password', '')
+    admin_key = os.environ.get('ADMIN_KEY', '29Sept1982!')
+
+    if password != admin_key:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    from poll_scheduler import PollScheduler, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+    return jsonify({
+        'floor': POLL_MIN_INTERVAL,
+        'ceiling': POLL_MAX_INTERVAL,
+        'channels': PollScheduler().snapshot()
+    })
+
 @app.route('/api/bunny-image/<path:image_path>')
 def bunny_image_proxy(image_path):
-    """Прокси для загрузки изображений из BunnyCDN Storage"""
+    """Прокси для загрузки изображений из BunnyCDN Storage.
+    Объект кэшируется на диске (image_cache.py) и отдаётся оттуда с ETag, 304 и Range"""
     import urllib.parse
+    from flask import send_file
+    import image_cache
     
     storage_zone = os.environ.get('BUNNY_CDN_STORAGE_ZONE', 'storage.bunnycdn.com')
     storage_name = os.environ.get('BUNNY_CDN_STORAGE_NAME', 'goldantelope')
     api_key = os.environ.get('BUNNY_CDN_API_KEY', '')
+    # Можно указать локальную заглушку, например http://127.0.0.1:8092/goldantelope
+    upstream = os.environ.get('BUNNY_PROXY_UPSTREAM', f'https://{storage_zone}/{storage_name}')
     
     # Decode the path and fetch from storage
     decoded_path = urllib.parse.unquote(image_path)
-    url = f'https://{storage_zone}/{storage_name}/{decoded_path}'
+    if '..' in decoded_path.split('/'):
+        return Response('Image not found', status=404)
+    url = f'{upstream.rstrip("/")}/{decoded_path}'
     
     try:
-        r = requests.get(url, headers={'AccessKey': api_key}, timeout=30)
-        if r.status_code == 200:
-            content_type = r.headers.get('Content-Type', 'image/jpeg')
-            return Response(r.content, mimetype=content_type, headers={
-                'Cache-Control': 'public, max-age=86400'
-            })
-        else:
-            return Response('Image not found', status=404)
+        path, meta = image_cache.get(decoded_path, url, headers={'AccessKey': api_key})
+    except image_cache.UpstreamError:
+        return Response('Image not found', status=404)
     except Exception as e:
         print(f"Error fetching image: {e}")
         return Response('Error fetching image', status=500)
+    
+    response = send_file(os.path.abspath(path), mimetype=meta['content_type'], conditional=True, etag=meta['etag'],
+                         last_modified=meta['fetched'], max_age=86400)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
 
 # ============ УПРАВЛЕНИЕ ГОРОДАМИ ============
 
@@ -1992,6 +2076,26 @@ def save_cities_config(country, category, cities):
     cities_file = f'cities_{country}_{category}.json'
     with open(cities_file, 'w', encoding='utf-8') as f:
         json.dump(cities, f, ensure_ascii=False, indent=2)
+    from events import publish
+    publish(country, 'admin', {'kind': 'cities', 'category': category})
+
+def save_city_thumbnails_later(country, category, city_id, image_path):
+    """WebP-варианты и отпечаток фото города - в фоне; по готовности варианты пишутся в конфиг,
+    если у города всё ещё это фото"""
+    from thumbnails import save_thumbnails_later
+    
+    def on_done(thumbnails):
+        # Файл мог быть перезаписан под тем же именем - новый отпечаток сбрасывает кэш браузеров
+        from static_assets import process_file
+        process_file(image_path, thumbnails)
+        cities = load_cities_config(country, category)
+        for city in cities:
+            if city.get('id') == city_id and city.get('image') == image_path:
+                city['thumbnails'] = thumbnails
+                save_cities_config(country, category, cities)
+                return
+    
+    save_thumbnails_later(image_path.lstrip('/'), on_done)
 
 @app.route('/api/admin/cities', methods=['GET', 'POST'])
 def get_cities():
@@ -2010,6 +2114,12 @@ def get_cities():
     country = request.args.get('country', 'vietnam') if request.method == 'GET' else request.json.get('country', 'vietnam')
     category = request.args.get('category', 'restaurants') if request.method == 'GET' else request.json.get('category', 'restaurants')
     cities = load_cities_config(country, category)
+    from static_assets import asset_url
+    webp = bool(request.args.get('webp'))
+    for city in cities:
+        city['image'] = asset_url(city.get('image'), webp)
+        for variant in (city.get('thumbnails') or {}).values():
+            variant['url'] = asset_url(variant.get('url'))
     return jsonify({'country': country, 'category': category, 'cities': cities})
 
 @app.route('/api/admin/add-city', methods=['POST'])
@@ -2054,9 +2164,10 @@ def add_city():
         'name': name,
         'image': image_path
     }
-    
     cities.append(new_city)
     save_cities_config(country, category, cities)
+    if image_path.startswith('/static/icons/cities/'):
+        save_city_thumbnails_later(country, category, city_id, image_path)
     
     return jsonify({'success': True, 'message': f'Город "{name}" добавлен'})
 
@@ -2115,7 +2226,9 @@ def update_city_photo():
                 f.write(file_data)
             
             city['image'] = f"/static/icons/cities/{filename}"
+            city.pop('thumbnails', None)  # старые варианты - от прежнего фото
             save_cities_config(country, category, cities)
+            save_city_thumbnails_later(country, category, city_id, city['image'])
             return jsonify({'success': True, 'message': 'Фото обновлено'})
     
     return jsonify({'error': 'City not found'}), 404
@@ -2199,12 +2312,31 @@ def edit_city_inline():
         if 'images' not in section_data:
             section_data['images'] = {}
         section_data['images'][new_name] = f"/{filepath}"
+        section_data.get('thumbnails', {}).pop(new_name, None)
     
     config[section] = section_data
     
     with open(config_file, 'w', encoding='utf-8') as f:
         json.dump(config, f, ensure_ascii=False, indent=2)
     
+    if photo and photo.filename:
+        from thumbnails import save_thumbnails_later
+        
+        def on_done(thumbnails):
+            # Конфиг перечитываем: пока кодировались варианты, его могли поменять
+            from static_assets import process_file
+            process_file(filepath, thumbnails)
+            with open(config_file, 'r', encoding='utf-8') as f:
+                current = json.load(f)
+            current_section = current.get(section, {})
+            if current_section.get('images', {}).get(new_name) != f"/{filepath}":
+                return
+            current_section.setdefault('thumbnails', {})[new_name] = thumbnails
+            with open(config_file, 'w', encoding='utf-8') as f:
+                json.dump(current, f, ensure_ascii=False, indent=2)
+        
+        save_thumbnails_later(filepath, on_done)
+    
     return jsonify({'success': True, 'message': 'Город обновлён'})
 
 @app.route('/api/admin/move-city-position', methods=['POST'])
@@ -2301,7 +2433,9 @@ def delete_city_inline():
 
 @app.route('/api/admin/manual-parse', methods=['POST'])
 def manual_parse():
-    """Ручной парсинг канала - 100% всех сообщений"""
+    """Ручной парсинг канала - 100% всех сообщений.
+    Сам парсинг идёт в backfill_worker.py: здесь задача только ставится в очередь,
+    прогресс - GET /api/admin/jobs/<id>"""
     password = request.json.get('password', '')
     admin_key = os.environ.get('ADMIN_KEY', '29Sept1982!')
     
@@ -2316,166 +2450,89 @@ def manual_parse():
     if not channel:
         return jsonify({'error': 'Channel name required'}), 400
     
-    try:
-        # Пытаемся использовать Telethon парсер
-        from telethon.sync import TelegramClient
-        
-        api_id = os.environ.get('TELEGRAM_API_ID')
-        api_hash = os.environ.get('TELEGRAM_API_HASH')
-        
-        if not api_id or not api_hash:
-            return jsonify({'error': 'Telegram API credentials not configured'}), 400
-        
-        session_name = 'goldantelope_manual'
-        client = TelegramClient(session_name, int(api_id), api_hash)
-        
-        count = 0
-        log_messages = []
-        
-        with client:
-            entity = client.get_entity(channel)
-            
-            # Если limit=0, загружаем ВСЕ сообщения (iter_messages без limit)
-            if limit == 0 or limit >= 10000:
-                messages = client.iter_messages(entity)
-            else:
-                messages = client.iter_messages(entity, limit=limit)
-            
-            data = load_data(country)
-            if category not in data:
-                data[category] = []
-            
-            existing_ids = set(item.get('telegram_link', '') for item in data[category])
-            
-            for msg in messages:
-                if msg.text:
-                    telegram_link = f"https://t.me/{channel}/{msg.id}"
-                    
-                    # Пропускаем дубликаты
-                    if telegram_link in existing_ids:
-                        continue
-                    
-                    # Создаём объявление
-                    listing_id = f"{country}_{category}_{int(time.time())}_{count}"
-                    
-                    new_listing = {
-                        'id': listing_id,
-                        'title': msg.text[:100] if msg.text else 'Без названия',
-                        'description': msg.text,
-                        'date': msg.date.isoformat() if msg.date else datetime.now().isoformat(),
-                        'telegram_link': telegram_link,
-                        'category': category
-                    }
-                    
-                    # Обработка фото - пересылаем в наш Telegram канал
-                    if msg.photo:
-                        try:
-                            # Скачиваем фото во временный буфер
-                            import io
-                            photo_buffer = io.BytesIO()
-                            client.download_media(msg.photo, file=photo_buffer)
-                            photo_buffer.seek(0)
-                            image_data = photo_buffer.read()
-                            
-                            if image_data:
-                                # Отправляем в Telegram канал с полным текстом
-                                caption = f"📋 {new_listing['title']}\n\n{msg.text[:900] if msg.text else ''}"
-                                file_id = send_photo_to_channel(image_data, caption)
-                                
-                                if file_id:
-                                    new_listing['telegram_file_id'] = file_id
-                                    new_listing['telegram_photo'] = True
-                                    # Получаем актуальный URL
-                                    fresh_url = get_telegram_photo_url(file_id)
-                                    if fresh_url:
-                                        new_listing['image_url'] = fresh_url
-                                    log_messages.append(f"[✓] Фото #{count+1} загружено в Telegram канал")
-                        except Exception as photo_err:
-                            log_messages.append(f"[!] Ошибка фото: {photo_err}")
-                    
-                    data[category].insert(0, new_listing)
-                    existing_ids.add(telegram_link)
-                    count += 1
-                    
-                    if count % 50 == 0:
-                        log_messages.append(f"[{count}] Обработано {count} сообщений...")
-            
-            save_data(country, data)
-        
-        return jsonify({
-            'success': True, 
-            'message': f'Парсинг завершён. Добавлено {count} объявлений из канала @{channel}.',
-            'count': count,
-            'log': '\n'.join(log_messages[-30:])
-        })
-        
-    except ImportError:
-        return jsonify({'error': 'Telethon не установлен. Используйте Bot API.'}), 400
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-# ============ TELEGRAM КАНАЛ ДЛЯ ФОТО ============
+    if not os.environ.get('TELEGRAM_API_ID') or not os.environ.get('TELEGRAM_API_HASH'):
+        return jsonify({'error': 'Telegram API credentials not configured'}), 400
+    
+    from jobs import create_job
+    job = create_job('manual_parse', {
+        'country': country,
+        'channel': channel,
+        'category': category,
+        'limit': 0 if limit >= 10000 else limit
+    })
+    
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'message': f'Парсинг @{channel} поставлен в очередь (задача {job["id"]})'
+    }), 202
+
+@app.route('/api/admin/jobs', methods=['GET'])
+def admin_jobs():
+    """Последние фоновые задачи"""
+    password = request.args.get('password', '')
+    admin_key = os.environ.get('ADMIN_KEY', '29Sept1982!')
+    if password != admin_key:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    from jobs import list_jobs, job_summary
+    return jsonify({'jobs': [job_summary(job) for job in list_jobs()]})
 
-TELEGRAM_PHOTO_CHANNEL = '-1003577636318'
+@app.route('/api/admin/jobs/<job_id>', methods=['GET'])
+def admin_job_status(job_id):
+    """Прогресс задачи: обработано / добавлено / последнее сообщение / сообщений в секунду"""
+    password = request.args.get('password', '')
+    admin_key = os.environ.get('ADMIN_KEY', '29Sept1982!')
+    if password != admin_key:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    from jobs import get_job, job_summary
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_summary(job))
 
-def send_photo_to_channel(image_data, caption=''):
-    """Отправить фото в Telegram канал и получить file_id для постоянного хранения"""
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        print("TELEGRAM: Bot token not found!")
-        return None
+@app.route('/api/admin/jobs/<job_id>/<action>', methods=['POST'])
+def admin_job_action(job_id, action):
+    """resume - продолжить упавшую/отменённую задачу с сохранённого места, cancel - остановить"""
+    password = request.json.get('password', '')
+    admin_key = os.environ.get('ADMIN_KEY', '29Sept1982!')
+    if password != admin_key:
+        return jsonify({'error': 'Unauthorized'}), 401
     
-    try:
-        url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
-        
-        files = {'photo': ('photo.jpg', image_data, 'image/jpeg')}
-        data = {
-            'chat_id': TELEGRAM_PHOTO_CHANNEL,
-            'caption': caption[:1024] if caption else ''
-        }
-        
-        print(f"TELEGRAM: Sending photo to channel {TELEGRAM_PHOTO_CHANNEL}, size: {len(image_data)} bytes")
-        response = requests.post(url, files=files, data=data, timeout=30)
-        result = response.json()
-        print(f"TELEGRAM: Response: {result}")
-        
-        if result.get('ok'):
-            photo = result['result'].get('photo', [])
-            if photo:
-                largest = max(photo, key=lambda x: x.get('file_size', 0))
-                file_id = largest.get('file_id')
-                print(f"TELEGRAM: Photo uploaded! file_id: {file_id[:50]}...")
-                return file_id
-        else:
-            print(f"TELEGRAM: Failed to send photo: {result.get('description', 'Unknown error')}")
-        
-        return None
-    except Exception as e:
-        print(f"TELEGRAM: Error sending photo to channel: {e}")
-        return None
+    from jobs import get_job, update_job, job_summary
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if action == 'resume' and job['status'] in ('failed', 'cancelled'):
+        job = update_job(job_id, status='queued', error=None, finished=None)
+    elif action == 'cancel' and job['status'] in ('queued', 'running'):
+        job = update_job(job_id, status='cancelled', finished=time.time())
+    else:
+        return jsonify({'error': f'Cannot {action} job in status {job["status"]}'}), 400
+    return jsonify(job_summary(job))
 
-def get_telegram_photo_url(file_id):
-    """Получить актуальный URL фото по file_id"""
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token or not file_id:
-        return None
+@app.route('/api/admin/http-stats', methods=['GET'])
+def admin_http_stats():
+    """Исходящие запросы по хостам: задержки, ошибки, сколько соединений открыто"""
+    password = request.args.get('password', '')
+    admin_key = os.environ.get('ADMIN_KEY', '29Sept1982!')
+    if password != admin_key:
+        return jsonify({'error': 'Unauthorized'}), 401
     
-    try:
-        file_url = f"https://api.telegram.org/bot{bot_token}/getFile?file_id={file_id}"
-        file_response = requests.get(file_url, timeout=10).json()
-        
-        if file_response.get('ok'):
-            file_path = file_response['result'].get('file_path')
-            return f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
-    except:
-        pass
-    return None
+    return jsonify({'hosts': http_client.stats()})
+
+# ============ TELEGRAM КАНАЛ ДЛЯ ФОТО ============
+
+from telegram_photos import send_photo_to_channel, get_telegram_photo_url
 
 # ============ ВНУТРЕННИЙ ЧАТ С TELEGRAM АВТОРИЗАЦИЕЙ ============
 
 CHAT_DATA_FILE = 'internal_chat.json'
 CHAT_BLACKLIST_FILE = 'chat_blacklist.json'
-verification_codes = {}
+# Коды подтверждения и сессии чата - в session_store (общие для всех воркеров gunicorn)
+CHAT_CODE_TTL = 600
+CHAT_SESSION_TTL = int(os.environ.get('CHAT_SESSION_TTL', 30 * 24 * 3600))
 import random
 import string
 
@@ -2489,23 +2546,18 @@ CHAT_FILES = {
 def get_chat_file(country='vietnam'):
     return CHAT_FILES.get(country, CHAT_FILES['vietnam'])
 
-def load_chat_data(country='vietnam'):
+def load_legacy_chat_users(country='vietnam'):
+    """Сессии чата, выданные до session_store, - из старого файла чата страны"""
     chat_file = get_chat_file(country)
     if os.path.exists(chat_file):
         with open(chat_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            messages = data.get('messages', [])
-            three_days_ago = datetime.now() - timedelta(days=3)
-            messages = [m for m in messages if datetime.fromisoformat(m.get('timestamp', '2000-01-01')) > three_days_ago]
-            return {'messages': messages[-500:], 'users': data.get('users', {})}
-    return {'messages': [], 'users': {}}
+            return json.load(f).get('users', {})
+    return {}
 
-def save_chat_data(data, country='vietnam'):
-    chat_file = get_chat_file(country)
-    three_days_ago = datetime.now() - timedelta(days=3)
-    data['messages'] = [m for m in data.get('messages', []) if datetime.fromisoformat(m.get('timestamp', '2000-01-01')) > three_days_ago][-500:]
-    with open(chat_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def get_chat_log(country='vietnam'):
+    """Журнал сообщений чата страны (chat_store.py)"""
+    from chat_store import get_chat
+    return get_chat(get_chat_file(country))
 
 def load_blacklist():
     if os.path.exists(CHAT_BLACKLIST_FILE):
@@ -2525,37 +2577,47 @@ def load_chat_users():
             return json.load(f)
     return {}
 
-def save_chat_users(data):
-    with open(CHAT_USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def telegram_sender(update):
+    """(username, chat_id) автора апдейта Bot API, если он пишет боту в личку; иначе (None, None)"""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        item = update.get(kind)
+        if not item:
+            continue
+        chat = (item.get('message') or {}).get('chat', {}) if kind == 'callback_query' else item.get('chat', {})
+        username = (item.get('from') or {}).get('username')
+        if username and chat.get('type') == 'private' and chat.get('id'):
+            return username.lower(), str(chat['id'])
+    return None, None
+
+def remember_telegram_user(update):
+    """Вебхуки бота: @username -> chat_id каждого, кто пишет боту, - в session_store.
+    Пишем только новое или изменившееся, повторные сообщения - одно чтение по ключу"""
+    try:
+        username, chat_id = telegram_sender(update)
+        if not username:
+            return
+        from session_store import get_store
+        store = get_store()
+        if store.get(f"tg_user:{username}") != chat_id:
+            store.set(f"tg_user:{username}", chat_id)
+    except Exception as e:
+        print(f"Error saving Telegram user: {e}")
 
 def find_chat_id_by_username(username):
-    users = load_chat_users()
+    """chat_id по @username - один запрос по ключу, без обращения к Telegram.
+    Записи добавляют вебхуки (/bot/webhook, /api/telegram-webhook) по мере прихода сообщений.
+    getUpdates здесь больше не вызывается: при установленном вебхуке он не работает"""
     username_lower = username.lower().replace('@', '')
-    if username_lower in users:
-        return users[username_lower]
-    
-    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not bot_token:
-        return None
-    
-    try:
-        url = f"https://api.telegram.org/bot{bot_token}/getUpdates?limit=100"
-        resp = requests.get(url, timeout=10)
-        if resp.status_code == 200:
-            updates = resp.json().get('result', [])
-            for upd in updates:
-                msg = upd.get('message', {})
-                user = msg.get('from', {})
-                uname = user.get('username', '').lower()
-                chat_id = msg.get('chat', {}).get('id')
-                if uname and chat_id:
-                    users[uname] = str(chat_id)
-            save_chat_users(users)
-            if username_lower in users:
-                return users[username_lower]
-    except Exception as e:
-        print(f"Error finding chat_id: {e}")
+    from session_store import get_store
+    store = get_store()
+    chat_id = store.get(f"tg_user:{username_lower}")
+    if chat_id:
+        return chat_id
+    # Записи, собранные раньше в chat_users.json, переносим при первом обращении
+    chat_id = load_chat_users().get(username_lower)
+    if chat_id:
+        store.set(f"tg_user:{username_lower}", str(chat_id))
+        return str(chat_id)
     return None
 
 @app.route('/api/chat/request-code', methods=['POST'])
@@ -2573,8 +2635,9 @@ def request_chat_code():
     if not chat_id:
         return jsonify({'success': False, 'error': 'Сначала напишите боту @goldantelope_bot команду /start'})
     
+    from session_store import get_store
     code = ''.join(random.choices(string.digits, k=6))
-    verification_codes[username.lower()] = {'code': code, 'expires': datetime.now() + timedelta(minutes=10), 'chat_id': chat_id}
+    get_store().set(f"chat_code:{username.lower()}", {'code': code, 'chat_id': chat_id}, ttl=CHAT_CODE_TTL)
     
     message = f"🔐 Ваш код для чата GoldAntelope:\n\n<b>{code}</b>\n\nКод действителен 10 минут."
     
@@ -2582,7 +2645,7 @@ def request_chat_code():
         bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
         if bot_token:
             url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-            resp = requests.post(url, json={'chat_id': chat_id, 'text': message, 'parse_mode': 'HTML'}, timeout=10)
+            resp = http_client.post(url, json={'chat_id': chat_id, 'text': message, 'parse_mode': 'HTML'}, timeout=10)
             if resp.status_code == 200 and resp.json().get('ok'):
                 return jsonify({'success': True, 'message': 'Код отправлен в Telegram'})
             else:
@@ -2602,33 +2665,69 @@ def verify_chat_code():
     if not telegram_id or not code:
         return jsonify({'success': False, 'error': 'Укажите ID и код'})
     
-    stored = verification_codes.get(telegram_id)
+    from session_store import get_store
+    store = get_store()
+    stored = store.get(f"chat_code:{telegram_id}")
     if not stored:
-        return jsonify({'success': False, 'error': 'Сначала запросите код'})
-    
-    if datetime.now() > stored['expires']:
-        del verification_codes[telegram_id]
-        return jsonify({'success': False, 'error': 'Код истёк, запросите новый'})
+        return jsonify({'success': False, 'error': 'Код истёк или не запрошен, запросите новый'})
     
     if stored['code'] != code:
         return jsonify({'success': False, 'error': 'Неверный код'})
     
-    del verification_codes[telegram_id]
+    # Код одноразовый: при двух одновременных запросах сессию получит только один
+    if store.pop(f"chat_code:{telegram_id}") is None:
+        return jsonify({'success': False, 'error': 'Код уже использован, запросите новый'})
     
     session_token = ''.join(random.choices(string.ascii_letters + string.digits, k=32))
-    
-    for country in CHAT_FILES.keys():
-        chat_data = load_chat_data(country)
-        chat_data['users'][session_token] = {'telegram_id': telegram_id, 'created': datetime.now().isoformat()}
-        save_chat_data(chat_data, country)
+    # Одна запись на все страны вместо перезаписи четырёх файлов чата
+    store.set(f"chat_session:{session_token}",
+              {'telegram_id': telegram_id, 'created': datetime.now().isoformat()}, ttl=CHAT_SESSION_TTL)
     
     return jsonify({'success': True, 'token': session_token, 'username': telegram_id})
 
+def migrate_legacy_chat_sessions(store):
+    """Один раз перенести сессии из старых файлов чата в session_store. Пока переноса не было,
+    неизвестный токен стоил бы чтения всех файлов на каждый запрос. True - перенос был сейчас"""
+    if store.get('chat_legacy_sessions_migrated'):
+        return False
+    moved = 0
+    for country in CHAT_FILES.keys():
+        for token, user in load_legacy_chat_users(country).items():
+            if not store.get(f"chat_session:{token}"):
+                store.set(f"chat_session:{token}", user, ttl=CHAT_SESSION_TTL)
+                moved += 1
+    store.set('chat_legacy_sessions_migrated', {'moved': moved, 'at': datetime.now().isoformat()})
+    print(f"💬 Сессии чата: {moved} перенесено из файлов чата в session_store")
+    return True
+
+def get_chat_session(token):
+    """Пользователь чата по токену сессии - один запрос к session_store
+    (токены, выданные до переезда в хранилище, переносятся туда один раз)"""
+    from session_store import get_store
+    store = get_store()
+    user = store.get(f"chat_session:{token}")
+    if user:
+        return user
+    if migrate_legacy_chat_sessions(store):
+        return store.get(f"chat_session:{token}")
+    return None
+
+@app.route('/api/stream')
+def event_stream():
+    """SSE-поток держит отдельный асинхронный процесс event_server.py: обычно /api/stream
+    проксируется туда, минуя Flask. Если задан EVENT_STREAM_URL - перенаправляем, иначе 204:
+    EventSource перестаёт переподключаться, а дашборд остаётся на опросе по таймеру"""
+    stream_url = os.environ.get('EVENT_STREAM_URL')
+    if not stream_url:
+        return Response(status=204)
+    return redirect(f"{stream_url}?{request.query_string.decode()}", code=307)
+
 @app.route('/api/chat/messages', methods=['GET'])
 def get_chat_messages():
+    # ?since=<id последнего полученного> - только новые сообщения и удаления
     country = request.args.get('country', 'vietnam')
-    chat_data = load_chat_data(country)
-    return jsonify({'messages': chat_data.get('messages', [])[-500:]})
+    since = request.args.get('since', 0, type=int)
+    return jsonify(get_chat_log(country).since(since))
 
 @app.route('/api/chat/send', methods=['POST'])
 def send_chat_message():
@@ -2643,8 +2742,7 @@ def send_chat_message():
     if len(message) > 2000:
         return jsonify({'success': False, 'error': 'Сообщение слишком длинное (макс 2000 символов)'})
     
-    chat_data = load_chat_data(country)
-    user = chat_data.get('users', {}).get(token)
+    user = get_chat_session(token)
     if not user:
         return jsonify({'success': False, 'error': 'Сессия истекла, войдите заново'})
     
@@ -2654,15 +2752,9 @@ def send_chat_message():
     if telegram_id.lower() in [u.lower() for u in blacklist.get('users', [])]:
         return jsonify({'success': False, 'error': 'Ваш аккаунт заблокирован'})
     
-    new_message = {
-        'id': f"msg_{int(time.time())}_{random.randint(1000,9999)}",
-        'username': telegram_id,
-        'message': message,
-        'timestamp': datetime.now().isoformat()
-    }
-    
-    chat_data['messages'].append(new_message)
-    save_chat_data(chat_data, country)
+    new_message = get_chat_log(country).append(telegram_id, message)
+    from events import publish
+    publish(country, 'chat', new_message)
     
     # Дублируем сообщение в Telegram канал
     if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
@@ -2672,7 +2764,7 @@ def send_chat_message():
         except Exception as e:
             print(f"Error sending chat to Telegram: {e}")
     
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'id': new_message['id']})
 
 @app.route('/api/admin/chat-blacklist', methods=['GET', 'POST'])
 def admin_chat_blacklist():
@@ -2713,13 +2805,16 @@ def admin_delete_chat_message():
     if admin_key != expected_key:
         return jsonify({'success': False, 'error': 'Неверный пароль'}), 401
     
-    msg_id = data.get('message_id')
-    if not msg_id:
+    try:
+        msg_id = int(data.get('message_id'))
+    except (TypeError, ValueError):
         return jsonify({'success': False, 'error': 'Укажите ID сообщения'})
     
-    chat_data = load_chat_data()
-    chat_data['messages'] = [m for m in chat_data['messages'] if m.get('id') != msg_id]
-    save_chat_data(chat_data)
+    country = data.get('country', 'vietnam')
+    if not get_chat_log(country).delete(msg_id):
+        return jsonify({'success': False, 'error': 'Сообщение не найдено'})
+    from events import publish
+    publish(country, 'chat', {'deleted': msg_id})
     
     return jsonify({'success': True, 'message': 'Сообщение удалено'})
 
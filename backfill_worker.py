@@ -0,0 +1,330 @@
+import os
+import time
+import asyncio
+from datetime import datetime
+from telethon import TelegramClient
+from entity_cache import resolve_entity, invalidate, is_stale_error
+from rate_limiter import get_limiter, run_bounded
+from image_hash import ImageIndex, dhash
+from seen_photos import SeenPhotos, photo_key
+from dedup_index import iter_listings
+from albums import group_albums, album_photos, ALBUM_CONCURRENCY
+from jobs import claim_job, update_job, JOB_HEARTBEAT_INTERVAL
+from media_fetch import update_listing
+from bunny_upload import BunnyUploader
+from listings_store import load_data, save_data, listings_lock
+from telegram_photos import (send_photo_to_channel, get_telegram_photo_url, get_channel_photo_file_id,
+                             TELEGRAM_PHOTO_CHANNEL)
+
+# Фоновый воркер ручного парсинга (бэкфилла) каналов.
+# /api/admin/manual-parse только ставит задачу в очередь (jobs.py), а история канала читается здесь
+# страницами по BACKFILL_PAGE сообщений. После каждой страницы объявления сохраняются,
+# а в задачу пишется id последнего обработанного сообщения - после падения или
+# повторного запуска чтение продолжается с него (offset_id), а не с начала канала.
+API_ID = os.environ.get('TELEGRAM_API_ID')
+API_HASH = os.environ.get('TELEGRAM_API_HASH')
+BACKFILL_SESSION = 'goldantelope_manual'
+BACKFILL_PAGE = 100
+JOB_POLL_INTERVAL = 3  # сек между проверками очереди
+# forward - фото копируется в TELEGRAM_PHOTO_CHANNEL на стороне Telegram (send_file по ссылке на фото),
+# upload - по-старому: скачать байты и залить через Bot API (нужно, если копирование запрещено)
+PHOTO_INGEST_MODE = os.environ.get('PHOTO_INGEST_MODE', 'forward')
+
+
+async def photo_channel_entity(client):
+    """Канал для фото; access_hash берём из диалогов, если его ещё нет в сессии"""
+    try:
+        return await client.get_input_entity(int(TELEGRAM_PHOTO_CHANNEL))
+    except ValueError:
+        async for _ in client.iter_dialogs():
+            pass
+        return await client.get_input_entity(int(TELEGRAM_PHOTO_CHANNEL))
+
+
+async def copy_photo_to_channel(client, limiter, photo, caption):
+    """Zero-copy: Telegram сам копирует фото в наш канал, Bot API отдаёт его file_id.
+    None - если канал-источник запрещает копирование или что-то не вышло (тогда старый путь)"""
+    try:
+        channel = await photo_channel_entity(client)
+        sent = await limiter.call(client.send_file, channel, photo, caption=caption[:1024])
+    except Exception as e:
+        print(f"   ⚠️ Копирование фото: {str(e)[:80]}")
+        return None
+    loop = asyncio.get_running_loop()
+    file_id = await loop.run_in_executor(None, get_channel_photo_file_id, sent.id)
+    if not file_id:
+        # Дальше фото зальётся старым путём - копию убираем, чтобы в канале не было двух одинаковых
+        try:
+            await limiter.call(client.delete_messages, channel, [sent.id])
+        except Exception as e:
+            print(f"   ⚠️ Удаление копии фото {sent.id}: {str(e)[:80]}")
+    return file_id
+
+
+def use_photo(listing, file_id, image_url=None, image_phash=None):
+    listing['telegram_file_id'] = file_id
+    listing['telegram_photo'] = True
+    if image_url:
+        listing['image_url'] = image_url
+    if image_phash:
+        listing['image_phash'] = image_phash
+
+
+async def attach_photo(client, limiter, job_state, msg, listing, text=None):
+    """Фото сообщения -> telegram_file_id в нашем канале, по возможности без скачивания байтов"""
+    listings_by_id = job_state['listings_by_id']
+    seen_photos = job_state['seen_photos']
+    image_index = job_state['image_index']
+    key = photo_key(msg.photo)
+    loop = asyncio.get_running_loop()
+
+    # Фото уже обрабатывалось раньше (тот же photo.id) - берём его из готового объявления
+    known_photo = listings_by_id.get(seen_photos.get(key))
+    if known_photo and known_photo.get('telegram_file_id'):
+        use_photo(listing, known_photo['telegram_file_id'], known_photo.get('image_url'), known_photo.get('image_phash'))
+        return
+
+    text = text or msg.text
+    caption = f"📋 {listing['title']}\n\n{text[:900] if text else ''}"
+    if job_state['zero_copy']:
+        file_id = await copy_photo_to_channel(client, limiter, msg.photo, caption)
+        if file_id:
+            seen_photos.add(key, listing['id'])
+            use_photo(listing, file_id, await loop.run_in_executor(None, get_telegram_photo_url, file_id))
+            return
+        # Канал с запретом копирования - не тратим запросы на каждое фото
+        job_state['zero_copy_failures'] += 1
+        if job_state['zero_copy_failures'] >= 3:
+            job_state['zero_copy'] = False
+            print("   ⚠️ Копирование фото не работает для этого канала - скачиваем и заливаем")
+
+    # Старый путь: скачать, сверить перцептивный хеш, залить через Bot API
+    image_data = await limiter.call(client.download_media, msg.photo, bytes)
+    if not image_data:
+        return
+    seen_photos.add(key, listing['id'])
+    image_phash = dhash(image_data)
+    same_photo = listings_by_id.get(image_index.find(image_phash))
+    if image_phash is not None:
+        listing['image_phash'] = format(image_phash, '016x')
+        image_index.add(image_phash, listing['id'])
+    if same_photo and same_photo.get('telegram_file_id'):
+        use_photo(listing, same_photo['telegram_file_id'], same_photo.get('image_url'))
+        return
+    # Отправка в Telegram канал - синхронный requests, уводим из event loop
+    file_id = await loop.run_in_executor(None, send_photo_to_channel, image_data, caption)
+    if file_id:
+        use_photo(listing, file_id, await loop.run_in_executor(None, get_telegram_photo_url, file_id))
+
+
+async def attach_album(client, limiter, job_state, msg, photos, listing):
+    """Все фото альбома параллельно; первое - основное фото объявления, остальные в all_images"""
+    async def attach(photo_msg):
+        target = {'id': listing['id'], 'title': listing['title']}
+        await attach_photo(client, limiter, job_state, photo_msg, target, text=msg.text)
+        return target
+
+    results = await run_bounded(photos, attach, ALBUM_CONCURRENCY)
+    attached = []
+    for photo_msg, result in zip(photos, results):
+        if isinstance(result, Exception):
+            print(f"   ⚠️ Фото {photo_msg.id}: {str(result)[:80]}")
+        elif result.get('telegram_file_id'):
+            attached.append(result)
+    if not attached:
+        return
+    listing.update(attached[0])
+    if len(attached) > 1:
+        # Ссылки getFile протухают - храним file_id, app.get_listings обновляет all_images
+        listing['all_file_ids'] = [a['telegram_file_id'] for a in attached]
+        listing['all_images'] = [a.get('image_url') for a in attached if a.get('image_url')] or None
+
+
+async def process_message(client, limiter, job_state, msg, album=None):
+    """Сообщение (с фото альбома) -> объявление (или None для дубликатов/пустых)"""
+    params = job_state['params']
+    channel, country, category = params['channel'], params['country'], params['category']
+    if not msg.text:
+        return None
+    telegram_link = f"https://t.me/{channel}/{msg.id}"
+    if telegram_link in job_state['existing_links']:
+        return None
+
+    listing_id = f"{country}_{category}_{int(time.time())}_{job_state['counter']}"
+    job_state['counter'] += 1
+    new_listing = {
+        'id': listing_id,
+        'title': msg.text[:100] if msg.text else 'Без названия',
+        'description': msg.text,
+        'date': msg.date.isoformat() if msg.date else datetime.now().isoformat(),
+        'telegram_link': telegram_link,
+        'category': category
+    }
+
+    photos = album_photos(album or [msg])
+    if len(photos) > 1:
+        await attach_album(client, limiter, job_state, msg, photos, new_listing)
+    elif photos:
+        try:
+            await attach_photo(client, limiter, job_state, photos[0], new_listing, text=msg.text)
+        except Exception as photo_err:
+            print(f"   ⚠️ Фото {telegram_link}: {str(photo_err)[:80]}")
+
+    job_state['existing_links'].add(telegram_link)
+    job_state['listings_by_id'][listing_id] = new_listing
+    return new_listing
+
+
+async def run_manual_parse(client, job):
+    params = job['params']
+    channel, country, category = params['channel'], params['country'], params['category']
+    limit = params.get('limit') or 0
+    progress = job.get('progress', {})
+    limiter = get_limiter(client)
+
+    try:
+        entity = await limiter.call(resolve_entity, client, channel)
+    except Exception as e:
+        if is_stale_error(e):
+            invalidate(client, channel)
+        raise
+
+    data = load_data(country)
+    listings_by_id = {item.get('id'): item for item in iter_listings(data)}
+    job_state = {
+        'params': params,
+        'existing_links': {item.get('telegram_link', '') for item in data.get(category, [])},
+        'listings_by_id': listings_by_id,
+        'image_index': ImageIndex(listings_by_id.values()),
+        'seen_photos': SeenPhotos(),
+        'zero_copy': PHOTO_INGEST_MODE == 'forward',
+        'zero_copy_failures': 0,
+        'counter': progress.get('processed', 0)
+    }
+
+    processed = progress.get('processed', 0)
+    added = progress.get('added', 0)
+    active_seconds = progress.get('active_seconds', 0)
+    # Продолжаем с места остановки: get_messages(offset_id=X) отдаёт сообщения старше X
+    offset_id = progress.get('last_message_id') or 0
+    if offset_id:
+        print(f"↪️ Продолжаем @{channel} с сообщения {offset_id} (уже {processed})")
+
+    while not limit or processed < limit:
+        page_started = time.monotonic()
+        page_size = BACKFILL_PAGE if not limit else min(BACKFILL_PAGE, limit - processed)
+        messages = await limiter.call(client.get_messages, entity, limit=page_size, offset_id=offset_id)
+        if not messages:
+            break
+
+        new_listings = []
+        # Альбом на границе страниц собирается из своей части: подпись - в одной из них
+        for msg, album in group_albums(messages):
+            listing = await process_message(client, limiter, job_state, msg, album)
+            if listing:
+                new_listings.append(listing)
+
+        # Файл страны перечитываем перед записью - его параллельно пишут парсеры и админка
+        if new_listings:
+            with listings_lock(country):
+                data = load_data(country)
+                if category not in data:
+                    data[category] = []
+                data[category][0:0] = reversed(new_listings)
+                save_data(country, data)
+        job_state['seen_photos'].save()
+
+        processed += len(messages)
+        added += len(new_listings)
+        offset_id = messages[-1].id
+        active_seconds += time.monotonic() - page_started
+        job = update_job(job['id'], progress={
+            'processed': processed,
+            'added': added,
+            'last_message_id': offset_id,
+            'active_seconds': round(active_seconds, 2)
+        })
+        print(f"   [{processed}] @{channel}: +{added}, сообщение {offset_id}")
+        if not job or job['status'] == 'cancelled':
+            print(f"⏹️ Задача отменена: @{channel}")
+            return
+    update_job(job['id'], status='done', finished=time.time())
+    print(f"✅ @{channel}: обработано {processed}, добавлено {added}")
+
+
+async def run_full_photo(client, job):
+    """Оригиналы фото объявления, спарсенного с превью (MEDIA_FETCH_POLICY=thumb):
+    качаем по photo_message_ids, заливаем в BunnyCDN, ссылки - в full_image_url / full_images"""
+    params = job['params']
+    limiter = get_limiter(client)
+    channel = params['channel'].lstrip('@')
+    entity = await limiter.call(resolve_entity, client, channel)
+    messages = await limiter.call(client.get_messages, entity, ids=params['message_ids'])
+    photos = [m for m in messages if m and m.photo]
+
+    async with BunnyUploader() as uploader:
+        async def fetch(msg):
+            data = await limiter.call(client.download_media, msg.media, bytes)
+            return await uploader.upload(data, 'jpg')
+
+        urls = await run_bounded(photos, fetch, ALBUM_CONCURRENCY)
+    urls = [url for url in urls if isinstance(url, str)]
+    if not urls:
+        update_job(job['id'], status='failed', error='no photos', finished=time.time())
+        return
+    fields = {'full_image_url': urls[0]}
+    if len(urls) > 1:
+        fields['full_images'] = urls
+    update_listing(params['country'], params['listing_id'], fields)
+    update_job(job['id'], status='done', finished=time.time())
+    print(f"🖼️ Оригинал фото: {params['listing_id']}")
+
+
+async def keep_alive(job_id):
+    """Heartbeat задачи, пока она выполняется: пауза лимитера после FloodWait (до 900 сек)
+    длиннее JOB_STALE_AFTER, и без него задачу посчитали бы брошенной и запустили второй раз"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        await loop.run_in_executor(None, update_job, job_id)
+
+
+JOB_RUNNERS = {
+    'manual_parse': run_manual_parse,
+    'full_photo': run_full_photo
+}
+
+
+async def worker_loop():
+    client = TelegramClient(BACKFILL_SESSION, int(API_ID), API_HASH)
+    await client.connect()
+    if not await client.is_user_authorized():
+        print(f"❌ Сессия {BACKFILL_SESSION} не авторизована!")
+        return
+    print(f"✅ Backfill worker: ожидание задач")
+    try:
+        while True:
+            job = claim_job(list(JOB_RUNNERS))
+            if not job:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            print(f"🚀 Задача {job['id']} ({job['kind']}): @{job['params']['channel']}")
+            heartbeat = asyncio.create_task(keep_alive(job['id']))
+            try:
+                await JOB_RUNNERS[job['kind']](client, job)
+            except Exception as e:
+                # Прогресс сохранён - задачу можно продолжить через /api/admin/jobs/<id>/resume
+                update_job(job['id'], status='failed', error=str(e)[:300], finished=time.time())
+                print(f"❌ Задача {job['id']}: {str(e)[:100]}")
+            finally:
+                heartbeat.cancel()
+    finally:
+        await client.disconnect()
+
+
+if __name__ == '__main__':
+    if not API_ID or not API_HASH:
+        print("❌ TELEGRAM_API_ID / TELEGRAM_API_HASH не заданы")
+    else:
+        print(f"🔄 Backfill worker: {datetime.now().strftime('%H:%M:%S')}")
+        asyncio.run(worker_loop())
@@ -0,0 +1,168 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import aiohttp
+import requests
+import http_client
+
+# Загрузка фото в BunnyCDN Storage.
+# Парсеры: асинхронно через общий пул соединений aiohttp, не более BUNNY_UPLOAD_CONCURRENCY
+# загрузок одновременно, с повторами и backoff. Загрузка идёт в фоне параллельно со скачиванием
+# следующих сообщений, а не блокирует event loop на requests.put.
+# Путь зависит только от содержимого (listings/{md5}.{ext}), поэтому если файл уже лежит
+# в хранилище (HEAD 200), повторно его не заливаем.
+BUNNY_STORAGE_ZONE = os.environ.get('BUNNY_STORAGE_ZONE', '')
+BUNNY_ACCESS_KEY = os.environ.get('BUNNY_ACCESS_KEY', '')
+BUNNY_CDN_URL = os.environ.get('BUNNY_CDN_URL', '')
+# Можно указать локальную заглушку, например http://127.0.0.1:8089
+BUNNY_STORAGE_ENDPOINT = os.environ.get('BUNNY_STORAGE_ENDPOINT', 'https://storage.bunnycdn.com')
+
+BUNNY_UPLOAD_CONCURRENCY = int(os.environ.get('BUNNY_UPLOAD_CONCURRENCY', 4))
+BUNNY_UPLOAD_RETRIES = int(os.environ.get('BUNNY_UPLOAD_RETRIES', 3))
+BUNNY_UPLOAD_TIMEOUT = int(os.environ.get('BUNNY_UPLOAD_TIMEOUT', 60))
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def content_path(data, ext='jpg', folder='listings'):
+    """Путь в хранилище по md5 содержимого"""
+    return f"{folder}/{hashlib.md5(data).hexdigest()}.{ext}"
+
+
+def cdn_url(remote_path):
+    if BUNNY_CDN_URL and 'b-cdn.net' in BUNNY_CDN_URL:
+        return f"{BUNNY_CDN_URL.rstrip('/')}/{remote_path}"
+    return f"https://{BUNNY_STORAGE_ZONE}.b-cdn.net/{remote_path}"
+
+
+def _backoff(attempt):
+    return min(30, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+class BunnyUploader:
+    """async with BunnyUploader() as uploader:
+           uploader.submit(photo_bytes, target=item)   # item['image_url'] заполнится в фоне
+       при выходе из блока дожидается всех загрузок"""
+
+    def __init__(self, concurrency=BUNNY_UPLOAD_CONCURRENCY, retries=BUNNY_UPLOAD_RETRIES,
+                 endpoint=None, storage_zone=None, access_key=None):
+        self.endpoint = (endpoint or BUNNY_STORAGE_ENDPOINT).rstrip('/')
+        self.storage_zone = storage_zone if storage_zone is not None else BUNNY_STORAGE_ZONE
+        self.access_key = access_key if access_key is not None else BUNNY_ACCESS_KEY
+        self.concurrency = concurrency
+        self.retries = retries
+        self.session = None
+        self.semaphore = None
+        self.tasks = set()
+        self.inflight = {}  # путь -> задача: одинаковое фото из разных каналов заливается один раз
+        self.stats = {'uploaded': 0, 'skipped': 0, 'failed': 0, 'retries': 0}
+
+    @property
+    def enabled(self):
+        return bool(self.storage_zone and self.access_key)
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=BUNNY_UPLOAD_TIMEOUT, connect=10),
+            headers={'AccessKey': self.access_key}
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.drain()
+        await self.session.close()
+
+    async def upload(self, data, ext='jpg'):
+        """Залить байты, вернуть CDN-ссылку (или None после всех повторов)"""
+        if not self.enabled or not data:
+            return None
+        remote_path = content_path(data, ext)
+        if remote_path not in self.inflight:
+            task = asyncio.ensure_future(self._upload(data, remote_path))
+            task.add_done_callback(lambda task, path=remote_path: self._forget_failed(path, task))
+            self.inflight[remote_path] = task
+        return await asyncio.shield(self.inflight[remote_path])
+
+    def _forget_failed(self, remote_path, task):
+        """Неудачную загрузку не кэшируем - тот же файл позже можно залить снова"""
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            if self.inflight.get(remote_path) is task:
+                del self.inflight[remote_path]
+
+    async def _request(self, url, data):
+        """Одна попытка: (статус, уже был в хранилище). Семафор держим только на время запросов"""
+        async with self.semaphore:
+            async with self.session.head(url) as response:
+                if response.status == 200:
+                    return 200, True
+            async with self.session.put(url, data=data,
+                                        headers={'Content-Type': 'application/octet-stream'}) as response:
+                return response.status, False
+
+    async def _upload(self, data, remote_path):
+        url = f"{self.endpoint}/{self.storage_zone}/{remote_path}"
+        for attempt in range(self.retries + 1):
+            status = None
+            try:
+                status, existed = await self._request(url, data)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    print(f"⚠️ Bunny: {remote_path}: {str(e)[:80]}")
+            if status == 200 and existed:
+                self.stats['skipped'] += 1
+                return cdn_url(remote_path)
+            if status == 201:
+                self.stats['uploaded'] += 1
+                return cdn_url(remote_path)
+            if status is not None and status not in RETRY_STATUSES:
+                print(f"⚠️ Bunny {status}: {remote_path}")
+                break
+            if attempt < self.retries:
+                # Пауза перед повтором - без семафора: пока ждём, место занимают другие загрузки
+                self.stats['retries'] += 1
+                await asyncio.sleep(_backoff(attempt))
+        self.stats['failed'] += 1
+        return None
+
+    def submit(self, data, ext='jpg', target=None, field='image_url'):
+        """Запустить загрузку в фоне; по готовности ссылка пишется в target[field]"""
+        async def run():
+            url = await self.upload(data, ext)
+            if target is not None and url:
+                target[field] = url
+            return url
+
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def drain(self):
+        """Дождаться всех фоновых загрузок"""
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+def put_file(url, local_path, access_key, retries=BUNNY_UPLOAD_RETRIES, timeout=BUNNY_UPLOAD_TIMEOUT):
+    """Синхронная загрузка файла для Flask: поток с диска, таймауты, повторы с backoff"""
+    headers = {'AccessKey': access_key, 'Content-Type': 'application/octet-stream'}
+    for attempt in range(retries + 1):
+        with open(local_path, 'rb') as f:
+            try:
+                response = http_client.put(url, data=f, headers=headers, timeout=(10, timeout))
+            except requests.RequestException as e:
+                print(f"BunnyCDN Upload Error: {e}")
+                response = None
+        if response is not None:
+            if response.status_code == 201:
+                return True
+            if response.status_code not in RETRY_STATUSES:
+                print(f"BunnyCDN Upload Error: HTTP {response.status_code}")
+                return False
+        if attempt < retries:
+            time.sleep(_backoff(attempt))
+    return False
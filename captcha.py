@@ -0,0 +1,131 @@
+import os
+import hmac
+import mmap
+import time
+import fcntl
+import random
+import hashlib
+import secrets
+
+# Капча без состояния на сервере.
+# Токен: "<expires>.<nonce>.<подпись>", подпись = HMAC-SHA256(секрет, expires.nonce.ответ).
+# Ответа в токене нет; проверка - пересчитать подпись с ответом пользователя и сравнить
+# за постоянное время. Любой воркер проверяет капчу сам, всплеск спама ничего не вытесняет.
+# Повторное использование решённой капчи ловит фильтр Блума по nonce: два поколения
+# по CAPTCHA_TTL в общем mmap-файле (одно пишется, предыдущее только проверяется).
+CAPTCHA_TTL = 600  # сек на заполнение формы
+CAPTCHA_SECRET_FILE = 'captcha_secret.key'
+CAPTCHA_BLOOM_FILE = os.environ.get('CAPTCHA_BLOOM_FILE', 'captcha_bloom.bin')
+BLOOM_BITS = 1 << 20  # 128 КБ на поколение: ~0.01% ложных срабатываний на 20k капч
+BLOOM_HASHES = 4
+
+_GENERATION_SIZE = 8 + BLOOM_BITS // 8
+
+
+def _load_secret():
+    """CAPTCHA_SECRET из окружения; иначе ключ, созданный один раз в файле (общий для воркеров)"""
+    secret = os.environ.get('CAPTCHA_SECRET')
+    if secret:
+        return secret.encode()
+    with open(f"{CAPTCHA_SECRET_FILE}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(CAPTCHA_SECRET_FILE):
+            fd = os.open(CAPTCHA_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+    with open(CAPTCHA_SECRET_FILE, 'r') as f:
+        return f.read().strip().encode()
+
+
+_secret = None
+
+
+def _sign(expires, nonce, answer):
+    global _secret
+    if _secret is None:
+        _secret = _load_secret()
+    message = f"{expires}.{nonce}.{answer}".encode()
+    return hmac.new(_secret, message, hashlib.sha256).hexdigest()[:32]
+
+
+def new_captcha():
+    """(вопрос, токен)"""
+    a = random.randint(1, 10)
+    b = random.randint(1, 10)
+    expires = int(time.time()) + CAPTCHA_TTL
+    nonce = secrets.token_hex(8)
+    return f'{a} + {b} = ?', f"{expires}.{nonce}.{_sign(expires, nonce, a + b)}"
+
+
+class ReplayFilter:
+    def __init__(self, path=CAPTCHA_BLOOM_FILE):
+        self.path = path
+        self.pid = None
+        self.mm = None
+
+    def _map(self):
+        if self.mm is None or self.pid != os.getpid():
+            size = 2 * _GENERATION_SIZE
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            self.pid = os.getpid()
+        return self.mm
+
+    @staticmethod
+    def _bits(nonce):
+        digest = hashlib.blake2b(nonce.encode(), digest_size=4 * BLOOM_HASHES).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'little') % BLOOM_BITS for i in range(BLOOM_HASHES)]
+
+    def _generation(self, mm, generation):
+        """Смещение битов поколения или None, если в слоте другое (старое) поколение"""
+        offset = (generation % 2) * _GENERATION_SIZE
+        if int.from_bytes(mm[offset:offset + 8], 'little') != generation:
+            return None
+        return offset + 8
+
+    def _contains(self, mm, offset, bits):
+        return all(mm[offset + bit // 8] & (1 << (bit % 8)) for bit in bits)
+
+    def check_and_add(self, nonce):
+        """True - nonce новый (и теперь запомнен), False - капчу уже использовали"""
+        mm = self._map()
+        bits = self._bits(nonce)
+        generation = int(time.time() // CAPTCHA_TTL)
+        with open(f"{self.path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for previous in (generation, generation - 1):
+                offset = self._generation(mm, previous)
+                if offset is not None and self._contains(mm, offset, bits):
+                    return False
+            offset = self._generation(mm, generation)
+            if offset is None:
+                # Новое поколение занимает слот позапрошлого
+                start = (generation % 2) * _GENERATION_SIZE
+                mm[start + 8:start + _GENERATION_SIZE] = bytes(_GENERATION_SIZE - 8)
+                mm[start:start + 8] = generation.to_bytes(8, 'little')
+                offset = start + 8
+            for bit in bits:
+                mm[offset + bit // 8] |= 1 << (bit % 8)
+        return True
+
+
+_replay = ReplayFilter()
+
+
+def check_captcha(token, answer):
+    """Верный ответ, токен не истёк и ещё не использовался"""
+    try:
+        expires, nonce, signature = token.split('.')
+        expires = int(expires)
+    except (AttributeError, ValueError):
+        return False
+    if expires < time.time():
+        return False
+    if not hmac.compare_digest(signature, _sign(expires, nonce, str(answer).strip())):
+        return False
+    return _replay.check_and_add(nonce)
@@ -2,38 +2,20 @@ import os
 import json
 import re
 import asyncio
-import requests
-import hashlib
 from datetime import datetime, timedelta
 from telethon import TelegramClient
+from spam_filter import spam_rule
 from telethon.tl.functions.channels import GetFullChannelRequest
+from entity_cache import resolve_entity, invalidate, is_stale_error
+from rate_limiter import get_limiter, run_bounded, TG_CONCURRENCY
+from poll_scheduler import get_scheduler
+from dedup_index import DedupIndex, iter_listings
+from events import publish_listings
+from listings_store import merge_listings, read_listings
 
 API_ID = int(os.environ.get('TELETHON_API_ID', 0))
 API_HASH = os.environ.get('TELETHON_API_HASH', '')
 
-BUNNY_STORAGE_ZONE = os.environ.get('BUNNY_STORAGE_ZONE', '')
-BUNNY_ACCESS_KEY = os.environ.get('BUNNY_ACCESS_KEY', '')
-BUNNY_CDN_URL = os.environ.get('BUNNY_CDN_URL', '')
-
-def upload_to_bunny(file_bytes, filename):
-    if not BUNNY_STORAGE_ZONE or not BUNNY_ACCESS_KEY:
-        return None
-    try:
-        file_hash = hashlib.md5(file_bytes).hexdigest()[:8]
-        ext = filename.split('.')[-1] if '.' in filename else 'jpg'
-        remote_path = f"listings/{file_hash}_{filename}"
-        url = f"https://storage.bunnycdn.com/{BUNNY_STORAGE_ZONE}/{remote_path}"
-        headers = {"AccessKey": BUNNY_ACCESS_KEY, "Content-Type": "application/octet-stream"}
-        response = requests.put(url, headers=headers, data=file_bytes, timeout=30)
-        if response.status_code == 201:
-            cdn_url = f"https://{BUNNY_STORAGE_ZONE}.b-cdn.net/{remote_path}"
-            if BUNNY_CDN_URL and 'b-cdn.net' in BUNNY_CDN_URL:
-                cdn_url = f"{BUNNY_CDN_URL.rstrip('/')}/{remote_path}"
-            return cdn_url
-    except:
-        pass
-    return None
-
 def classify_message(text, channel_category):
     text_lower = text.lower()
     if channel_category and channel_category != 'chat':
@@ -46,40 +28,49 @@ def is_english_only(text):
             return False
     return True
 
+def message_to_listing(msg, channel_username, category):
+    """Сообщение -> объявление (или None, если не прошло фильтры длины, языка и спама)"""
+    if not msg.text or len(msg.text) < 20:
+        return None
+    if is_english_only(msg.text):
+        return None
+    rule = spam_rule(msg.text)
+    if rule:
+        print(f"🚫 Спам [{rule}]: @{channel_username} {msg.id}")
+        return None
+    
+    detected_category = classify_message(msg.text, category)
+    return {
+        'id': f"{channel_username}_{msg.id}",
+        'category': detected_category,
+        'title': msg.text[:100],
+        'description': msg.text,
+        'date': msg.date.isoformat(),
+        'source_channel': f"@{channel_username}",
+        'message_id': msg.id,
+        'image_url': None,
+        'image_hash': None,
+        'has_media': bool(msg.media),
+        'price': None
+    }
+
 async def parse_channel(client, channel_username, category, limit=25):
     """Parse channel - менее агрессивный режим"""
     listings = []
     skipped_english = 0
     try:
-        entity = await client.get_entity(channel_username)
-        messages = await client.get_messages(entity, limit=limit)
+        limiter = get_limiter(client)
+        entity = await limiter.call(resolve_entity, client, channel_username)
+        messages = await get_scheduler().fetch_new(limiter, client, entity, channel_username, limit)
         for msg in messages:
-            if not msg.text or len(msg.text) < 20:
-                continue
-            if is_english_only(msg.text):
+            if msg.text and len(msg.text) >= 20 and is_english_only(msg.text):
                 skipped_english += 1
-                continue
-            
-            if is_spam(msg.text):
-                continue
-            
-            detected_category = classify_message(msg.text, category)
-            item = {
-                'id': f"{channel_username}_{msg.id}",
-                'category': detected_category,
-                'title': msg.text[:100],
-                'description': msg.text,
-                'date': msg.date.isoformat(),
-                'source_channel': f"@{channel_username}",
-                'message_id': msg.id,
-                'image_url': None,
-                'image_hash': None,
-                'has_media': bool(msg.media),
-                'price': None
-            }
-            listings.append(item)
+            item = message_to_listing(msg, channel_username, category)
+            if item:
+                listings.append(item)
     except Exception as e:
-        pass
+        if is_stale_error(e):
+            invalidate(client, channel_username)
     return listings
 
 async def parse_vietnam():
@@ -115,48 +106,64 @@ async def parse_vietnam():
     except:
         pass
     
+    dedup = DedupIndex.from_data(existing_data)
+    
     channels_to_parse = []
     for cat_key, channel_list in channels_config.get('channels', {}).items():
         for channel in channel_list:
             channels_to_parse.append((channel, cat_key))
     
     print(f"📋 Найдено {len(channels_to_parse)} каналов")
-    print(f"⏱️  Режим: АГРЕССИВНЫЙ (1.5 сек между каналами)")
+    
+    # Опрашиваем только каналы, которым подошла очередь по расписанию активности
+    scheduler = get_scheduler()
+    due_channels = set(scheduler.due([c for c, _ in channels_to_parse]))
+    channels_to_parse = [(c, cat) for c, cat in channels_to_parse if c in due_channels]
+    print(f"⏰ К опросу по расписанию: {len(channels_to_parse)}")
+    print(f"⏱️  Режим: адаптивный лимитер, до {TG_CONCURRENCY} каналов параллельно")
     print(f"📦 Существующих объявлений: {len(existing_ids)}")
     
-    new_count = 0
+    new_items = []
+    duplicates = []
     total_parsed = 0
     
-    for i, (channel, category) in enumerate(channels_to_parse):
-        try:
-            listings = await parse_channel(client, channel, category, limit=50)
-            total_parsed += len(listings)
-            
-            # Добавить только новые
-            for item in listings:
-                if item['id'] not in existing_ids:
-                    cat = item['category']
-                    if cat not in existing_data:
-                        existing_data[cat] = []
-                    existing_data[cat].insert(0, item)
-                    existing_ids.add(item['id'])
-                    new_count += 1
-            
-            if listings:
-                print(f"  [{i+1}/{len(channels_to_parse)}] @{channel}: {len(listings)} шт")
-        except:
-            pass
+    async def fetch(job):
+        channel, category = job
+        return await parse_channel(client, channel, category, limit=50)
+    
+    results = await run_bounded(channels_to_parse, fetch)
+    
+    for i, ((channel, category), listings) in enumerate(zip(channels_to_parse, results)):
+        if isinstance(listings, Exception):
+            continue
+        total_parsed += len(listings)
+        
+        # Добавить только новые
+        for item in listings:
+            if item['id'] not in existing_ids and not dedup.known(item['id']):
+                # Репост из другого канала - в sources существующего объявления
+                if dedup.merge(item):
+                    duplicates.append(item)
+                    continue
+                existing_ids.add(item['id'])
+                new_items.append(item)
         
-        await asyncio.sleep(1.5)
+        if listings:
+            print(f"  [{i+1}/{len(channels_to_parse)}] @{channel}: {len(listings)} шт")
+    
+    scheduler.save()
     
-    with open('listings_vietnam.json', 'w', encoding='utf-8') as f:
-        json.dump(existing_data, f, ensure_ascii=False, indent=2)
+    # existing_data - снимок на момент старта: пока шёл парсинг, файл могли дописать
+    # realtime_ingest и админка, поэтому новое сливается с актуальным файлом под блокировкой
+    added, merged = merge_listings('vietnam', new_items + duplicates)
+    publish_listings('vietnam', added)
     
-    total_now = sum(len(v) for v in existing_data.values() if isinstance(v, list))
+    total_now = sum(1 for _ in iter_listings(read_listings('vietnam')))
     print(f"")
     print(f"📊 ИТОГО:")
     print(f"   Пропарсено: {total_parsed}")
-    print(f"   ✨ НОВЫХ: {new_count}")
+    print(f"   ✨ НОВЫХ: {len(added)}")
+    print(f"   🔗 Дубликатов слито: {merged}")
     print(f"   📦 Всего в базе: {total_now}")
     
     try:
@@ -166,37 +173,6 @@ async def parse_vietnam():
 
 if __name__ == '__main__':
     print(f"🔄 Auto Parser: {datetime.now().strftime('%H:%M:%S')}")
-    print("🔥 РЕЖИМ: Агрессивный (50 сообщений, 1.5 сек)")
+    print("🔥 РЕЖИМ: 50 сообщений, адаптивный лимитер")
     asyncio.run(parse_vietnam())
     print("✅ Завершено!\n")
-
-
-def is_spam(text):
-    """Проверяет, не является ли объявление спамом/промо"""
-    if not text:
-        return False
-    
-    spam_keywords = [
-        'deriv.com', 'synthetic indices', 'trading account',
-        'round-the-clock trading', 'forex', 'crypto trading',
-        'click here', 'open account', 'sign up', 'register now',
-        'жми сюда', 'заработок', 'быстрый доход', 'гарантированный',
-        'скам', 'опасно',
-        'kumpulan video viral', 'full video', 'join grup', 'klik link',
-        'video-info-viral', 'join sekarang',
-        'rent account', 'rent linkedin', 'rent facebook', 'make money',
-        'passive income', 'rent out', 'advertising account', 'payment proof',
-        'binance usdt', 'grow your business', 'promote message', 'promotion packages',
-        'reach more customers', 'boost visibility', 'active groups', 'drive engagement',
-        'anda ingin sukses', 'ubah cara berfikir', 'positive thinking', 'pilihan itu selalu ada',
-        'salam sukses', 'mulai sebelum orang',
-        'notif sms', 'hak cipta hack', 'bootloader', 'fingerprint', 'manufacturer',
-        'chat id of this chat'
-    ]
-    
-    text_lower = text.lower()
-    for keyword in spam_keywords:
-        if keyword in text_lower:
-            return True
-    return False
-
@@ -2,17 +2,25 @@ import os
 import json
 import asyncio
 import hashlib
-import requests
 from datetime import datetime
 from telethon import TelegramClient
+from spam_filter import spam_rule
+from entity_cache import resolve_entity, invalidate, is_stale_error
+from rate_limiter import get_limiter, run_bounded
+from albums import group_albums, album_photos, ALBUM_CONCURRENCY
+from poll_scheduler import get_scheduler
+from dedup_index import DedupIndex
+from image_hash import ImageIndex, dhash
+from seen_photos import SeenPhotos, photo_key
+from bunny_upload import BunnyUploader
+from thumbnails import render_thumbnails_async
+from media_fetch import fetch_photo
+from events import publish_listings
+from listings_store import merge_listings
 
 API_ID = int(os.environ.get('TELETHON_API_ID', 0))
 API_HASH = os.environ.get('TELETHON_API_HASH', '')
 
-BUNNY_STORAGE_ZONE = os.environ.get('BUNNY_STORAGE_ZONE', '')
-BUNNY_ACCESS_KEY = os.environ.get('BUNNY_ACCESS_KEY', '')
-BUNNY_CDN_URL = os.environ.get('BUNNY_CDN_URL', '')
-
 CHAT_CHANNELS = [
     "phuket_ru", "Pkhuket_Chatx", "vmestenaphukete", "phuket_chat1",
     "bangkok_chat_znakomstva", "phangan_chat", "samui_chat", "chiangmai_chat",
@@ -28,44 +36,6 @@ def is_english_only(text):
             return False
     return True
 
-def is_spam(text):
-    """Проверяет, не является ли объявление спамом/промо"""
-    if not text:
-        return False
-    spam_keywords = [
-        'deriv.com', 'synthetic indices', 'trading account',
-        'round-the-clock trading', 'forex', 'crypto trading',
-        'kumpulan video viral', 'full video', 'join grup', 'klik link',
-        'video-info-viral', 'join sekarang',
-        'rent account', 'rent linkedin', 'rent facebook', 'make money',
-        'passive income', 'rent out', 'advertising account',
-        'grow your business', 'promote message', 'promotion packages',
-        'reach more customers', 'boost visibility', 'drive engagement',
-        'anda ingin sukses', 'ubah cara berfikir', 'positive thinking',
-        'salam sukses', 'mulai sebelum orang',
-        'notif sms', 'hak cipta hack', 'bootloader', 'fingerprint'
-    ]
-    text_lower = text.lower()
-    return any(keyword in text_lower for keyword in spam_keywords)
-
-def upload_to_bunny(file_bytes, filename):
-    if not BUNNY_STORAGE_ZONE or not BUNNY_ACCESS_KEY:
-        return None
-    try:
-        file_hash = hashlib.md5(file_bytes).hexdigest()[:8]
-        remote_path = f"listings/{file_hash}_{filename}"
-        url = f"https://storage.bunnycdn.com/{BUNNY_STORAGE_ZONE}/{remote_path}"
-        headers = {"AccessKey": BUNNY_ACCESS_KEY, "Content-Type": "application/octet-stream"}
-        response = requests.put(url, headers=headers, data=file_bytes, timeout=30)
-        if response.status_code == 201:
-            cdn_url = f"https://{BUNNY_STORAGE_ZONE}.b-cdn.net/{remote_path}"
-            if BUNNY_CDN_URL and 'b-cdn.net' in BUNNY_CDN_URL:
-                cdn_url = f"{BUNNY_CDN_URL.rstrip('/')}/{remote_path}"
-            return cdn_url
-    except:
-        pass
-    return None
-
 async def connect_with_retry(max_retries=3):
     """Подключение с retry логикой (для обхода database is locked)"""
     for attempt in range(max_retries):
@@ -95,20 +65,31 @@ async def parse_chats():
             existing = json.load(f)
     
     existing_ids = {item['id'] for item in existing}
-    existing_texts = {item.get('description', '')[:150] for item in existing}
+    # Почти-дубликаты (тот же текст с другим эмодзи/форматом телефона) ищем по SimHash
+    dedup = DedupIndex.from_data(existing)
     existing_hashes = {item.get('image_hash') for item in existing if item.get('image_hash')}
-    existing_image_urls = {item.get('image_url') for item in existing if item.get('image_url')}
+    # md5 не ловит пережатые/уменьшенные репосты - дополнительно сравниваем перцептивный хеш
+    image_index = ImageIndex(existing)
+    seen_photos = SeenPhotos()
+    skipped_photos = 0
     
     new_items = []
     
     total_skipped = 0
-    for channel in CHAT_CHANNELS:
+    duplicates = []
+    limiter = get_limiter(client)
+    
+    async def parse_chat(channel):
+        nonlocal total_skipped, skipped_photos
+        channel_count = 0
         try:
-            entity = await client.get_entity(channel)
+            entity = await limiter.call(resolve_entity, client, channel)
             # Берем последние 5 сообщений для более частых обновлений (1 в минуту)
-            messages = await client.get_messages(entity, limit=5)
+            # и дочитываем назад, если с прошлого опроса их больше (poll_scheduler)
+            messages = await scheduler.fetch_new(limiter, client, entity, channel, 5)
             
-            for msg in messages:
+            # Альбом (общий grouped_id) - одно объявление со всеми фото
+            for msg, album in group_albums(messages):
                 if not msg.text or len(msg.text) < 20:
                     continue
                 
@@ -116,34 +97,14 @@ async def parse_chats():
                     total_skipped += 1
                     continue
                 
-                if is_spam(msg.text):
+                rule = spam_rule(msg.text)
+                if rule:
+                    print(f"🚫 Спам [{rule}]: @{channel} {msg.id}")
                     continue
                 
                 item_id = f"{channel}_{msg.id}"
-                if item_id in existing_ids:
+                if item_id in existing_ids or dedup.known(item_id):
                     continue
-                if msg.text[:150] in existing_texts:
-                    continue
-                
-                image_url = None
-                image_hash = None
-                if msg.media and hasattr(msg.media, 'photo'):
-                    try:
-                        photo_bytes = await client.download_media(msg.media, bytes)
-                        if photo_bytes:
-                            image_hash = hashlib.md5(photo_bytes).hexdigest()
-                            # Пропустить если фото по хешу уже есть
-                            if image_hash in existing_hashes:
-                                continue
-                            filename = f"{channel}_{msg.id}.jpg"
-                            image_url = upload_to_bunny(photo_bytes, filename)
-                            # Пропустить если URL фото уже в системе
-                            if image_url and image_url in existing_image_urls:
-                                continue
-                            if image_url:
-                                print(f"   📷 {filename}")
-                    except:
-                        pass
                 
                 item = {
                     'id': item_id,
@@ -153,34 +114,119 @@ async def parse_chats():
                     'date': msg.date.isoformat(),
                     'source_channel': f"@{channel}",
                     'message_id': msg.id,
-                    'image_url': image_url,
-                    'image_hash': image_hash,
+                    'image_url': None,
+                    'image_hash': None,
                     'has_media': bool(msg.media),
                     'price': None
                 }
+                # Индексируем сразу, до скачивания фото - параллельные каналы не добавят тот же текст дважды.
+                # Дубликат сливается в существующее объявление (sources), фото для него не качаем
+                if dedup.merge(item):
+                    duplicates.append(item)
+                    continue
+                existing_ids.add(item_id)
+                
+                photos = album_photos(album)
+                if photos:
+                    # Это фото уже скачивалось (репост/пересылка) - не тратим трафик на повторное скачивание
+                    if photo_key(photos[0].photo) in seen_photos:
+                        skipped_photos += 1
+                        dedup.discard(item)
+                        continue
+                    try:
+                        # Все фото альбома качаются параллельно, а не по одному.
+                        # По умолчанию - превью Telegram, оригинал докачается при первом детальном просмотре
+                        downloaded = await run_bounded(
+                            photos, lambda m: fetch_photo(client, limiter, m), ALBUM_CONCURRENCY)
+                        album_bytes = []
+                        photo_ids = []
+                        preview_only = False
+                        for m, result in zip(photos, downloaded):
+                            if isinstance(result, tuple) and result[0]:
+                                data, full = result
+                                seen_photos.add(photo_key(m.photo), item_id)
+                                album_bytes.append(data)
+                                photo_ids.append(m.id)
+                                preview_only = preview_only or not full
+                        if preview_only:
+                            # По этим сообщениям backfill_worker потом скачает оригиналы
+                            item['preview_only'] = True
+                            item['photo_message_ids'] = photo_ids
+                        photo_bytes = album_bytes[0] if album_bytes else None
+                        if photo_bytes:
+                            image_hash = hashlib.md5(photo_bytes).hexdigest()
+                            image_phash = dhash(photo_bytes)
+                            # Пропустить если фото уже есть (точная копия или визуально то же фото)
+                            if image_hash in existing_hashes or image_index.find(image_phash):
+                                dedup.discard(item)
+                                continue
+                            existing_hashes.add(image_hash)
+                            image_index.add(image_phash, item_id)
+                            item['image_hash'] = image_hash
+                            if image_phash is not None:
+                                item['image_phash'] = format(image_phash, '016x')
+                            # Загрузка в фоне: image_url заполнится к сохранению, канал тем временем читается дальше
+                            uploader.submit(photo_bytes, 'jpg', target=item)
+                            # WebP 160/480/1080 для карточек и мобильных - в пуле потоков, не блокируя парсинг
+                            try:
+                                item['thumbnails'] = {}
+                                for size, webp, width, height in await render_thumbnails_async(photo_bytes):
+                                    variant = {'width': width, 'height': height}
+                                    item['thumbnails'][str(size)] = variant
+                                    uploader.submit(webp, 'webp', target=variant, field='url')
+                            except Exception as e:
+                                print(f"   ⚠️ thumbnails: {str(e)[:60]}")
+                            if len(album_bytes) > 1:
+                                item['all_images'] = [None] * len(album_bytes)
+                                for i, data in enumerate(album_bytes):
+                                    uploader.submit(data, 'jpg', target=item['all_images'], field=i)
+                    except:
+                        pass
+                
                 new_items.append(item)
+                channel_count += 1
             
-            channel_count = len([i for i in new_items if i['source_channel'] == f'@{channel}'])
             if channel_count > 0:
                 print(f"✓ @{channel}: +{channel_count}")
         except Exception as e:
+            if is_stale_error(e):
+                invalidate(client, channel)
             error_msg = str(e)[:50]
             if 'database is locked' not in error_msg:
                 print(f"⚠️ @{channel}: {error_msg}")
-        
-        await asyncio.sleep(120)  # 2 минуты задержка между каналами (менее агрессивно)
     
-    if new_items:
-        all_items = existing + new_items
-        with open(listings_file, 'w', encoding='utf-8') as f:
-            json.dump(all_items, f, ensure_ascii=False, indent=2)
-        print(f"💬 Добавлено {len(new_items)} новых сообщений")
+    # Вместо фиксированных 2 минут между каналами - адаптивный лимитер и несколько каналов параллельно.
+    # Тихие чаты опрашиваются реже активных (poll_scheduler)
+    scheduler = get_scheduler()
+    async with BunnyUploader() as uploader:
+        await run_bounded(scheduler.due(CHAT_CHANNELS), parse_chat)
+    scheduler.save()
+    # Фото альбома, которые не удалось залить, в all_images не оставляем
+    for item in new_items:
+        if item.get('all_images'):
+            item['all_images'] = [url for url in item['all_images'] if url] or None
+    if uploader.stats['uploaded'] or uploader.stats['skipped'] or uploader.stats['failed']:
+        print(f"📷 Фото: загружено {uploader.stats['uploaded']}, уже были {uploader.stats['skipped']}, ошибок {uploader.stats['failed']}")
+    
+    if new_items or duplicates:
+        # existing - снимок на момент старта; новое сливается с актуальным файлом под блокировкой,
+        # чтобы не затереть то, что за это время записали realtime_ingest и админка
+        added, merged = merge_listings('thailand', new_items + duplicates, at_start=False)
+        publish_listings('thailand', added)
+        print(f"💬 Добавлено {len(added)} новых сообщений")
+        if merged > 0:
+            print(f"🔗 Слито дубликатов с другими каналами: {merged}")
         if total_skipped > 0:
             print(f"🚫 Отклонено англоязычных: {total_skipped}")
     else:
         print("💬 Новых сообщений нет")
         if total_skipped > 0:
             print(f"🚫 (найдено {total_skipped} англ., но они отклонены)")
+    # Фото помечаем известными только после записи объявлений: если запись упала,
+    # следующий запуск скачает их снова, а не пропустит навсегда
+    seen_photos.save()
+    if skipped_photos > 0:
+        print(f"🖼️ Пропущено уже известных фото без скачивания: {skipped_photos}")
     
     try:
         await client.disconnect()
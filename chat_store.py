@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import fcntl
+import threading
+from collections import deque
+from datetime import datetime
+
+# Сообщения внутреннего чата.
+# Раньше каждый опрос (раз в 5 сек с каждой открытой вкладки) читал internal_chat_*.json,
+# разбирал дату каждого сообщения для окна в 3 дня и возвращал до 500 сообщений, а каждая
+# отправка переписывала файл целиком. Теперь:
+#   - на диске журнал internal_chat_*.jsonl: отправка дописывает одну строку под flock;
+#   - у сообщения возрастающий номер (id), общий для всех воркеров;
+#   - в памяти процесса - кольцевой буфер последних CHAT_RING_SIZE сообщений за CHAT_WINDOW;
+#     чужие записи подхватываются дочитыванием хвоста журнала (один stat на опрос);
+#   - /api/chat/messages?since=<id> возвращает только новое - обычно пустой список.
+# Строки журнала: сообщение {"id", "username", "message", "timestamp"},
+# удаление {"seq", "deleted": id} и заголовок {"last_seq"} после сжатия журнала.
+CHAT_RING_SIZE = int(os.environ.get('CHAT_RING_SIZE', 500))
+CHAT_WINDOW = 3 * 24 * 3600
+CHAT_COMPACT_LINES = 5000  # строк в журнале, после которых он переписывается только с живыми сообщениями
+DELETED_KEEP = 500  # сколько последних удалений помнить для клиентов с since
+
+
+def _epoch(timestamp):
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+
+class ChatLog:
+    def __init__(self, log_file, legacy_file=None):
+        self.log_file = log_file
+        self.lock_file = f"{log_file}.lock"
+        self.legacy_file = legacy_file
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.ring = deque()  # (epoch, сообщение), по возрастанию id
+        self.deleted = deque()  # (seq, id удалённого)
+        self.last_seq = 0
+        # Всё с номером <= base_seq из памяти уже вытеснено: клиенту с since < base_seq - полный список
+        self.base_seq = 0
+        self.offset = 0
+        self.inode = None
+        self.lines = 0
+
+    # --- журнал ---
+
+    def _apply(self, record):
+        self.lines += 1
+        if 'deleted' in record:
+            seq = record['seq']
+            self.ring = deque(item for item in self.ring if item[1]['id'] != record['deleted'])
+            self.deleted.append((seq, record['deleted']))
+            if len(self.deleted) > DELETED_KEEP:
+                self.base_seq = max(self.base_seq, self.deleted.popleft()[0])
+        elif 'message' in record:
+            seq = record['id']
+            self.ring.append((_epoch(record.get('timestamp')), record))
+            if len(self.ring) > CHAT_RING_SIZE:
+                self.base_seq = max(self.base_seq, self.ring.popleft()[1]['id'])
+        else:
+            seq = record.get('last_seq', 0)
+            self.base_seq = max(self.base_seq, seq)
+        self.last_seq = max(self.last_seq, seq)
+
+    def _sync(self):
+        """Дочитать журнал с места, где остановились; если его переписали - перечитать целиком"""
+        try:
+            stat = os.stat(self.log_file)
+        except OSError:
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self._reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return
+        with open(self.log_file, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read(stat.st_size - self.offset)
+        # Строка, которую другой процесс ещё дописывает, будет прочитана в следующий раз
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            if line.strip():
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    continue
+        self.offset += end
+
+    def _trim(self):
+        cutoff = time.time() - CHAT_WINDOW
+        while self.ring and self.ring[0][0] < cutoff:
+            self.base_seq = max(self.base_seq, self.ring.popleft()[1]['id'])
+
+    def _write(self, record):
+        """Дописать запись; вызывать под flock после _sync"""
+        with open(self.log_file, 'ab') as f:
+            f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    def _locked(self, action):
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._sync()
+            result = action()
+            self._sync()
+            if self.lines > CHAT_COMPACT_LINES:
+                self._compact()
+            return result
+
+    def _compact(self):
+        """Переписать журнал: заголовок с last_seq и живые сообщения (под flock)"""
+        self._trim()
+        tmp_path = f"{self.log_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'last_seq': self.last_seq}).encode('utf-8') + b'\n')
+            for _, message in self.ring:
+                f.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+        os.replace(tmp_path, self.log_file)
+        self._reset()
+        self._sync()
+
+    def _import_legacy(self):
+        """Первый запуск: сообщения из internal_chat_*.json -> журнал с номерами по порядку"""
+        if self.inode is not None or not self.legacy_file or os.path.exists(self.log_file) \
+                or not os.path.exists(self.legacy_file):
+            return
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.log_file):
+                return
+            try:
+                with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                    messages = json.load(f).get('messages', [])
+            except (OSError, ValueError):
+                messages = []
+            cutoff = time.time() - CHAT_WINDOW
+            messages = [m for m in messages if _epoch(m.get('timestamp')) > cutoff][-CHAT_RING_SIZE:]
+            tmp_path = f"{self.log_file}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                for seq, m in enumerate(messages, 1):
+                    record = {'id': seq, 'username': m.get('username'), 'message': m.get('message'),
+                              'timestamp': m.get('timestamp')}
+                    f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+            os.replace(tmp_path, self.log_file)
+            print(f"💬 Чат: {len(messages)} сообщений перенесено из {self.legacy_file} в {self.log_file}")
+
+    # --- API ---
+
+    def append(self, username, message):
+        """Новое сообщение с очередным номером; вернуть его"""
+        with self.lock:
+            self._import_legacy()
+            def action():
+                record = {'id': self.last_seq + 1, 'username': username, 'message': message,
+                          'timestamp': datetime.now().isoformat()}
+                self._write(record)
+                return record
+            return self._locked(action)
+
+    def delete(self, msg_id):
+        """Удалить сообщение по номеру; False, если такого нет"""
+        with self.lock:
+            self._import_legacy()
+            def action():
+                if not any(item[1]['id'] == msg_id for item in self.ring):
+                    return False
+                self._write({'seq': self.last_seq + 1, 'deleted': msg_id})
+                return True
+            return self._locked(action)
+
+    def since(self, since=0):
+        """{messages, deleted, last_id, reset}: новое после since. reset=True - клиент должен
+        заменить свой список целиком (первый запрос или пропущено больше, чем хранится в памяти)"""
+        with self.lock:
+            self._import_legacy()
+            self._sync()
+            self._trim()
+            reset = since <= 0 or since < self.base_seq or since > self.last_seq
+            if reset:
+                messages = [m for _, m in self.ring]
+                deleted = []
+            else:
+                messages = []
+                for _, m in reversed(self.ring):
+                    if m['id'] <= since:
+                        break
+                    messages.append(m)
+                messages.reverse()
+                deleted = [msg_id for seq, msg_id in self.deleted if seq > since]
+            return {'messages': messages, 'deleted': deleted, 'last_id': self.last_seq, 'reset': reset}
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def get_chat(legacy_file):
+    """Журнал чата страны по имени старого файла (internal_chat_*.json -> internal_chat_*.jsonl)"""
+    log = _logs.get(legacy_file)
+    if log is None:
+        with _logs_lock:
+            log = _logs.get(legacy_file)
+            if log is None:
+                log = ChatLog(f"{os.path.splitext(legacy_file)[0]}.jsonl", legacy_file)
+                _logs[legacy_file] = log
+    return log
@@ -0,0 +1,162 @@
+import os
+import re
+import hashlib
+
+# Поиск почти-дубликатов объявлений по SimHash.
+# Одна и та же квартира, перепощенная в пять каналов с другим эмодзи или форматом телефона,
+# даёт 64-битные отпечатки, отличающиеся на несколько бит. Отпечаток режется на DEDUP_BANDS полос:
+# если расстояние Хэмминга <= DEDUP_MAX_DISTANCE < DEDUP_BANDS, хотя бы одна полоса совпадает точно,
+# поэтому поиск - это несколько обращений к словарю, а не перебор всей базы.
+DEDUP_MAX_DISTANCE = int(os.environ.get('DEDUP_MAX_DISTANCE', 3))
+DEDUP_BANDS = 4
+DEDUP_MIN_TOKENS = 5  # короткие тексты ("пишите в лс") слишком похожи друг на друга
+
+_BAND_BITS = 64 // DEDUP_BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+_DIGIT_GAPS_RE = re.compile(r'(?<=\d)[\s\-.()]+(?=\d)')
+_LONG_NUMBER_RE = re.compile(r'\d{9,}')
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def normalize_text(text):
+    """Нижний регистр, без эмодзи и пунктуации; телефоны в любом формате -> последние 9 цифр"""
+    text = _DIGIT_GAPS_RE.sub('', text.lower())
+    text = _LONG_NUMBER_RE.sub(lambda m: m.group(0)[-9:], text)
+    return _TOKEN_RE.findall(text)
+
+
+def simhash(text):
+    """64-битный SimHash по словам и парам слов; None для слишком коротких текстов"""
+    tokens = normalize_text(text or '')
+    if len(tokens) < DEDUP_MIN_TOKENS:
+        return None
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    bits = [format(int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), 'big'), '064b')
+            for f in features]
+    half = len(bits) / 2
+    # Столбцы строк битов: в каждой позиции побеждает большинство
+    result = 0
+    for column in zip(*bits):
+        result = (result << 1) | (column.count('1') > half)
+    return result
+
+
+def iter_listings(data):
+    """Объявления из listings_*.json в любом из двух форматов: {категория: [...]} или список"""
+    groups = data.values() if isinstance(data, dict) else [data]
+    for items in groups:
+        if isinstance(items, list):
+            for item in items:
+                if isinstance(item, dict):
+                    yield item
+
+
+class DedupIndex:
+    """Индекс объявлений одной страны. Отпечаток хранится в самом объявлении (text_simhash),
+    поэтому при загрузке пересчитываются только объявления, у которых его ещё нет."""
+
+    def __init__(self, items=()):
+        self.bands = [{} for _ in range(DEDUP_BANDS)]
+        self.items = {}       # id -> объявление
+        self.hashes = {}      # id -> отпечаток
+        self.source_ids = {}  # id дубликата -> id объявления, в которое он слит
+        for item in items:
+            self.add(item)
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(iter_listings(data))
+
+    def fingerprint(self, item):
+        value = item.get('text_simhash')
+        if value:
+            return int(value, 16)
+        value = simhash(item.get('description'))
+        if value is not None:
+            item['text_simhash'] = format(value, '016x')
+        return value
+
+    def known(self, item_id):
+        return item_id in self.items or item_id in self.source_ids
+
+    def add(self, item):
+        item_id = item.get('id')
+        if not item_id:
+            return
+        self.items[item_id] = item
+        for source in item.get('sources', []):
+            self.source_ids[source['id']] = item_id
+        value = self.fingerprint(item)
+        if value is None:
+            return
+        self.hashes[item_id] = value
+        for band, key in zip(self.bands, self._band_keys(value)):
+            band.setdefault(key, []).append(item_id)
+
+    def discard(self, item):
+        item_id = item.get('id')
+        value = self.hashes.pop(item_id, None)
+        self.items.pop(item_id, None)
+        if value is None:
+            return
+        for band, key in zip(self.bands, self._band_keys(value)):
+            ids = band.get(key, [])
+            if item_id in ids:
+                ids.remove(item_id)
+
+    def find(self, text):
+        """Ближайшее объявление-дубликат для текста или None"""
+        value = simhash(text)
+        if value is None:
+            return None
+        return self._find_hash(value)
+
+    def merge(self, item):
+        """Если item - дубликат существующего объявления, дописать его в sources и вернуть
+        существующее; иначе проиндексировать item как новое и вернуть None"""
+        if item.get('id') in self.source_ids:
+            return self.items.get(self.source_ids[item['id']])
+        value = self.fingerprint(item)
+        existing = self._find_hash(value) if value is not None else None
+        if existing is None or existing.get('id') == item.get('id'):
+            self.add(item)
+            return None
+        add_source(existing, item)
+        self.source_ids[item['id']] = existing['id']
+        return existing
+
+    def _find_hash(self, value):
+        best, best_distance = None, DEDUP_MAX_DISTANCE + 1
+        seen = set()
+        for band, key in zip(self.bands, self._band_keys(value)):
+            for item_id in band.get(key, ()):
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+                distance = bin(self.hashes[item_id] ^ value).count('1')
+                if distance < best_distance:
+                    best, best_distance = item_id, distance
+        return self.items.get(best) if best else None
+
+    @staticmethod
+    def _band_keys(value):
+        return [(value >> (i * _BAND_BITS)) & _BAND_MASK for i in range(DEDUP_BANDS)]
+
+
+def _source_of(item):
+    return {
+        'id': item.get('id'),
+        'source_channel': item.get('source_channel'),
+        'message_id': item.get('message_id'),
+        'date': item.get('date')
+    }
+
+
+def add_source(existing, duplicate):
+    """Записать дубликат как ещё один источник объявления (первым идёт само объявление)"""
+    sources = existing.setdefault('sources', [_source_of(existing)])
+    if all(s.get('id') != duplicate.get('id') for s in sources):
+        sources.append(_source_of(duplicate))
+        # Для фото берём первое попавшееся, если у оригинала его не было
+        if not existing.get('image_url') and duplicate.get('image_url'):
+            existing['image_url'] = duplicate['image_url']
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+from telethon import types, utils
+from telethon.errors import UsernameNotOccupiedError, UsernameInvalidError, ChannelPrivateError
+
+# Постоянный кеш username -> (peer id, access_hash), общий для всех парсеров и manual_parse.
+# ResolveUsername - один из самых жёстко лимитируемых методов Telegram (бан на ~21 час),
+# поэтому username резолвим только при первом обращении, после ошибки или по истечении TTL.
+ENTITY_CACHE_FILE = 'entity_cache.json'
+ENTITY_CACHE_TTL = int(os.environ.get('ENTITY_CACHE_TTL', 7 * 24 * 3600))
+
+# Ошибки, после которых запись считается устаревшей
+STALE_ERRORS = (UsernameNotOccupiedError, UsernameInvalidError, ChannelPrivateError)
+
+_cache = None
+_cache_mtime = 0
+
+
+def account_key(client):
+    """access_hash привязан к аккаунту, поэтому кеш разделён по файлу сессии"""
+    filename = getattr(client.session, 'filename', None) or 'default'
+    return os.path.splitext(os.path.basename(str(filename)))[0]
+
+
+def _normalize(username):
+    return str(username).strip().replace('@', '').lower()
+
+
+def _load():
+    global _cache, _cache_mtime
+    try:
+        mtime = os.path.getmtime(ENTITY_CACHE_FILE)
+    except OSError:
+        mtime = 0
+    if _cache is None or mtime != _cache_mtime:
+        _cache = {}
+        if mtime:
+            try:
+                with open(ENTITY_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    _cache = json.load(f)
+            except Exception:
+                _cache = {}
+        _cache_mtime = mtime
+    return _cache
+
+
+def _save(account, username, record):
+    """Перечитываем файл перед записью - кеш пишут несколько процессов"""
+    global _cache_mtime
+    _cache_mtime = 0
+    data = _load()
+    bucket = data.setdefault(account, {})
+    if record is None:
+        bucket.pop(username, None)
+    else:
+        bucket[username] = record
+    tmp_file = f"{ENTITY_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, ENTITY_CACHE_FILE)
+        _cache_mtime = os.path.getmtime(ENTITY_CACHE_FILE)
+    except Exception as e:
+        print(f"⚠️ entity cache: {str(e)[:80]}")
+
+
+def _to_input_peer(record):
+    if record['type'] == 'channel':
+        return types.InputPeerChannel(record['id'], record['access_hash'])
+    if record['type'] == 'user':
+        return types.InputPeerUser(record['id'], record['access_hash'])
+    return types.InputPeerChat(record['id'])
+
+
+def _to_record(entity):
+    peer = utils.get_input_peer(entity)
+    if isinstance(peer, types.InputPeerChannel):
+        return {'type': 'channel', 'id': peer.channel_id, 'access_hash': peer.access_hash, 'resolved_at': time.time()}
+    if isinstance(peer, types.InputPeerUser):
+        return {'type': 'user', 'id': peer.user_id, 'access_hash': peer.access_hash, 'resolved_at': time.time()}
+    if isinstance(peer, types.InputPeerChat):
+        return {'type': 'chat', 'id': peer.chat_id, 'access_hash': 0, 'resolved_at': time.time()}
+    return None
+
+
+def get_cached_peer(client, username):
+    """Вернуть InputPeer из кеша или None, если записи нет или истёк TTL"""
+    record = _load().get(account_key(client), {}).get(_normalize(username))
+    if not record:
+        return None
+    if time.time() - record.get('resolved_at', 0) > ENTITY_CACHE_TTL:
+        return None
+    return _to_input_peer(record)
+
+
+def remember(client, username, entity):
+    record = _to_record(entity)
+    if record:
+        _save(account_key(client), _normalize(username), record)
+
+
+def invalidate(client, username):
+    """Сбросить запись (канал переименован, стал приватным и т.п.)"""
+    _save(account_key(client), _normalize(username), None)
+
+
+def is_stale_error(error):
+    return isinstance(error, STALE_ERRORS)
+
+
+async def resolve_entity(client, username):
+    """Асинхронный резолв: кеш -> client.get_entity только при промахе"""
+    peer = get_cached_peer(client, username)
+    if peer is not None:
+        return peer
+    try:
+        entity = await client.get_entity(_normalize(username))
+    except STALE_ERRORS:
+        invalidate(client, username)
+        raise
+    remember(client, username, entity)
+    return entity
+
+
+def resolve_entity_sync(client, username):
+    """То же для telethon.sync клиента (manual_parse)"""
+    peer = get_cached_peer(client, username)
+    if peer is not None:
+        return peer
+    try:
+        entity = client.get_entity(_normalize(username))
+    except STALE_ERRORS:
+        invalidate(client, username)
+        raise
+    remember(client, username, entity)
+    return entity
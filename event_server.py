@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import asyncio
+import resource
+from collections import deque
+from aiohttp import web
+from events import bus_address
+
+# Процесс SSE-потока: GET /api/stream?country=<страна>
+# Опрос дашборда (чат каждые 5 сек, статистика каждые 5 сек) стоит запрос на каждую открытую
+# вкладку, даже когда ничего не меняется. Здесь каждая вкладка держит одно соединение,
+# а события приходят по UDP от любых процессов (events.publish) и раздаются подписчикам страны.
+# Простаивающий подписчик - корутина, ждущая свою очередь: тысячи соединений почти не тратят CPU.
+#   python event_server.py   (EVENT_SERVER_PORT, по умолчанию 5001)
+# Снаружи /api/stream проксируется сюда (nginx: proxy_buffering off), либо задаётся
+# EVENT_STREAM_URL - тогда /api/stream во Flask перенаправляет на этот адрес.
+# Нагрузочная проверка: python stream_loadgen.py --clients 5000
+EVENT_SERVER_PORT = int(os.environ.get('EVENT_SERVER_PORT', 5001))
+EVENT_ALLOW_ORIGIN = os.environ.get('EVENT_ALLOW_ORIGIN', '*')
+COUNTRIES = ('vietnam', 'thailand', 'india', 'indonesia')
+HEARTBEAT_INTERVAL = 25  # сек; комментарий-пинг не даёт прокси закрыть молчащее соединение
+SUBSCRIBER_QUEUE = 256  # событий в очереди медленного клиента, дальше он отключается
+HISTORY_SIZE = 500  # последних событий для переподключения с Last-Event-ID
+RETRY_MS = 5000
+
+PING = object()
+CLOSE = object()
+
+
+class Hub:
+    def __init__(self):
+        self.subscribers = {country: set() for country in COUNTRIES}
+        self.history = deque(maxlen=HISTORY_SIZE)  # (id, страна, кадр)
+        # Номера событий начинаются с времени запуска (мс): Last-Event-ID из прошлого запуска
+        # всегда меньше истории нового и не примется за номер свежего события
+        self.seq = int(time.time() * 1000)
+        self.stats = {'received': 0, 'delivered': 0, 'dropped_clients': 0, 'bad_datagrams': 0}
+
+    def frame(self, event_type, data):
+        self.seq += 1
+        body = json.dumps(data, ensure_ascii=False)
+        return self.seq, f"id: {self.seq}\nevent: {event_type}\ndata: {body}\n\n".encode('utf-8')
+
+    def publish(self, country, event_type, data):
+        countries = COUNTRIES if country == 'all' else (country,)
+        event_id, frame = self.frame(event_type, data)
+        self.stats['received'] += 1
+        for target in countries:
+            self.history.append((event_id, target, frame))
+            for queue in list(self.subscribers.get(target, ())):
+                self.offer(queue, frame)
+
+    def offer(self, queue, item):
+        try:
+            queue.put_nowait(item)
+            if item is not PING:
+                self.stats['delivered'] += 1
+        except asyncio.QueueFull:
+            # Клиент не успевает читать - отключаем, браузер переподключится с Last-Event-ID
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(CLOSE)
+            self.stats['dropped_clients'] += 1
+
+    def replay(self, country, last_id):
+        """(кадры страны после last_id, reset). reset=True - часть пропущенного уже вытеснена
+        из истории (или last_id не из этого запуска): клиент должен перечитать данные сам"""
+        oldest = self.history[0][0] if self.history else self.seq + 1
+        if last_id > self.seq or last_id < oldest - 1:
+            return [], True
+        return [frame for event_id, target, frame in self.history if target == country and event_id > last_id], False
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            for queues in self.subscribers.values():
+                for queue in list(queues):
+                    if queue.empty():
+                        self.offer(queue, PING)
+
+
+HUB = web.AppKey('hub', Hub)
+BUS = web.AppKey('bus', asyncio.DatagramTransport)
+HEARTBEAT = web.AppKey('heartbeat', asyncio.Task)
+
+
+class BusProtocol(asyncio.DatagramProtocol):
+    """UDP-датаграммы от events.publish -> Hub"""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def datagram_received(self, data, addr):
+        try:
+            event = json.loads(data)
+            self.hub.publish(event.get('country', 'all'), event['type'], event.get('data', {}))
+        except (ValueError, KeyError, TypeError):
+            self.hub.stats['bad_datagrams'] += 1
+
+
+async def stream(request):
+    hub = request.app[HUB]
+    country = request.query.get('country', 'vietnam')
+    if country not in COUNTRIES:
+        country = 'vietnam'
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.query.get('last_event_id') or 0)
+    except ValueError:
+        last_id = 0
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'Access-Control-Allow-Origin': EVENT_ALLOW_ORIGIN
+    })
+    await response.prepare(request)
+    queue = asyncio.Queue(SUBSCRIBER_QUEUE)
+    hub.subscribers[country].add(queue)
+    try:
+        await response.write(f"retry: {RETRY_MS}\n: {country}\n\n".encode('utf-8'))
+        if last_id:
+            frames, reset = hub.replay(country, last_id)
+            if reset:
+                # С текущим номером: следующее переподключение продолжит уже отсюда
+                await response.write(f"id: {hub.seq}\nevent: reset\ndata: {{}}\n\n".encode('utf-8'))
+            for frame in frames:
+                await response.write(frame)
+        while True:
+            item = await queue.get()
+            if item is CLOSE:
+                break
+            await response.write(b": ping\n\n" if item is PING else item)
+    except ConnectionResetError:
+        pass
+    finally:
+        hub.subscribers[country].discard(queue)
+    return response
+
+
+async def stream_stats(request):
+    hub = request.app[HUB]
+    return web.json_response({
+        'subscribers': {country: len(queues) for country, queues in hub.subscribers.items()},
+        'last_event_id': hub.seq,
+        **hub.stats
+    })
+
+
+async def start_bus(app):
+    loop = asyncio.get_running_loop()
+    app[BUS], _ = await loop.create_datagram_endpoint(lambda: BusProtocol(app[HUB]), local_addr=bus_address())
+    app[HEARTBEAT] = asyncio.create_task(app[HUB].heartbeat())
+
+
+async def stop_bus(app):
+    app[HEARTBEAT].cancel()
+    app[BUS].close()
+    # Открытые потоки завершаем сами, иначе остановка ждёт, пока клиенты отключатся
+    for queues in app[HUB].subscribers.values():
+        for queue in list(queues):
+            app[HUB].offer(queue, CLOSE)
+
+
+def create_app():
+    app = web.Application()
+    app[HUB] = Hub()
+    app.router.add_get('/api/stream', stream)
+    app.router.add_get('/api/stream/stats', stream_stats)
+    app.on_startup.append(start_bus)
+    app.on_shutdown.append(stop_bus)
+    return app
+
+
+def raise_fd_limit():
+    # Каждый подписчик - открытый сокет; поднимаем мягкий лимит до жёсткого
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+if __name__ == '__main__':
+    limit = raise_fd_limit()
+    host, port = bus_address()
+    print(f"📡 SSE: http://0.0.0.0:{EVENT_SERVER_PORT}/api/stream, события по UDP {host}:{port}, "
+          f"лимит соединений ~{limit}")
+    web.run_app(create_app(), host='0.0.0.0', port=EVENT_SERVER_PORT, print=None, shutdown_timeout=5)
@@ -0,0 +1,49 @@
+import os
+import json
+import time
+import socket
+
+# Публикация событий для SSE-потока /api/stream (event_server.py).
+# Воркеры Flask, парсеры и backfill - разные процессы; событие уходит одним UDP-датаграммом
+# на локальный адрес EVENT_BUS_ADDR, где его слушает процесс event_server и раздаёт подписчикам.
+# publish() не блокирует и не падает: если event_server не запущен, датаграмма просто теряется,
+# а клиенты продолжают опрос по таймеру.
+# Типы: chat (новое/удалённое сообщение), listings (новые объявления парсеров), admin (правки админки).
+EVENT_BUS_ADDR = os.environ.get('EVENT_BUS_ADDR', '127.0.0.1:8766')
+MAX_DATAGRAM = 60000  # UDP на loopback - до 64 КБ; больше не шлём
+LISTING_EVENT_LIMIT = 20  # объявлений в одном событии - клиенту нужны id и категория, остальное он догрузит
+
+_socket = None
+
+
+def bus_address():
+    host, _, port = EVENT_BUS_ADDR.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def publish(country, event_type, data=None):
+    """Отправить событие подписчикам страны (country='all' - всем)"""
+    global _socket
+    payload = json.dumps({'country': country, 'type': event_type, 'data': data or {}, 'ts': time.time()},
+                         ensure_ascii=False).encode('utf-8')
+    if len(payload) > MAX_DATAGRAM:
+        print(f"⚠️ событие {event_type} слишком большое ({len(payload)} байт), не отправлено")
+        return
+    try:
+        if _socket is None:
+            _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _socket.setblocking(False)
+        _socket.sendto(payload, bus_address())
+    except OSError:
+        pass
+
+
+def publish_listings(country, items):
+    """Новые объявления парсера: одно событие на пачку"""
+    items = [item for item in items if isinstance(item, dict)]
+    if not items:
+        return
+    publish(country, 'listings', {
+        'count': len(items),
+        'items': [{'id': item.get('id'), 'category': item.get('category')} for item in items[:LISTING_EVENT_LIMIT]]
+    })
@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Общий HTTP-клиент для исходящих запросов (Bot API, getFile, BunnyCDN).
+# Голый requests.get/post открывает новое TCP+TLS соединение на каждый вызов - для
+# get_listings, где getFile вызывается на каждое фото, это десятки рукопожатий на запрос.
+# Здесь на каждый хост своя Session с пулом keep-alive соединений, таймауты по умолчанию
+# и повторы: GET/HEAD - на обрывы и 502/503/504, остальные методы - только если
+# соединение не установилось (запрос не ушёл, повтор безопасен).
+# Отдельные Session - для первых HTTP_MAX_HOSTS хостов (Bot API, BunnyCDN и т.п.); остальные
+# (ссылки из объявлений, внешние картинки) идут через одну общую Session, где urllib3 сам держит
+# не больше HTTP_MAX_HOSTS пулов и закрывает давно не нужные - число сессий и сокетов ограничено.
+# Задержки по хостам - stats(), в админке: GET /api/admin/http-stats ("*" - все прочие хосты)
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_MAX_HOSTS = int(os.environ.get('HTTP_MAX_HOSTS', 16))
+OTHER_HOSTS = '*'
+LATENCY_SAMPLES = 500  # последних замеров на хост для перцентилей
+
+_sessions = {}
+_metrics = {}
+_lock = threading.Lock()
+
+
+def _retry_policy():
+    return Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD', 'OPTIONS'}),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+
+
+def _host_key(url):
+    """Хост url, если у него своя Session, иначе OTHER_HOSTS; Session создаётся при первом запросе"""
+    host = urlsplit(url).netloc
+    if host in _sessions:
+        return host
+    with _lock:
+        if host not in _sessions and len(_sessions) >= HTTP_MAX_HOSTS:
+            host = OTHER_HOSTS
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_MAX_HOSTS if host == OTHER_HOSTS else 1,
+                                  pool_maxsize=HTTP_POOL_SIZE, max_retries=_retry_policy())
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+            _metrics[host] = {'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                              'latencies': deque(maxlen=LATENCY_SAMPLES)}
+    return host
+
+
+def session_for(url):
+    """Session с пулом соединений для хоста url (одна на процесс; для прочих хостов - общая)"""
+    return _sessions[_host_key(url)]
+
+
+def request(method, url, timeout=None, **kwargs):
+    host = _host_key(url)
+    session = _sessions[host]
+    started = time.perf_counter()
+    error = True
+    try:
+        response = session.request(method, url, timeout=timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                                   **kwargs)
+        error = response.status_code >= 500
+        return response
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        metrics = _metrics[host]
+        with _lock:
+            metrics['requests'] += 1
+            metrics['errors'] += error
+            metrics['total_ms'] += elapsed
+            metrics['max_ms'] = max(metrics['max_ms'], elapsed)
+            metrics['latencies'].append(elapsed)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request('HEAD', url, **kwargs)
+
+
+def _connections(session):
+    """Сколько соединений пул открыл за всё время (каждое - отдельное TCP/TLS рукопожатие)"""
+    opened = 0
+    for adapter in session.adapters.values():
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+    return opened
+
+
+def stats():
+    """По хостам: запросы, ошибки, средняя/p50/p95/max задержка (мс), открыто соединений"""
+    result = {}
+    with _lock:
+        for host, metrics in _metrics.items():
+            latencies = sorted(metrics['latencies'])
+            count = metrics['requests']
+            result[host] = {
+                'requests': count,
+                'errors': metrics['errors'],
+                'avg_ms': round(metrics['total_ms'] / count, 1) if count else None,
+                'p50_ms': round(latencies[len(latencies) // 2], 1) if latencies else None,
+                'p95_ms': round(latencies[int(len(latencies) * 0.95)], 1) if latencies else None,
+                'max_ms': round(metrics['max_ms'], 1),
+                'connections_opened': _connections(_sessions[host])
+            }
+    return result
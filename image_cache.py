@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import http_client
+
+# Дисковый кэш для /api/bunny-image/<path>.
+# Раньше каждый просмотр скачивал объект из BunnyCDN Storage целиком в память и отдавал его.
+# Теперь объект один раз пишется потоком (по IMAGE_CACHE_CHUNK) в image_cache/, дальше
+# отдаётся с диска через send_file: ETag/Last-Modified, 304 и Range (206) делает werkzeug.
+# Одновременные промахи по одному пути ждут друг друга на flock: в Storage уходит один запрос
+# на все воркеры. Размер кэша ограничен IMAGE_CACHE_MAX_MB, вытесняются давно не читанные (LRU по mtime).
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_MB = int(os.environ.get('IMAGE_CACHE_MAX_MB', 1024))
+IMAGE_CACHE_CHUNK = 64 * 1024
+EVICT_EVERY = 50  # новых файлов между проверками размера
+TMP_MAX_AGE = 3600  # сек; .tmp старше - остаток оборванной загрузки, удаляется при вытеснении
+
+
+class UpstreamError(Exception):
+    def __init__(self, status):
+        super().__init__(f"upstream HTTP {status}")
+        self.status = status
+
+
+def _paths(key):
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    folder = os.path.join(IMAGE_CACHE_DIR, digest[:2])
+    base = os.path.join(folder, digest)
+    # Блокировки - 4096 полос, а не файл на путь: промахи (404) не оставляют мусора
+    lock_path = os.path.join(IMAGE_CACHE_DIR, 'locks', f"{digest[:3]}.lock")
+    return folder, base, f"{base}.json", lock_path
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _touch(path):
+    # mtime = время последнего чтения, по нему вытесняем
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+_inserts = 0
+
+
+def get(key, url, headers=None):
+    """(путь к файлу, meta) - из кэша или скачав потоком. UpstreamError, если Storage не отдал объект"""
+    global _inserts
+    folder, data_path, meta_path, lock_path = _paths(key)
+    meta = _read_meta(meta_path)
+    if meta and os.path.exists(data_path):
+        _touch(data_path)
+        return data_path, meta
+
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Пока ждали блокировку, файл мог скачать другой запрос
+        meta = _read_meta(meta_path)
+        if meta and os.path.exists(data_path):
+            _touch(data_path)
+            return data_path, meta
+
+        response = http_client.get(url, headers=headers, stream=True)
+        tmp_path = f"{data_path}.{os.getpid()}.tmp"
+        try:
+            if response.status_code != 200:
+                raise UpstreamError(response.status_code)
+            os.makedirs(folder, exist_ok=True)
+            size = 0
+            digest = hashlib.md5()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(IMAGE_CACHE_CHUNK):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        except Exception:
+            # Оборванная загрузка не должна оставлять недокачанный файл
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            response.close()
+
+        meta = {
+            'content_type': response.headers.get('Content-Type', 'image/jpeg'),
+            'etag': digest.hexdigest(),
+            'size': size,
+            'fetched': time.time()
+        }
+        os.replace(tmp_path, data_path)
+        tmp_meta = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, meta_path)
+
+    _inserts += 1
+    if _inserts % EVICT_EVERY == 0:
+        evict()
+    return data_path, meta
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def evict(max_bytes=None):
+    """Удалить давно не читанные файлы, пока кэш больше лимита (до 90% лимита).
+    В размер входят и .json с метаданными; брошенные .tmp и .json без файла удаляются сразу"""
+    max_bytes = max_bytes if max_bytes is not None else IMAGE_CACHE_MAX_MB * 1024 * 1024
+    now = time.time()
+    data = {}  # путь -> (mtime, размер)
+    metas = {}  # путь файла -> размер его .json
+    total = 0
+    for folder, _, files in os.walk(IMAGE_CACHE_DIR):
+        for name in files:
+            path = os.path.join(folder, name)
+            if name.endswith('.lock'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                if now - stat.st_mtime > TMP_MAX_AGE:
+                    _remove(path)
+                else:
+                    total += stat.st_size  # загрузка идёт прямо сейчас
+            elif name.endswith('.json'):
+                metas[path[:-len('.json')]] = stat.st_size
+            elif '.' not in name:
+                data[path] = (stat.st_mtime, stat.st_size)
+    for path, size in metas.items():
+        if path not in data:
+            _remove(f"{path}.json")
+            continue
+        data[path] = (data[path][0], data[path][1] + size)
+    total += sum(size for _, size in data.values())
+    if total <= max_bytes:
+        return 0
+    removed = 0
+    entries = sorted((mtime, size, path) for path, (mtime, size) in data.items())
+    for _, size, path in entries:
+        if total <= max_bytes * 0.9:
+            break
+        _remove(f"{path}.json")
+        _remove(path)
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,76 @@
+import io
+import os
+from PIL import Image
+
+# Перцептивный хеш фото (dHash) и индекс для поиска визуально одинаковых фото.
+# md5 байтов ломается, как только Telegram пережал или уменьшил фото при репосте;
+# dHash сравнивает яркость соседних пикселей уменьшенной копии, поэтому
+# пережатое/уменьшенное фото даёт тот же хеш с точностью до нескольких бит.
+PHASH_MAX_DISTANCE = int(os.environ.get('PHASH_MAX_DISTANCE', 6))
+HASH_SIZE = 8  # 8x8 = 64 бита
+
+
+def dhash(image_bytes):
+    """64-битный dHash фото или None, если байты не открываются как картинка"""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        # Для JPEG декодируем сразу в уменьшенном масштабе - это в разы быстрее полного декода
+        img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        img = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    except Exception:
+        return None
+    pixels = list(img.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class ImageIndex:
+    """Multi-index поиск по полю image_phash объявлений страны.
+    Хеш режется на PHASH_MAX_DISTANCE + 1 кусков: у хешей с расстоянием <= PHASH_MAX_DISTANCE
+    хотя бы один кусок совпадает точно, поэтому сравниваем только кандидатов из этих корзин
+    (BK-дерево на случайных 64-битных хешах при радиусе 6 обходит большую часть дерева)."""
+
+    def __init__(self, items=(), max_distance=PHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        bounds = [64 * i // chunks for i in range(chunks + 1)]
+        self.chunks = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self.tables = [{} for _ in self.chunks]
+        self.hashes = {}  # id -> хеш
+        for item in items:
+            if item.get('image_phash'):
+                self.add(int(item['image_phash'], 16), item.get('id'))
+
+    def _keys(self, value):
+        return [(value >> shift) & mask for shift, mask in self.chunks]
+
+    def add(self, value, item_id):
+        if value is None or item_id is None:
+            return
+        self.hashes[item_id] = value
+        for table, key in zip(self.tables, self._keys(value)):
+            table.setdefault(key, []).append(item_id)
+
+    def find(self, value):
+        """id объявления с визуально тем же фото (ближайшее) или None"""
+        if value is None:
+            return None
+        best, best_distance = None, self.max_distance + 1
+        seen = set()
+        for table, key in zip(self.tables, self._keys(value)):
+            for item_id in table.get(key, ()):
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+                distance = hamming(self.hashes[item_id], value)
+                if distance < best_distance:
+                    best, best_distance = item_id, distance
+        return best
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+from contextlib import contextmanager
+
+# Очередь фоновых задач (полный бэкфилл канала и т.п.).
+# Flask только ставит задачу в jobs.json и отдаёт её id; выполняет backfill_worker.py.
+# Файл читают и пишут несколько процессов (воркеры gunicorn + фоновый воркер),
+# поэтому каждое чтение-изменение-запись идёт под flock.
+JOBS_FILE = 'jobs.json'
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 120))  # сек без heartbeat - воркер умер
+JOB_HEARTBEAT_INTERVAL = max(5, JOB_STALE_AFTER // 4)  # сек между heartbeat работающей задачи
+JOBS_KEEP = 200  # завершённые задачи сверх этого числа удаляются
+
+
+@contextmanager
+def _locked_jobs():
+    with open(f"{JOBS_FILE}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            jobs = {}
+            if os.path.exists(JOBS_FILE):
+                try:
+                    with open(JOBS_FILE, 'r', encoding='utf-8') as f:
+                        jobs = json.load(f)
+                except Exception:
+                    pass
+            before = json.dumps(jobs, sort_keys=True)
+            yield jobs
+            if json.dumps(jobs, sort_keys=True) != before:
+                tmp_file = f"{JOBS_FILE}.{os.getpid()}.tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(jobs, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_file, JOBS_FILE)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def create_job(kind, params, key=None):
+    """Поставить задачу в очередь. С key повторный запрос той же работы (пока она не завершена)
+    возвращает уже существующую задачу, а не ставит вторую"""
+    job = {
+        'id': uuid.uuid4().hex[:12],
+        'kind': kind,
+        'params': params,
+        'status': 'queued',
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'heartbeat': None,
+        'error': None,
+        'progress': {}
+    }
+    if key:
+        job['key'] = key
+    with _locked_jobs() as jobs:
+        if key:
+            active = next((j for j in jobs.values()
+                           if j.get('key') == key and j['status'] in ('queued', 'running')), None)
+            if active:
+                return active
+        jobs[job['id']] = job
+        done = sorted((j for j in jobs.values() if j['status'] in ('done', 'failed', 'cancelled')),
+                      key=lambda j: j['created'])
+        for old in done[:max(0, len(jobs) - JOBS_KEEP)]:
+            del jobs[old['id']]
+    return job
+
+
+def get_job(job_id):
+    with _locked_jobs() as jobs:
+        return jobs.get(job_id)
+
+
+def find_jobs(key):
+    """Все задачи с этим key (ещё не вычищенные), от старых к новым"""
+    with _locked_jobs() as jobs:
+        return sorted((j for j in jobs.values() if j.get('key') == key), key=lambda j: j['created'])
+
+
+def list_jobs(limit=20):
+    with _locked_jobs() as jobs:
+        return sorted(jobs.values(), key=lambda j: j['created'], reverse=True)[:limit]
+
+
+def update_job(job_id, progress=None, **fields):
+    """Обновить поля задачи; progress дописывается к имеющемуся. Возвращает задачу (или None)"""
+    with _locked_jobs() as jobs:
+        job = jobs.get(job_id)
+        if not job:
+            return None
+        job.update(fields)
+        if progress:
+            job['progress'].update(progress)
+        if job['status'] == 'running':
+            job['heartbeat'] = time.time()
+        return job
+
+
+def claim_job(kinds):
+    """Взять самую старую задачу из очереди. Задача в статусе running без heartbeat дольше
+    JOB_STALE_AFTER (воркер упал) тоже забирается - и продолжается с сохранённого места."""
+    now = time.time()
+    with _locked_jobs() as jobs:
+        candidates = [
+            j for j in jobs.values() if j['kind'] in kinds and (
+                j['status'] == 'queued' or
+                (j['status'] == 'running' and now - (j['heartbeat'] or 0) > JOB_STALE_AFTER))
+        ]
+        if not candidates:
+            return None
+        job = min(candidates, key=lambda j: j['created'])
+        job['status'] = 'running'
+        job['started'] = job['started'] or now
+        job['heartbeat'] = now
+        job['error'] = None
+        return job
+
+
+def job_summary(job):
+    """Задача + производительность для API"""
+    progress = job.get('progress', {})
+    processed = progress.get('processed', 0)
+    elapsed = progress.get('active_seconds', 0)
+    return {
+        **job,
+        'throughput': round(processed / elapsed, 2) if elapsed else None,  # сообщений в секунду
+        'elapsed': round(elapsed, 1)
+    }
@@ -0,0 +1,158 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+
+# Объявления по странам: listings_<страна>.json и общий listings_data.json.
+# Отдельно от app.py, чтобы фоновые процессы (backfill_worker) не поднимали ради них Flask-приложение.
+# Файл страны пишут несколько процессов (парсеры, realtime_ingest, backfill_worker, админка),
+# поэтому любое чтение-изменение-запись идёт под listings_lock и перечитывает файл внутри блокировки.
+DATA_FILE = "listings_data.json"
+
+_local = threading.local()
+
+
+@contextmanager
+def listings_lock(country):
+    """Эксклюзивный flock на listings_<страна>.json. Повторный вход в том же потоке
+    не блокируется - внутри можно звать load_data/save_data и остальные функции модуля."""
+    held = _local.__dict__.setdefault('held', set())
+    if country in held:
+        yield
+        return
+    with open(f"listings_{country}.json.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        held.add(country)
+        try:
+            yield
+        finally:
+            held.discard(country)
+
+
+def read_listings(country):
+    """Файл страны как есть: {категория: [...]} или плоский список; {} если файла нет"""
+    path = f"listings_{country}.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_listings(country, data):
+    """Атомарная запись файла страны (вызывать под listings_lock)"""
+    path = f"listings_{country}.json"
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, path)
+
+
+def merge_listings(country, items, at_start=True):
+    """Дописать новые объявления в актуальный файл страны.
+    Файл перечитывается под блокировкой, поэтому записанное другими процессами после старта
+    парсера не теряется. Известные id пропускаются, почти-дубликаты сливаются в sources.
+    Возвращает (добавленные объявления, число слитых дубликатов)."""
+    from dedup_index import DedupIndex
+    added = []
+    merged = 0
+    with listings_lock(country):
+        data = read_listings(country)
+        buckets = data if isinstance(data, dict) else {'_all': data}
+        dedup = DedupIndex.from_data(data)
+        for item in items:
+            if dedup.known(item.get('id')):
+                continue
+            if dedup.merge(item):
+                merged += 1
+                continue
+            cat = item.get('category', 'chat') if isinstance(data, dict) else '_all'
+            bucket = buckets.setdefault(cat, [])
+            if at_start:
+                bucket.insert(0, item)
+            else:
+                bucket.append(item)
+            added.append(item)
+        if added or merged:
+            write_listings(country, buckets if isinstance(data, dict) else buckets['_all'])
+    return added, merged
+
+
+def create_empty_data():
+    return {
+        "restaurants": [],
+        "tours": [],
+        "transport": [],
+        "real_estate": [],
+        "money_exchange": [],
+        "entertainment": [],
+        "marketplace": [],
+        "visas": [],
+        "news": [],
+        "medicine": [],
+        "kids": [],
+        "chat": []
+    }
+
+
+def load_data(country='vietnam'):
+    country_file = f"listings_{country}.json"
+    if os.path.exists(country_file):
+        data = read_listings(country)
+        if isinstance(data, dict):
+            return data
+
+        # Если данные в файле - список, распределяем по категориям
+        result = create_empty_data()
+        category_map = {
+            'bikes': 'transport',
+            'real_estate': 'real_estate',
+            'exchange': 'money_exchange',
+            'money_exchange': 'money_exchange',
+            'food': 'restaurants'
+        }
+        for item in data:
+            if not isinstance(item, dict): continue
+            cat = item.get('category', 'chat')
+            mapped_cat = category_map.get(cat, cat)
+            if mapped_cat in result:
+                result[mapped_cat].append(item)
+        return result
+
+    if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, 'r', encoding='utf-8') as f:
+            all_data = json.load(f)
+            if country in all_data:
+                return all_data[country]
+    return create_empty_data()
+
+
+def save_data(country='vietnam', data=None):
+    if not data or not isinstance(data, dict):
+        return
+
+    # Сохраняем в файл страны
+    country_file = f"listings_{country}.json"
+    try:
+        with listings_lock(country):
+            write_listings(country, data)
+    except Exception as e:
+        print(f"Error saving country file {country_file}: {e}")
+
+    # Открытые дашборды страны обновят счётчики и списки (SSE, event_server.py)
+    from events import publish
+    publish(country, 'admin', {'kind': 'listings'})
+
+    # Синхронизируем с общим файлом listings_data.json (его пишут все страны)
+    try:
+        with listings_lock('data'):
+            all_data = {}
+            if os.path.exists(DATA_FILE):
+                with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                    all_data = json.load(f)
+
+            all_data[country] = data
+            with open(DATA_FILE, 'w', encoding='utf-8') as f:
+                json.dump(all_data, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"Error syncing with listings_data.json: {e}")
@@ -0,0 +1,81 @@
+import os
+import json
+
+# Что качать из Telegram для карточек объявлений.
+# Карточка на дашборде ~300 px, а оригинал фото - до 2560 px и 0.3-1 МБ. При MEDIA_FETCH_POLICY=thumb
+# парсер качает готовое превью Telegram нужного размера (x = 800 px, ~60-90 КБ),
+# а оригинал - только когда его впервые запросит детальный просмотр (/api/listing-photo/<id>).
+# Оригинал качает backfill_worker (задача full_photo), ссылка сохраняется в объявлении
+# (full_image_url) и дальше отдаётся без обращения к Telegram.
+MEDIA_FETCH_POLICY = os.environ.get('MEDIA_FETCH_POLICY', 'thumb')  # thumb | full
+MEDIA_THUMB_SIZE = os.environ.get('MEDIA_THUMB_SIZE', 'x')  # s=100, m=320, x=800, y=1280 px
+# Оригинал, который не удалось скачать, запрашивается снова не раньше чем через
+# FULL_PHOTO_RETRY_AFTER * 2^(неудач - 1) сек и не больше FULL_PHOTO_MAX_ATTEMPTS раз
+FULL_PHOTO_RETRY_AFTER = int(os.environ.get('FULL_PHOTO_RETRY_AFTER', 300))
+FULL_PHOTO_MAX_ATTEMPTS = int(os.environ.get('FULL_PHOTO_MAX_ATTEMPTS', 3))
+
+# Типы размеров фото Telegram по возрастанию
+PHOTO_SIZE_TYPES = 'smxyw'
+
+
+def thumb_size(photo, preferred=MEDIA_THUMB_SIZE):
+    """Самый большой из доступных размеров фото, не больше preferred (или None)"""
+    available = {getattr(size, 'type', None) for size in getattr(photo, 'sizes', None) or []}
+    if preferred not in PHOTO_SIZE_TYPES:
+        return None
+    for size_type in reversed(PHOTO_SIZE_TYPES[:PHOTO_SIZE_TYPES.index(preferred) + 1]):
+        if size_type in available:
+            return size_type
+    return None
+
+
+async def fetch_photo(client, limiter, msg, policy=MEDIA_FETCH_POLICY):
+    """Байты фото сообщения: (data, full). full=False - скачано только превью"""
+    if policy == 'thumb':
+        size = thumb_size(msg.photo)
+        if size:
+            data = await limiter.call(client.download_media, msg.media, bytes, thumb=size)
+            if data:
+                return data, False
+    return await limiter.call(client.download_media, msg.media, bytes), True
+
+
+def listings_file(country):
+    return f"listings_{country}.json"
+
+
+def find_listing(country, listing_id):
+    """Объявление по id прямо из файла страны (и список, и словарь категорий)"""
+    from dedup_index import iter_listings
+    path = listings_file(country)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return next((item for item in iter_listings(data) if item.get('id') == listing_id), None)
+
+
+def update_listing(country, listing_id, fields):
+    """Дописать поля в объявление; файл перечитывается под блокировкой (его пишут и парсеры)"""
+    from dedup_index import iter_listings
+    from listings_store import listings_lock, read_listings, write_listings
+    if not os.path.exists(listings_file(country)):
+        return False
+    with listings_lock(country):
+        data = read_listings(country)
+        item = next((item for item in iter_listings(data) if item.get('id') == listing_id), None)
+        if item is None:
+            return False
+        item.update(fields)
+        write_listings(country, data)
+    return True
+
+
+def full_photo_retry_allowed(failed_jobs, now):
+    """Можно ли снова ставить задачу full_photo после неудачных (jobs.find_jobs по ключу)"""
+    if not failed_jobs:
+        return True
+    if len(failed_jobs) >= FULL_PHOTO_MAX_ATTEMPTS:
+        return False
+    last_finished = failed_jobs[-1].get('finished') or failed_jobs[-1]['created']
+    return now >= last_finished + FULL_PHOTO_RETRY_AFTER * 2 ** (len(failed_jobs) - 1)
@@ -0,0 +1,189 @@
+import os
+import time
+import fcntl
+import sqlite3
+import threading
+import requests
+import http_client
+
+# Очередь исходящих сообщений бота.
+# Обработчики форм и чата раньше ждали sendMessage до 10 сек прямо в запросе пользователя.
+# Теперь enqueue() только пишет строку в SQLite (notify_queue.db) и сразу возвращается,
+# а отправляет фоновый поток:
+#   - очередь на диске: рестарт сервера не теряет уведомления;
+#   - 429 - ждём retry_after из ответа Telegram, 5xx/обрывы - повторы с backoff;
+#   - уведомления в один чат, накопившиеся за NOTIFY_MIN_INTERVAL, уходят одним сообщением-дайджестом.
+# Поток запускается в каждом процессе, но отправляет только один - тот, кто держит flock.
+# Можно вынести отправку в отдельный процесс: python notify_queue.py
+NOTIFY_QUEUE_FILE = os.environ.get('NOTIFY_QUEUE_FILE', 'notify_queue.db')
+# Можно указать локальную заглушку Bot API, например http://127.0.0.1:8090
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+NOTIFY_MIN_INTERVAL = float(os.environ.get('NOTIFY_MIN_INTERVAL', 3))  # сек между сообщениями в один чат
+NOTIFY_MAX_ATTEMPTS = 8
+NOTIFY_POLL_INTERVAL = 1.0
+TELEGRAM_TEXT_LIMIT = 4096
+DIGEST_SEPARATOR = '\n\n➖➖➖\n\n'
+
+_local = threading.local()
+_sender = None
+_sender_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def _db():
+    db = getattr(_local, 'db', None)
+    if db is None or _local.pid != os.getpid():
+        db = sqlite3.connect(NOTIFY_QUEUE_FILE, timeout=10, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('''CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            batchable INTEGER NOT NULL DEFAULT 1,
+            created REAL NOT NULL,
+            next_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0)''')
+        db.execute('CREATE INDEX IF NOT EXISTS queue_next ON queue (next_at)')
+        _local.db = db
+        _local.pid = os.getpid()
+    return db
+
+
+def enqueue(chat_id, text, batchable=True):
+    """Поставить сообщение в очередь (HTML). batchable=False - не объединять в дайджест (ответы бота)"""
+    now = time.time()
+    _db().execute('INSERT INTO queue (chat_id, text, batchable, created, next_at) VALUES (?, ?, ?, ?, ?)',
+                  (str(chat_id), text, 1 if batchable else 0, now, now))
+    start_sender()
+    _wakeup.set()
+
+
+def pending():
+    """Сколько сообщений ждёт отправки"""
+    return _db().execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+
+
+def build_batches(rows):
+    """Строки очереди одного чата -> [(ids, текст)]: подряд идущие batchable-строки склеиваются
+    в дайджест не длиннее лимита Telegram, остальные уходят по одной"""
+    batches = []
+    ids, parts, size = [], [], 0
+    for row_id, text, batchable in rows:
+        if not batchable or len(text) > TELEGRAM_TEXT_LIMIT:
+            if ids:
+                batches.append((ids, parts))
+                ids, parts, size = [], [], 0
+            batches.append(([row_id], [text[:TELEGRAM_TEXT_LIMIT]]))
+            continue
+        if ids and size + len(DIGEST_SEPARATOR) + len(text) > TELEGRAM_TEXT_LIMIT:
+            batches.append((ids, parts))
+            ids, parts, size = [], [], 0
+        size += len(text) + (len(DIGEST_SEPARATOR) if parts else 0)
+        ids.append(row_id)
+        parts.append(text)
+    if ids:
+        batches.append((ids, parts))
+    return [(ids, DIGEST_SEPARATOR.join(parts)) for ids, parts in batches]
+
+
+class Sender:
+    def __init__(self, bot_token=None):
+        self.bot_token = bot_token or os.environ.get('TELEGRAM_BOT_TOKEN', '')
+        self.chat_ready_at = {}  # chat_id -> когда можно слать следующее сообщение
+        self.stats = {'sent': 0, 'digests': 0, 'retries': 0, 'dropped': 0}
+
+    def send(self, chat_id, text):
+        """(ok, retry): retry - сек до повтора из 429 retry_after, 0 - повтор с backoff, None - не повторять"""
+        url = f"{TELEGRAM_API_URL}/bot{self.bot_token}/sendMessage"
+        try:
+            response = http_client.post(url, data={'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'},
+                                        timeout=(5, 15))
+        except requests.RequestException as e:
+            print(f"Telegram notification error: {e}")
+            return False, 0
+        if response.status_code == 200:
+            return True, None
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get('parameters', {}).get('retry_after', 5)
+            except ValueError:
+                retry_after = 5
+            return False, retry_after
+        if response.status_code >= 500:
+            return False, 0
+        print(f"Telegram notification error: HTTP {response.status_code} {response.text[:200]}")
+        return False, None
+
+    def run_once(self):
+        """Отправить всё, что готово; вернуть число отправленных строк очереди"""
+        db = _db()
+        now = time.time()
+        rows = db.execute('SELECT id, chat_id, text, batchable, attempts FROM queue WHERE next_at <= ? ORDER BY id',
+                          (now,)).fetchall()
+        by_chat = {}
+        for row in rows:
+            by_chat.setdefault(row[1], []).append(row)
+        done = 0
+        for chat_id, chat_rows in by_chat.items():
+            if self.chat_ready_at.get(chat_id, 0) > now:
+                continue
+            attempts = {row[0]: row[4] for row in chat_rows}
+            for ids, text in build_batches([(row[0], row[2], row[3]) for row in chat_rows]):
+                ok, retry = self.send(chat_id, text)
+                placeholders = ','.join('?' * len(ids))
+                if ok:
+                    db.execute(f'DELETE FROM queue WHERE id IN ({placeholders})', ids)
+                    self.stats['sent'] += 1
+                    if len(ids) > 1:
+                        self.stats['digests'] += 1
+                    done += len(ids)
+                    # Следующее сообщение в этот чат - не раньше чем через NOTIFY_MIN_INTERVAL
+                    self.chat_ready_at[chat_id] = time.time() + NOTIFY_MIN_INTERVAL
+                    break
+                tries = max(attempts[i] for i in ids) + 1
+                if retry is None or tries >= NOTIFY_MAX_ATTEMPTS:
+                    db.execute(f'DELETE FROM queue WHERE id IN ({placeholders})', ids)
+                    self.stats['dropped'] += len(ids)
+                    continue
+                # Пауза для всего чата: остальные сообщения этого чата ждут вместе с ним
+                self.stats['retries'] += 1
+                delay = retry or min(300, 2 ** tries)
+                db.execute(f'UPDATE queue SET attempts = attempts + 1, next_at = ? WHERE id IN ({placeholders})',
+                           [time.time() + delay] + ids)
+                self.chat_ready_at[chat_id] = time.time() + delay
+                break
+        return done
+
+    def loop(self):
+        lock = open(f"{NOTIFY_QUEUE_FILE}.lock", 'w')
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                # Отправляет другой процесс; ждём, вдруг он завершится
+                time.sleep(5)
+        while True:
+            try:
+                if self.bot_token:
+                    self.run_once()
+            except Exception as e:
+                print(f"Telegram notification queue error: {e}")
+            _wakeup.wait(NOTIFY_POLL_INTERVAL)
+            _wakeup.clear()
+
+
+def start_sender():
+    """Фоновый поток отправки (один на процесс)"""
+    global _sender
+    if _sender is not None and _sender.is_alive():
+        return
+    with _sender_lock:
+        if _sender is None or not _sender.is_alive():
+            _sender = threading.Thread(target=Sender().loop, name='notify-sender', daemon=True)
+            _sender.start()
+
+
+if __name__ == '__main__':
+    print(f"📨 Очередь уведомлений: {pending()} в ожидании")
+    Sender().loop()
@@ -0,0 +1,113 @@
+import os
+import re
+import gzip
+import hashlib
+import threading
+
+try:
+    import brotli
+except ImportError:  # brotli есть в зависимостях; в окружении без него - только gzip
+    brotli = None
+
+# Готовая страница дашборда.
+# В dashboard.html нет переменных шаблона, а render_template вызывался на каждый визит
+# и 450 КБ уходили без сжатия. Теперь страница собирается один раз (и заново, если файл
+# шаблона изменился): встроенные <style> и <script> выносятся в /assets/dashboard.<hash>.css|js
+# (кэш браузера на год - имя меняется вместе с содержимым), CSS и HTML ужимаются,
+# всё заранее сжато gzip (и brotli, если установлен). Ответ - готовые байты с ETag и 304.
+# Ссылки /static/... в разметке, стилях и скрипте заменяются на /s/... с отпечатком (static_assets.py).
+ASSET_MAX_AGE = 365 * 24 * 3600
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+class Asset:
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.etag = hashlib.md5(body).hexdigest()[:16]
+        self.gzip = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        self.br = brotli.compress(body, quality=BROTLI_QUALITY) if brotli else None
+
+    def encoded(self, accept_encoding):
+        """(байты, Content-Encoding или None) - самый компактный из поддерживаемых клиентом"""
+        accept_encoding = accept_encoding or ''
+        if self.br is not None and 'br' in accept_encoding:
+            return self.br, 'br'
+        if 'gzip' in accept_encoding:
+            return self.gzip, 'gzip'
+        return self.body, None
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    lines = (line.strip() for line in css.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def minify_html(html):
+    """Убрать отступы, пустые строки и комментарии. Только для разметки без <pre>:
+    скрипты и стили к этому моменту уже вынесены"""
+    html = re.sub(r'<!--(?!\[if).*?-->', '', html, flags=re.S)
+    lines = (line.strip() for line in html.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+STATIC_REF = re.compile(r"/static/[\w./-]+\.\w+")
+
+
+def fingerprint_refs(text):
+    """Известные манифесту ссылки /static/... -> /s/...<hash>...; остальные как есть"""
+    from static_assets import asset_url
+    return STATIC_REF.sub(lambda m: asset_url(m.group(0)), text)
+
+
+def build_page(html, name):
+    """HTML шаблона -> (страница, {имя файла: Asset})"""
+    assets = {}
+    html = fingerprint_refs(html)
+
+    def extract(match, ext, content_type, tag):
+        body = match.group(1)
+        if ext == 'css':
+            body = minify_css(body)
+        asset = Asset(body.encode('utf-8'), content_type)
+        filename = f"{name}.{asset.etag[:10]}.{ext}"
+        assets[filename] = asset
+        return tag.format(url=f"/assets/{filename}")
+
+    html = re.sub(r'<style>(.*?)</style>',
+                  lambda m: extract(m, 'css', 'text/css; charset=utf-8', '<link rel="stylesheet" href="{url}">'),
+                  html, flags=re.S)
+    html = re.sub(r'<script>(.*?)</script>',
+                  lambda m: extract(m, 'js', 'application/javascript; charset=utf-8', '<script src="{url}"></script>'),
+                  html, flags=re.S)
+    page = Asset(minify_html(html).encode('utf-8'), 'text/html; charset=utf-8')
+    return page, assets
+
+
+class PageCache:
+    """Собранные страницы по имени шаблона; пересборка при изменении mtime файла или манифеста static/"""
+
+    def __init__(self, template_folder):
+        self.template_folder = template_folder
+        self.pages = {}
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def get(self, template, render):
+        path = os.path.join(self.template_folder, template)
+        from static_assets import manifest_version
+        mtime = (os.stat(path).st_mtime, manifest_version())
+        cached = self.pages.get(template)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with self.lock:
+            cached = self.pages.get(template)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            page, assets = build_page(render(template), os.path.splitext(template)[0])
+            # Старые ассеты оставляем: открытые вкладки могут ещё догружать прежние имена
+            self.assets.update(assets)
+            self.pages[template] = (mtime, page)
+            return page
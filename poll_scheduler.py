@@ -0,0 +1,144 @@
+import os
+import json
+import time
+
+# Адаптивное расписание опроса каналов.
+# Для каждого канала считаем EWMA скорости новых сообщений (сообщений в час):
+# активные каналы опрашиваются чаще, тихие - экспоненциально реже, в пределах [floor, ceiling].
+POLL_SCHEDULE_FILE = 'poll_schedule.json'
+
+POLL_MIN_INTERVAL = int(os.environ.get('POLL_MIN_INTERVAL', 60))         # floor, сек
+POLL_MAX_INTERVAL = int(os.environ.get('POLL_MAX_INTERVAL', 6 * 3600))   # ceiling, сек
+POLL_EWMA_ALPHA = float(os.environ.get('POLL_EWMA_ALPHA', 0.3))
+# Опрашиваем тогда, когда в канале ожидается примерно столько новых сообщений
+POLL_TARGET_NEW = float(os.environ.get('POLL_TARGET_NEW', 3))
+# Если вся страница опроса новая, дочитываем назад до прошлого опроса, но не больше стольких сообщений
+POLL_CATCHUP_MAX = int(os.environ.get('POLL_CATCHUP_MAX', 100))
+
+
+class PollScheduler:
+    def __init__(self, path=POLL_SCHEDULE_FILE):
+        self.path = path
+        self.state = self._load()
+        self.touched = set()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception:
+                pass
+        return {}
+
+    def due(self, channels, now=None):
+        """Отфильтровать каналы, которые пора опрашивать (новые - всегда)"""
+        now = now or time.time()
+        return [c for c in channels if self.state.get(self._key(c), {}).get('next_poll', 0) <= now]
+
+    def last_msg_id(self, channel):
+        return self.state.get(self._key(channel), {}).get('last_msg_id')
+
+    async def fetch_new(self, limiter, client, entity, channel, limit):
+        """Сообщения канала с прошлого опроса: первая страница limit сообщений, и если она вся новая -
+        следующие страницы назад до last_msg_id (до POLL_CATCHUP_MAX). Результат учитывается в record()"""
+        last_id = self.last_msg_id(channel)
+        messages = list(await limiter.call(client.get_messages, entity, limit=limit))
+        saturated = False
+        while last_id is not None and len(messages) >= limit and messages[-1].id > last_id:
+            if len(messages) >= POLL_CATCHUP_MAX:
+                # Дочитать не успели - часть сообщений пропущена, канал опрашиваем как можно чаще
+                saturated = True
+                break
+            page = await limiter.call(client.get_messages, entity, limit=limit,
+                                      offset_id=messages[-1].id, min_id=last_id)
+            if not page:
+                break
+            messages.extend(page)
+        self.record(channel, [m.id for m in messages], saturated=saturated)
+        return messages
+
+    def record(self, channel, message_ids, now=None, saturated=False):
+        """Учесть результат опроса: message_ids - id всех полученных сообщений.
+        saturated - новых больше, чем удалось прочитать: интервал сразу минимальный"""
+        now = now or time.time()
+        key = self._key(channel)
+        entry = self.state.get(key, {})
+        last_id = entry.get('last_msg_id')
+        max_id = max(message_ids) if message_ids else last_id
+        # При первом опросе базы для сравнения нет - считаем, что новых не было
+        new_count = len([m for m in message_ids if m > last_id]) if last_id is not None else 0
+
+        last_poll = entry.get('last_poll')
+        interval = entry.get('interval', POLL_MIN_INTERVAL)
+        ewma = entry.get('ewma', 0.0)
+        if last_poll:
+            hours = max((now - last_poll) / 3600, 1 / 3600)
+            ewma = POLL_EWMA_ALPHA * (new_count / hours) + (1 - POLL_EWMA_ALPHA) * ewma
+
+        if saturated:
+            interval = POLL_MIN_INTERVAL
+        elif new_count == 0:
+            # Тихий канал - экспоненциальный откат
+            interval = interval * 2
+        elif ewma > 0:
+            interval = POLL_TARGET_NEW / ewma * 3600
+        interval = int(min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, interval)))
+
+        self.state[key] = {
+            'ewma': round(ewma, 3),
+            'interval': interval,
+            'last_poll': now,
+            'next_poll': now + interval,
+            'last_new': new_count,
+            'last_msg_id': max_id
+        }
+        self.touched.add(key)
+        return interval
+
+    def save(self):
+        """Записать только затронутые каналы поверх свежей версии файла - его пишут несколько парсеров"""
+        if not self.touched:
+            return
+        data = self._load()
+        for key in self.touched:
+            data[key] = self.state[key]
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.path)
+            self.state = data
+            self.touched = set()
+        except Exception as e:
+            print(f"⚠️ poll schedule: {str(e)[:80]}")
+
+    def snapshot(self, now=None):
+        """Расписание для админки: ближайшие опросы сверху"""
+        now = now or time.time()
+        rows = []
+        for channel, entry in self.state.items():
+            rows.append({
+                'channel': channel,
+                'messages_per_hour': entry.get('ewma', 0),
+                'interval': entry.get('interval'),
+                'next_poll_in': max(0, int(entry.get('next_poll', 0) - now)),
+                'last_new': entry.get('last_new', 0),
+                'last_poll': entry.get('last_poll')
+            })
+        rows.sort(key=lambda r: r['next_poll_in'])
+        return rows
+
+    @staticmethod
+    def _key(channel):
+        return str(channel).replace('@', '').lower()
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = PollScheduler()
+    return _scheduler
@@ -0,0 +1,123 @@
+import os
+import math
+import mmap
+import time
+import fcntl
+import hashlib
+
+# Счётчик "сейчас онлайн" для /api/ping, /api/online и /api/status.
+# Раньше - словарь uid -> время без удаления: рос бесконечно, и каждый ping перебирал всех
+# посетителей за всё время. Теперь окно ONLINE_TIMEOUT разбито на корзины по BUCKET_SECONDS,
+# в каждой корзине - HyperLogLog (1024 регистра по байту, погрешность ~3%):
+#   ping  - O(1): один регистр в текущей корзине;
+#   count - O(корзин): регистры корзин в окне объединяются по максимуму.
+# Корзины лежат в общем файле через mmap, поэтому все воркеры gunicorn пишут в одни регистры.
+# Память фиксирована: (1 + стран) * корзин * (8 + 1024) байт.
+PRESENCE_FILE = os.environ.get('PRESENCE_FILE', 'presence.bin')
+ONLINE_TIMEOUT = 60
+BUCKET_SECONDS = 10
+BUCKETS = ONLINE_TIMEOUT // BUCKET_SECONDS
+HLL_BITS = 10
+REGISTERS = 1 << HLL_BITS
+SCOPES = ('all', 'vietnam', 'thailand', 'india', 'indonesia')
+COUNT_CACHE_SECONDS = 1.0
+
+_BUCKET_SIZE = 8 + REGISTERS  # номер корзины (epoch) + регистры
+_ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+
+
+def _hash(uid):
+    return int.from_bytes(hashlib.blake2b(uid.encode(), digest_size=8).digest(), 'big')
+
+
+def estimate(registers):
+    """Оценка HyperLogLog; для малых значений - линейный подсчёт по пустым регистрам"""
+    zeros = registers.count(0)
+    if zeros == REGISTERS:
+        return 0
+    raw = _ALPHA * REGISTERS * REGISTERS / sum(2.0 ** -r for r in registers)
+    if raw <= 2.5 * REGISTERS and zeros:
+        return round(REGISTERS * math.log(REGISTERS / zeros))
+    return round(raw)
+
+
+class Presence:
+    def __init__(self, path=PRESENCE_FILE):
+        self.path = path
+        self.pid = None
+        self.mm = None
+        self.cache = {}
+
+    def _map(self):
+        # Своё отображение в каждом процессе (после fork воркера)
+        if self.mm is None or self.pid != os.getpid():
+            size = len(SCOPES) * BUCKETS * _BUCKET_SIZE
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size:
+                    with open(f"{self.path}.lock", 'w') as lock:
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                        if os.fstat(fd).st_size != size:
+                            os.ftruncate(fd, 0)
+                            os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            self.pid = os.getpid()
+            self.cache = {}
+        return self.mm
+
+    def _bucket(self, scope, epoch):
+        """Смещение корзины для epoch; устаревшая корзина в кольце обнуляется под flock"""
+        mm = self._map()
+        offset = (SCOPES.index(scope) * BUCKETS + epoch % BUCKETS) * _BUCKET_SIZE
+        if int.from_bytes(mm[offset:offset + 8], 'little') != epoch:
+            with open(f"{self.path}.lock", 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if int.from_bytes(mm[offset:offset + 8], 'little') != epoch:
+                    mm[offset + 8:offset + _BUCKET_SIZE] = bytes(REGISTERS)
+                    mm[offset:offset + 8] = epoch.to_bytes(8, 'little')
+        return offset + 8
+
+    def ping(self, uid, country=None):
+        h = _hash(uid)
+        index = h & (REGISTERS - 1)
+        rest = h >> HLL_BITS
+        rank = (64 - HLL_BITS) - rest.bit_length() + 1
+        epoch = int(time.time() // BUCKET_SECONDS)
+        mm = self._map()
+        for scope in ('all', country) if country in SCOPES and country != 'all' else ('all',):
+            registers = self._bucket(scope, epoch)
+            # Гонка двух воркеров на одном байте теряет максимум одну отметку - для оценки не важно
+            if mm[registers + index] < rank:
+                mm[registers + index] = rank
+
+    def count(self, scope='all'):
+        if scope not in SCOPES:
+            return 0
+        now = time.time()
+        cached = self.cache.get(scope)
+        if cached and now - cached[0] < COUNT_CACHE_SECONDS:
+            return cached[1]
+        mm = self._map()
+        epoch = int(now // BUCKET_SECONDS)
+        merged = bytearray(REGISTERS)
+        for i in range(BUCKETS):
+            offset = (SCOPES.index(scope) * BUCKETS + i) * _BUCKET_SIZE
+            bucket_epoch = int.from_bytes(mm[offset:offset + 8], 'little')
+            if epoch - bucket_epoch >= BUCKETS:
+                continue
+            merged = bytearray(map(max, merged, mm[offset + 8:offset + _BUCKET_SIZE]))
+        value = estimate(merged)
+        self.cache[scope] = (now, value)
+        return value
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        _presence = Presence()
+    return _presence
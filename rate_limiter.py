@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import asyncio
+from telethon.errors import FloodWaitError
+from entity_cache import account_key
+
+# Общий для всех парсеров token-bucket лимитер запросов к Telegram.
+# Скорость адаптивная: каждый FloodWait режет её вдвое и ставит паузу на e.seconds,
+# успешные запросы понемногу возвращают скорость обратно (AIMD).
+# Пауза после FloodWait пишется в flood_state.json, чтобы её видели и другие процессы той же сессии.
+FLOOD_STATE_FILE = 'flood_state.json'
+
+TG_RATE = float(os.environ.get('TG_RATE', 1.0))           # запросов в секунду на старте
+TG_MIN_RATE = float(os.environ.get('TG_MIN_RATE', 0.05))
+TG_MAX_RATE = float(os.environ.get('TG_MAX_RATE', 3.0))
+TG_BURST = int(os.environ.get('TG_BURST', 3))
+TG_CONCURRENCY = int(os.environ.get('TG_CONCURRENCY', 4))  # каналов одновременно
+MAX_FLOOD_WAIT = int(os.environ.get('TG_MAX_FLOOD_WAIT', 900))  # дольше - отдаём ошибку наверх
+
+
+def _load_flood_state():
+    if os.path.exists(FLOOD_STATE_FILE):
+        try:
+            with open(FLOOD_STATE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {}
+
+
+def _save_flood_state(account, until, rate):
+    state = _load_flood_state()
+    state[account] = {'until': until, 'rate': rate, 'updated': time.time()}
+    tmp_file = f"{FLOOD_STATE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, FLOOD_STATE_FILE)
+    except Exception as e:
+        print(f"⚠️ flood state: {str(e)[:80]}")
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, account='default', rate=TG_RATE, burst=TG_BURST):
+        self.account = account
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.flood_waits = 0
+        self.requests = 0
+        self._lock = asyncio.Lock()
+
+        # Подхватываем паузу и сниженную скорость, выставленные другим процессом
+        saved = _load_flood_state().get(account)
+        if saved:
+            self.paused_until = max(0.0, saved.get('until', 0) - time.time()) + time.monotonic()
+            if time.time() - saved.get('updated', 0) < 3600:
+                self.rate = max(TG_MIN_RATE, min(self.rate, saved.get('rate', self.rate)))
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Дождаться токена (и конца паузы после FloodWait)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(TG_MAX_RATE, self.rate + 0.02)
+
+    def on_flood_wait(self, seconds):
+        self.flood_waits += 1
+        self.rate = max(TG_MIN_RATE, self.rate / 2)
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        _save_flood_state(self.account, time.time() + seconds, self.rate)
+        print(f"⏳ FloodWait {seconds} сек, скорость снижена до {self.rate:.2f} req/s")
+
+    async def call(self, func, *args, **kwargs):
+        """Выполнить запрос через лимитер, повторяя его после FloodWait"""
+        while True:
+            await self.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.on_flood_wait(e.seconds)
+                if e.seconds > MAX_FLOOD_WAIT:
+                    raise
+                continue
+            self.on_success()
+            return result
+
+
+_limiters = {}
+
+
+def get_limiter(client):
+    """Один лимитер на аккаунт в пределах процесса"""
+    account = account_key(client)
+    if account not in _limiters:
+        # Telethon сам молча спит на FloodWait < 60 сек - отключаем, чтобы лимитер видел каждый
+        client.flood_sleep_threshold = 0
+        _limiters[account] = AdaptiveRateLimiter(account)
+    return _limiters[account]
+
+
+async def run_bounded(items, worker, concurrency=TG_CONCURRENCY):
+    """Запустить worker(item) для всех items, не более concurrency одновременно.
+    Возвращает результаты в исходном порядке (исключения - как значения)."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            return await worker(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
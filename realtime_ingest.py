@@ -0,0 +1,302 @@
+import os
+import json
+import asyncio
+from datetime import datetime
+from telethon import TelegramClient, events, types
+from telethon.tl.functions.updates import GetChannelDifferenceRequest
+from telethon.tl.functions.channels import GetFullChannelRequest
+from channel_parser import message_to_listing
+from rate_limiter import get_limiter
+from dedup_index import DedupIndex
+from events import publish_listings
+from listings_store import listings_lock, read_listings, write_listings
+
+# Push-режим: вместо опроса get_messages слушаем обновления Telegram
+# для каналов, в которых состоит аккаунт. После рестарта/обрыва связи
+# пропущенное догоняем через GetChannelDifference от сохранённого pts.
+API_ID = int(os.environ.get('TELETHON_API_ID', 0))
+API_HASH = os.environ.get('TELETHON_API_HASH', '')
+# Отдельная сессия: одну sqlite-сессию нельзя держать в двух процессах (database is locked)
+REALTIME_SESSION = os.environ.get('REALTIME_SESSION', 'goldantelope_realtime')
+
+COUNTRIES = ['vietnam', 'thailand', 'india', 'indonesia']
+REALTIME_STATE_FILE = 'realtime_state.json'
+FLUSH_INTERVAL = 2  # сек - как часто изменения сбрасываются в listings_*.json
+DIFFERENCE_LIMIT = 100
+
+
+def load_channel_map():
+    """username (lower) -> (username, country, category) из {country}_channels.json"""
+    result = {}
+    for country in COUNTRIES:
+        channels_file = f'{country}_channels.json'
+        if not os.path.exists(channels_file):
+            continue
+        with open(channels_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        for category, channel_list in config.get('channels', {}).items():
+            for channel in channel_list:
+                result.setdefault(channel.lower(), (channel, country, category))
+    return result
+
+
+def load_state():
+    if os.path.exists(REALTIME_STATE_FILE):
+        try:
+            with open(REALTIME_STATE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {}
+
+
+def save_state(state):
+    tmp_file = f"{REALTIME_STATE_FILE}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, REALTIME_STATE_FILE)
+
+
+class ListingsBuffer:
+    """Копит добавления/правки/удаления и раз в FLUSH_INTERVAL применяет их к listings_{country}.json.
+    Файл перечитывается перед записью - его параллельно пишут опросные парсеры и админка."""
+
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, country, item):
+        self.pending.setdefault(country, []).append(('add', item))
+
+    def edit(self, country, item):
+        self.pending.setdefault(country, []).append(('edit', item))
+
+    def delete(self, country, item_ids):
+        self.pending.setdefault(country, []).append(('delete', set(item_ids)))
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        for country, ops in pending.items():
+            try:
+                self._apply(country, ops)
+            except Exception as e:
+                print(f"⚠️ {country}: не удалось сохранить: {str(e)[:80]}")
+
+    def _apply(self, country, ops):
+        # Файл перечитывается под блокировкой: параллельно его пишут парсеры и админка
+        with listings_lock(country):
+            added, merged = self._apply_locked(country, ops)
+        publish_listings(country, added)
+        if added or merged:
+            print(f"⚡ {country}: +{len(added)}, дубликатов слито: {merged}")
+
+    def _apply_locked(self, country, ops):
+        data = read_listings(country)
+        # Файлы бывают двух форматов: {категория: [...]} и плоский список
+        buckets = data if isinstance(data, dict) else {'_all': data}
+        dedup = DedupIndex.from_data(data)
+
+        added = []
+        merged = 0
+        for op, payload in ops:
+            if op == 'edit' and not dedup.known(payload['id']):
+                # Правка сообщения, которого у нас ещё нет (например, раньше не проходило фильтры)
+                op = 'add'
+            if op == 'add' and not dedup.known(payload['id']):
+                if dedup.merge(payload):
+                    merged += 1
+                    continue
+                cat = payload['category'] if isinstance(data, dict) else '_all'
+                buckets.setdefault(cat, []).insert(0, payload)
+                added.append(payload)
+            elif op == 'edit':
+                item = dedup.items.get(payload['id'])
+                if item is not None:
+                    # Новый текст - новый отпечаток: убираем старый из индекса и индексируем заново
+                    dedup.discard(item)
+                    item['title'] = payload['title']
+                    item['description'] = payload['description']
+                    item.pop('text_simhash', None)
+                    item['edited'] = datetime.now().isoformat()
+                    dedup.add(item)
+            elif op == 'delete':
+                for cat, items in buckets.items():
+                    if isinstance(items, list):
+                        buckets[cat] = [x for x in items if not (isinstance(x, dict) and x.get('id') in payload)]
+                for item_id in payload:
+                    dedup.discard(dedup.items.get(item_id, {}))
+
+        write_listings(country, buckets if isinstance(data, dict) else buckets['_all'])
+        return added, merged
+
+
+class RealtimeIngester:
+    def __init__(self, client):
+        self.client = client
+        self.limiter = get_limiter(client)
+        self.channel_map = load_channel_map()
+        self.channels = {}   # channel_id -> (username, country, category, input_channel)
+        self.state = load_state()
+        self.buffer = ListingsBuffer()
+        self.state_dirty = False
+
+    async def discover_channels(self):
+        """Push работает только для каналов, в которых аккаунт состоит - ищем их среди диалогов"""
+        async for dialog in self.client.iter_dialogs():
+            entity = dialog.entity
+            username = (getattr(entity, 'username', None) or '').lower()
+            if isinstance(entity, types.Channel) and username in self.channel_map:
+                channel, country, category = self.channel_map[username]
+                input_channel = types.InputChannel(entity.id, entity.access_hash)
+                self.channels[entity.id] = (channel, country, category, input_channel)
+        print(f"📡 Подписка на {len(self.channels)} из {len(self.channel_map)} каналов")
+
+    def handle_message(self, channel_id, msg):
+        info = self.channels.get(channel_id)
+        if not info or not isinstance(msg, types.Message):
+            return
+        channel, country, category, _ = info
+        item = message_to_listing(msg, channel, category)
+        if item:
+            self.buffer.add(country, item)
+
+    def handle_edit(self, channel_id, msg):
+        info = self.channels.get(channel_id)
+        if not info or not isinstance(msg, types.Message):
+            return
+        channel, country, category, _ = info
+        item = message_to_listing(msg, channel, category)
+        if item:
+            self.buffer.edit(country, item)
+        else:
+            # После правки сообщение перестало проходить фильтры (спам и т.п.)
+            self.buffer.delete(country, [f"{channel}_{msg.id}"])
+
+    def handle_delete(self, channel_id, message_ids):
+        info = self.channels.get(channel_id)
+        if not info:
+            return
+        channel, country, _, _ = info
+        self.buffer.delete(country, [f"{channel}_{mid}" for mid in message_ids])
+
+    def remember_pts(self, channel_id, pts):
+        if pts:
+            self.state[str(channel_id)] = pts
+            self.state_dirty = True
+
+    async def catch_up(self):
+        """Догнать пропущенное за время простоя через GetChannelDifference"""
+        for channel_id, (channel, country, category, input_channel) in self.channels.items():
+            pts = self.state.get(str(channel_id))
+            try:
+                if not pts:
+                    full = await self.limiter.call(self.client, GetFullChannelRequest(input_channel))
+                    self.remember_pts(channel_id, full.full_chat.pts)
+                    continue
+                caught = 0
+                while True:
+                    diff = await self.limiter.call(self.client, GetChannelDifferenceRequest(
+                        channel=input_channel,
+                        filter=types.ChannelMessagesFilterEmpty(),
+                        pts=pts,
+                        limit=DIFFERENCE_LIMIT,
+                        force=True
+                    ))
+                    if isinstance(diff, types.updates.ChannelDifferenceEmpty):
+                        pts = diff.pts
+                        break
+                    if isinstance(diff, types.updates.ChannelDifferenceTooLong):
+                        # Разрыв слишком большой - берём последние сообщения из diff и начинаем с текущего pts
+                        # В diff.messages бывают и сообщения других чатов - берём только этого канала
+                        for msg in diff.messages:
+                            peer = getattr(msg, 'peer_id', None)
+                            if not isinstance(peer, types.PeerChannel) or peer.channel_id != channel_id:
+                                continue
+                            self.handle_message(channel_id, msg)
+                            caught += 1
+                        pts = diff.dialog.pts
+                        break
+                    for msg in diff.new_messages:
+                        self.handle_message(channel_id, msg)
+                        caught += 1
+                    for update in diff.other_updates:
+                        if isinstance(update, types.UpdateEditChannelMessage):
+                            self.handle_edit(channel_id, update.message)
+                        elif isinstance(update, types.UpdateDeleteChannelMessages):
+                            self.handle_delete(channel_id, update.messages)
+                    pts = diff.pts
+                    if diff.final:
+                        break
+                self.remember_pts(channel_id, pts)
+                if caught:
+                    print(f"🔁 @{channel}: догнали {caught} сообщений")
+            except Exception as e:
+                print(f"⚠️ @{channel}: catch-up: {str(e)[:80]}")
+        self.flush()
+
+    def register_handlers(self):
+        chat_ids = list(self.channels.keys())
+
+        @self.client.on(events.NewMessage(chats=chat_ids))
+        async def on_new(event):
+            channel_id = event.message.peer_id.channel_id
+            self.handle_message(channel_id, event.message)
+            self.remember_pts(channel_id, getattr(event.original_update, 'pts', None))
+
+        @self.client.on(events.MessageEdited(chats=chat_ids))
+        async def on_edit(event):
+            channel_id = event.message.peer_id.channel_id
+            self.handle_edit(channel_id, event.message)
+            self.remember_pts(channel_id, getattr(event.original_update, 'pts', None))
+
+        @self.client.on(events.MessageDeleted())
+        async def on_delete(event):
+            # Для каналов Telegram присылает channel_id, для обычных чатов - нет
+            channel_id = getattr(event.original_update, 'channel_id', None)
+            if channel_id:
+                self.handle_delete(channel_id, event.deleted_ids)
+                self.remember_pts(channel_id, getattr(event.original_update, 'pts', None))
+
+    def flush(self):
+        self.buffer.flush()
+        if self.state_dirty:
+            save_state(self.state)
+            self.state_dirty = False
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+
+async def run_realtime():
+    client = TelegramClient(REALTIME_SESSION, API_ID, API_HASH)
+    await client.connect()
+    if not await client.is_user_authorized():
+        print(f"❌ Сессия {REALTIME_SESSION} не авторизована!")
+        return
+
+    ingester = RealtimeIngester(client)
+    await ingester.discover_channels()
+    ingester.register_handlers()
+    flusher = asyncio.create_task(ingester.flush_loop())
+
+    try:
+        while True:
+            await ingester.catch_up()
+            print(f"✅ Слушаем обновления: {datetime.now().strftime('%H:%M:%S')}")
+            await client.run_until_disconnected()
+            # Telethon переподключается сам; сюда попадаем только при окончательном обрыве
+            print("⚠️ Соединение потеряно, переподключение через 5 сек...")
+            await asyncio.sleep(5)
+            try:
+                await client.connect()
+            except Exception as e:
+                print(f"❌ Переподключение: {str(e)[:80]}")
+    finally:
+        flusher.cancel()
+        ingester.flush()
+
+
+if __name__ == '__main__':
+    print(f"⚡ Realtime ingest: {datetime.now().strftime('%H:%M:%S')}")
+    asyncio.run(run_realtime())
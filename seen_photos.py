@@ -0,0 +1,70 @@
+import os
+import json
+import time
+
+# Фото, которые уже скачивались. Ключ - id фото в Telegram (он одинаковый у репоста/пересылки
+# в любом канале) или file_unique_id из Bot API, поэтому известное фото отсекается
+# ДО download_media, а не после скачивания и сравнения хешей.
+SEEN_PHOTOS_FILE = 'seen_photos.json'
+SEEN_PHOTOS_MAX = int(os.environ.get('SEEN_PHOTOS_MAX', 200000))
+
+
+def photo_key(media):
+    """Ключ фото из сообщения Telethon (msg.media / msg.photo) или dict фото из Bot API"""
+    if isinstance(media, dict):
+        unique_id = media.get('file_unique_id')
+        return f"u:{unique_id}" if unique_id else None
+    photo = getattr(media, 'photo', media)
+    photo_id = getattr(photo, 'id', None)
+    return f"p:{photo_id}" if photo_id else None
+
+
+class SeenPhotos:
+    def __init__(self, path=SEEN_PHOTOS_FILE):
+        self.path = path
+        self.state = self._load()
+        self.touched = set()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception:
+                pass
+        return {}
+
+    def get(self, key):
+        """id объявления, в котором фото уже использовано, или None"""
+        entry = self.state.get(key) if key else None
+        return entry.get('listing_id') if entry else None
+
+    def __contains__(self, key):
+        return bool(key) and key in self.state
+
+    def add(self, key, listing_id):
+        if not key:
+            return
+        self.state[key] = {'listing_id': listing_id, 'seen_at': time.time()}
+        self.touched.add(key)
+
+    def save(self):
+        """Дописать новые ключи поверх свежей версии файла - его пишут несколько парсеров"""
+        if not self.touched:
+            return
+        data = self._load()
+        for key in self.touched:
+            data[key] = self.state[key]
+        if len(data) > SEEN_PHOTOS_MAX:
+            # Самые старые выкидываем - такие репосты уже вряд ли встретятся
+            keep = sorted(data.items(), key=lambda kv: kv[1].get('seen_at', 0))[-SEEN_PHOTOS_MAX:]
+            data = dict(keep)
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.path)
+            self.state = data
+            self.touched = set()
+        except Exception as e:
+            print(f"⚠️ seen photos: {str(e)[:80]}")
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from urllib.parse import urlparse
+
+# Общее хранилище коротко живущих данных (коды подтверждения, сессии чата).
+# Раньше это были словари в памяти процесса: код, запрошенный через один воркер gunicorn,
+# не находился на другом. Теперь все воркеры видят одно хранилище:
+#   sqlite:///sessions.db      - по умолчанию, файл на диске (WAL, общий для процессов на одной машине)
+#   redis://127.0.0.1:6379/0   - Redis или любой сервер с протоколом RESP (GET/SET EX/DEL/GETDEL)
+# Значения - JSON, у каждого ключа свой TTL; поиск по ключу - O(1) / O(log n).
+SESSION_STORE_URL = os.environ.get('SESSION_STORE_URL', 'sqlite:///sessions.db')
+SESSION_PURGE_EVERY = 200  # записей между удалениями просроченных ключей в SQLite
+
+
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        db = self._connect()
+        db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)')
+
+    def _connect(self):
+        # Соединение на поток (и на процесс - после fork воркера gunicorn открываем своё)
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        db = self._connect()
+        db.execute('INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                   (key, json.dumps(value, ensure_ascii=False), time.time() + ttl if ttl else None))
+        self.writes += 1
+        if self.writes % SESSION_PURGE_EVERY == 0:
+            db.execute('DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def pop(self, key):
+        """Прочитать и удалить одной транзакцией: одноразовый код не примут два воркера сразу"""
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT value, expires FROM kv WHERE key = ?', (key,)).fetchone()
+            if row:
+                db.execute('DELETE FROM kv WHERE key = ?', (key,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        if not row or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+
+class RedisStore:
+    """Минимальный клиент RESP - без зависимости от пакета redis"""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            sock = socket.create_connection((self.host, self.port), timeout=5)
+            conn = (sock, sock.makefile('rb'))
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            if self.password:
+                self._call(conn, 'AUTH', self.password)
+            if self.db:
+                self._call(conn, 'SELECT', self.db)
+        return conn
+
+    def _call(self, conn, *args):
+        sock, reader = conn
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        sock.sendall(b''.join(parts))
+        return self._read(reader)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('RESP: соединение закрыто')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RuntimeError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            size = int(payload)
+            if size < 0:
+                return None
+            data = reader.read(size + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [self._read(reader) for _ in range(int(payload))]
+        raise ConnectionError(f'RESP: неизвестный ответ {line[:20]!r}')
+
+    def command(self, *args):
+        """Команда с одним переподключением, если соединение оборвалось"""
+        for attempt in range(2):
+            try:
+                return self._call(self._connect(), *args)
+            except (ConnectionError, OSError):
+                conn = getattr(self.local, 'conn', None)
+                self.local.conn = None
+                if conn and self.local.pid == os.getpid():
+                    conn[0].close()
+                if attempt:
+                    raise
+
+    def get(self, key):
+        value = self.command('GET', key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        data = json.dumps(value, ensure_ascii=False)
+        if ttl:
+            self.command('SET', key, data, 'EX', int(ttl))
+        else:
+            self.command('SET', key, data)
+
+    def delete(self, key):
+        self.command('DEL', key)
+
+    def pop(self, key):
+        value = self.command('GETDEL', key)
+        return json.loads(value) if value is not None else None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if SESSION_STORE_URL.startswith('redis://'):
+                    _store = RedisStore(SESSION_STORE_URL)
+                else:
+                    _store = SQLiteStore(SESSION_STORE_URL.replace('sqlite:///', '', 1))
+    return _store
@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import time
+import random
+
+# Общий спам-фильтр для всех парсеров.
+# Ключевые слова берутся из spam_keywords.json и компилируются в ОДНУ регулярку,
+# построенную по префиксному дереву (общие префиксы не проверяются повторно),
+# вместо ~50 отдельных проверок `keyword in text` на каждое сообщение.
+# Ключевое слово совпадает только целым словом: "скам" не ловит "скамейку", "опасно" - "безопасно".
+# Границы слова - внутри регулярки, поэтому если длинное слово не подошло ("rent out" в "rent outing"),
+# она откатывается к более короткому с тем же началом ("rent").
+SPAM_KEYWORDS_FILE = 'spam_keywords.json'
+
+
+def _trie_pattern(keywords):
+    """Собрать регулярку из префиксного дерева ключевых слов (без проверки границ слова)"""
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for ch in keyword:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def build(node, root=False):
+        is_end = '' in node
+        # Граница слова слева проверяется сразу после первой буквы: (?<!\w.) - перед ней не буква.
+        # Регулярка по-прежнему начинается с набора первых букв, и re пропускает остальные позиции
+        # текста быстрым поиском, а не пробует на каждой lookbehind
+        branches = [re.escape(ch) + (r'(?<!\w.)' if root else '') + build(child)
+                    for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 and not is_end else '(?:' + '|'.join(branches) + ')'
+        # Ключевое слово закончилось, но есть более длинные с тем же префиксом - продолжение необязательно
+        return body + '?' if is_end else body
+
+    return build(trie, root=True)
+
+
+class SpamFilter:
+    def __init__(self, keywords):
+        self.keywords = sorted({k.lower() for k in keywords if k})
+        self.pattern = re.compile(rf"(?:{_trie_pattern(self.keywords)})(?!\w)", re.S) if self.keywords else None
+
+    def match(self, text):
+        """Вернуть сработавшее ключевое слово или None"""
+        if not text or not self.pattern:
+            return None
+        found = self.pattern.search(text.lower())
+        return found.group(0) if found else None
+
+    def is_spam(self, text):
+        return self.match(text) is not None
+
+
+_filter = None
+_filter_mtime = None
+
+
+def load_filter(path=SPAM_KEYWORDS_FILE):
+    """Фильтр с кешем; список перечитывается, если файл изменился"""
+    global _filter, _filter_mtime
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = 0
+    if _filter is None or mtime != _filter_mtime:
+        keywords = []
+        if mtime:
+            with open(path, 'r', encoding='utf-8') as f:
+                keywords = json.load(f).get('keywords', [])
+        _filter = SpamFilter(keywords)
+        _filter_mtime = mtime
+    return _filter
+
+
+def spam_rule(text):
+    """Какое правило сработало (для логов)"""
+    return load_filter().match(text)
+
+
+def is_spam(text):
+    """Проверяет, не является ли объявление спамом/промо"""
+    return load_filter().match(text) is not None
+
+
+def self_check():
+    """Пересекающиеся и вложенные ключевые слова, границы слова"""
+    cases = [
+        (['rent out', 'rent'], 'rent outing', 'rent'),
+        (['rent out', 'rent'], 'we rent out rooms', 'rent out'),
+        (['rent out'], 'rent outing', None),
+        (['скам', 'скамейка'], 'новая скамейка', 'скамейка'),
+        (['скам'], 'новая скамейка', None),
+        (['опасно'], 'безопасно, опасно!', 'опасно'),
+        (['sign up', 'up'], 'signup up', 'up'),
+        (['deriv.com'], 'see deriv.com now', 'deriv.com'),
+        (['forex', 'for'], 'FOR forexx', 'for'),
+    ]
+    for keywords, text, expected in cases:
+        found = SpamFilter(keywords).match(text)
+        assert found == expected, f"{keywords} / {text!r}: {found!r} != {expected!r}"
+    print(f"✅ spam_filter: {len(cases)} проверок пройдено")
+
+
+def benchmark(count=100000):
+    """Сравнение со старой проверкой `keyword in text_lower` на синтетическом корпусе"""
+    spam_filter = load_filter()
+    keywords = spam_filter.keywords
+    words = ('сдам квартиру в нячанге недорого цена долларов месяц байк аренда продам срочно '
+             'обмен валюты район центр море вид бассейн rent house villa pool kamar sewa').split()
+    rnd = random.Random(42)
+    corpus = [' '.join(rnd.choice(words) for _ in range(rnd.randint(10, 80))) for _ in range(count)]
+    for i in range(0, count, 50):
+        corpus[i] += ' ' + rnd.choice(keywords).upper()
+
+    start = time.perf_counter()
+    old_hits = 0
+    for text in corpus:
+        text_lower = text.lower()
+        if any(k in text_lower for k in keywords):
+            old_hits += 1
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_hits = sum(1 for text in corpus if spam_filter.is_spam(text))
+    new_time = time.perf_counter() - start
+
+    print(f"📊 {count} сообщений, {len(keywords)} правил")
+    print(f"   старый any(in): {old_time:.2f} сек ({old_hits} спам)")
+    print(f"   общая регулярка: {new_time:.2f} сек ({new_hits} спам)")
+    print(f"   ускорение: x{old_time / new_time:.1f}")
+
+
+if __name__ == '__main__':
+    self_check()
+    benchmark()
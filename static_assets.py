@@ -0,0 +1,240 @@
+import os
+import io
+import json
+import gzip
+import time
+import fcntl
+import hashlib
+import mimetypes
+
+try:
+    import brotli
+except ImportError:  # brotli есть в зависимостях; в окружении без него - только .gz
+    brotli = None
+
+# Отпечатки файлов static/ для долгого кэширования.
+# Раньше иконки, баннеры и фото городов (~80 МБ) отдавались стандартным /static/ Flask
+# с коротким кэшем, а фото города при замене перезаписывалось под тем же именем.
+# Теперь:
+#   python static_assets.py  - сборка: md5 каждого файла в static/manifest.json,
+#                              рядом .webp (для jpg/png, если меньше) и .gz/.br (для текстовых)
+#   asset_url('/static/x.jpg') -> '/s/x.<hash>.jpg' - имя меняется вместе с содержимым,
+#                              поэтому такой URL кэшируется навсегда (immutable)
+#   asset_url(..., webp=True)  -> '/s/x.<hash>.webp' - WebP-вариант по своему адресу: под .jpg-адресом
+#                              всегда JPEG, и общий кэш не отдаст WebP браузеру без его поддержки
+#   /s/<path>                 - файл или его WebP-вариант; текстовые - br/gzip по Accept-Encoding (Vary)
+# Загрузки баннеров и фото городов проходят через process_file() сразу.
+STATIC_DIR = 'static'
+MANIFEST_FILE = os.path.join(STATIC_DIR, 'manifest.json')
+ASSET_MAX_AGE = 365 * 24 * 3600
+WEBP_QUALITY = 80
+WEBP_MIN_BYTES = 10 * 1024
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.ico'}
+RASTER = {'.jpg', '.jpeg', '.png'}
+RASTER_NAMES = ('.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG')  # для поиска оригинала по .webp-адресу
+HASH_LENGTH = 10
+RELOAD_INTERVAL = 1.0  # сек между проверками, не обновил ли манифест другой воркер
+
+
+def _is_generated(path):
+    return path.endswith(('.gz', '.br', '.jpg.webp', '.jpeg.webp', '.png.webp', '.tmp')) or \
+        os.path.normpath(path) == os.path.normpath(MANIFEST_FILE)
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_entry(rel_path, previous=None):
+    """Отпечаток и варианты для файла static/<rel_path>. Если файл не менялся - старая запись"""
+    path = os.path.join(STATIC_DIR, rel_path)
+    stat = os.stat(path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime:
+        return previous
+    with open(path, 'rb') as f:
+        data = f.read()
+    entry = {
+        'hash': hashlib.md5(data).hexdigest()[:HASH_LENGTH],
+        'size': stat.st_size,
+        'mtime': stat.st_mtime
+    }
+    ext = os.path.splitext(rel_path)[1].lower()
+    if ext in COMPRESSIBLE:
+        compressed = gzip.compress(data, 9, mtime=0)
+        if len(compressed) < len(data):
+            _write_atomic(f"{path}.gz", compressed)
+            entry['gz'] = len(compressed)
+        if brotli:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                _write_atomic(f"{path}.br", compressed)
+                entry['br'] = len(compressed)
+    if ext in RASTER and len(data) >= WEBP_MIN_BYTES:
+        from PIL import Image
+        try:
+            img = Image.open(io.BytesIO(data))
+            out = io.BytesIO()
+            img.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+            if out.tell() < len(data):
+                _write_atomic(f"{path}.webp", out.getvalue())
+                entry['webp'] = out.tell()
+        except Exception as e:
+            print(f"⚠️ webp {rel_path}: {e}")
+    return entry
+
+
+def _locked_manifest(update):
+    """Прочитать манифест, применить update(manifest), записать - под flock (merge, а не перезапись)"""
+    with open(f"{MANIFEST_FILE}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = _read_manifest()
+        update(manifest)
+        _write_atomic(MANIFEST_FILE, json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+    return manifest
+
+
+def _read_manifest():
+    try:
+        with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build():
+    """Полная сборка: python static_assets.py"""
+    started = time.time()
+    stats = {'files': 0, 'webp': 0, 'bytes': 0, 'webp_bytes': 0}
+
+    def update(manifest):
+        seen = set()
+        for folder, _, files in os.walk(STATIC_DIR):
+            for name in files:
+                path = os.path.join(folder, name)
+                if _is_generated(path) or name.endswith('.lock'):
+                    continue
+                rel_path = os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+                entry = build_entry(rel_path, manifest.get(rel_path))
+                manifest[rel_path] = entry
+                seen.add(rel_path)
+                stats['files'] += 1
+                stats['bytes'] += entry['size']
+                if entry.get('webp'):
+                    stats['webp'] += 1
+                    stats['webp_bytes'] += entry['webp']
+        for rel_path in set(manifest) - seen:
+            del manifest[rel_path]
+
+    _locked_manifest(update)
+    print(f"📦 static: {stats['files']} файлов, {stats['bytes'] // 1024} КБ; "
+          f"webp для {stats['webp']} ({stats['webp_bytes'] // 1024} КБ) за {time.time() - started:.1f} сек")
+
+
+def process_file(path, thumbnails=None):
+    """Загруженный файл (static/...) и его превью (thumbnails.save_thumbnails) -> записи в манифесте
+    и варианты; вернуть URL оригинала с отпечатком"""
+    rel_path = os.path.relpath(path.lstrip('/'), STATIC_DIR).replace(os.sep, '/')
+    rel_paths = [rel_path] + [os.path.relpath(v['url'].lstrip('/'), STATIC_DIR).replace(os.sep, '/')
+                              for v in (thumbnails or {}).values() if v.get('url')]
+
+    def update(manifest):
+        for item in rel_paths:
+            manifest[item] = build_entry(item)
+
+    try:
+        _locked_manifest(update)
+    except Exception as e:
+        print(f"⚠️ static_assets {path}: {e}")
+    _manifest_cache['checked'] = 0
+    return asset_url(f"/static/{rel_path}")
+
+
+_manifest_cache = {'checked': 0, 'mtime': None, 'manifest': {}}
+
+
+def get_manifest():
+    now = time.time()
+    if now - _manifest_cache['checked'] >= RELOAD_INTERVAL:
+        _manifest_cache['checked'] = now
+        try:
+            mtime = os.stat(MANIFEST_FILE).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != _manifest_cache['mtime']:
+            _manifest_cache['mtime'] = mtime
+            _manifest_cache['manifest'] = _read_manifest() if mtime else {}
+    return _manifest_cache['manifest']
+
+
+def manifest_version():
+    get_manifest()
+    return _manifest_cache['mtime']
+
+
+def asset_url(url, webp=False):
+    """/static/x/y.jpg -> /s/x/y.<hash>.jpg (с webp=True - /s/x/y.<hash>.webp, если вариант есть);
+    чужие и неизвестные ссылки - как есть"""
+    if not url or not url.startswith('/static/'):
+        return url
+    rel_path = url[len('/static/'):].split('?', 1)[0]
+    entry = get_manifest().get(rel_path)
+    if not entry:
+        return url
+    stem, ext = os.path.splitext(rel_path)
+    if webp and entry.get('webp'):
+        ext = '.webp'
+    return f"/s/{stem}.{entry['hash']}{ext}"
+
+
+def _split(fingerprinted):
+    stem, ext = os.path.splitext(fingerprinted)
+    stem, _, file_hash = stem.rpartition('.')
+    return stem, file_hash, ext
+
+
+def resolve(fingerprinted):
+    """x/y.<hash>.jpg -> (rel_path, entry, webp) или None, если такого файла (или версии) нет.
+    x/y.<hash>.webp - WebP-вариант x/y.jpg (.png), если нет самого файла x/y.webp"""
+    stem, file_hash, ext = _split(fingerprinted)
+    manifest = get_manifest()
+    candidates = [(f"{stem}{ext}", False)]
+    if ext == '.webp':
+        candidates += [(f"{stem}{raster}", True) for raster in RASTER_NAMES]
+    for rel_path, webp in candidates:
+        entry = manifest.get(rel_path)
+        if entry and entry['hash'] == file_hash and (entry.get('webp') or not webp):
+            return rel_path, entry, webp
+    return None
+
+
+def original_url(url):
+    """/s/x/y.<hash>.jpg (или .webp) -> /static/x/y.jpg; остальные ссылки - как есть.
+    Для админки: в конфигах хранятся ссылки /static/..., а клиент видел адреса с отпечатком"""
+    if not url or not url.startswith('/s/'):
+        return url
+    stem, _, ext = _split(url[len('/s/'):].split('?', 1)[0])
+    if ext == '.webp' and f"{stem}{ext}" not in get_manifest():
+        original = next((f"{stem}{raster}" for raster in RASTER_NAMES if f"{stem}{raster}" in get_manifest()), None)
+        if original:
+            return f"/static/{original}"
+    return f"/static/{stem}{ext}"
+
+
+def choose_variant(rel_path, entry, accept_encoding, webp=False):
+    """(путь к файлу, mimetype, Content-Encoding): WebP-вариант по webp-адресу, для текстовых - br/gzip"""
+    path = os.path.join(STATIC_DIR, rel_path)
+    mimetype = mimetypes.guess_type(rel_path)[0] or 'application/octet-stream'
+    if webp:
+        return f"{path}.webp", 'image/webp', None
+    if entry.get('br') and 'br' in (accept_encoding or ''):
+        return f"{path}.br", mimetype, 'br'
+    if entry.get('gz') and 'gzip' in (accept_encoding or ''):
+        return f"{path}.gz", mimetype, 'gzip'
+    return path, mimetype, None
+
+
+if __name__ == '__main__':
+    build()
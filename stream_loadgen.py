@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+from events import publish
+from event_server import raise_fd_limit, COUNTRIES
+
+# Нагрузочная проверка SSE-потока (event_server.py): N простаивающих подписчиков.
+#   python stream_loadgen.py --clients 5000            - сам запускает event_server на свободном порту
+#   python stream_loadgen.py --url http://host:5001 --pid <pid event_server>
+# Печатает: сколько подключилось, CPU и память сервера за время простоя,
+# за сколько одно событие доходит до всех подписчиков страны.
+
+
+def process_usage(pid):
+    """(секунды CPU, RSS в МБ) процесса по /proc"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    with open(f"/proc/{pid}/status") as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    return cpu, rss / 1024
+
+
+class Subscriber:
+    def __init__(self, host, port, country):
+        self.host, self.port, self.country = host, port, country
+        self.events = 0
+        self.last_event_at = None
+        self.connected = asyncio.Event()
+
+    async def run(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(f"GET /api/stream?country={self.country} HTTP/1.1\r\nHost: {self.host}\r\n"
+                     f"Accept: text/event-stream\r\n\r\n".encode())
+        await writer.drain()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.startswith(b'retry:'):
+                    self.connected.set()
+                elif line.startswith(b'event:'):
+                    self.events += 1
+                    self.last_event_at = time.perf_counter()
+        finally:
+            writer.close()
+
+
+async def main(args):
+    raise_fd_limit()
+    server = None
+    host, port = args.url.split('//')[-1].split(':') if args.url else ('127.0.0.1', args.port)
+    port = int(port)
+    pid = args.pid
+    if not args.url:
+        env = dict(os.environ, EVENT_SERVER_PORT=str(port))
+        server = subprocess.Popen([sys.executable, 'event_server.py'], env=env,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        pid = server.pid
+        for _ in range(50):
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.2)
+
+    try:
+        subscribers = [Subscriber(host, port, COUNTRIES[i % len(COUNTRIES)]) for i in range(args.clients)]
+        tasks = []
+        started = time.perf_counter()
+        for i in range(0, len(subscribers), 200):
+            # Подключаемся пачками, чтобы не переполнить очередь accept
+            tasks += [asyncio.create_task(s.run()) for s in subscribers[i:i + 200]]
+            await asyncio.sleep(0.05)
+        await asyncio.wait_for(asyncio.gather(*(s.connected.wait() for s in subscribers)), 120)
+        print(f"🔌 Подключено {len(subscribers)} подписчиков за {time.perf_counter() - started:.1f} сек")
+
+        if pid:
+            cpu_before, rss = process_usage(pid)
+            await asyncio.sleep(args.idle)
+            cpu_after, rss = process_usage(pid)
+            print(f"💤 Простой {args.idle} сек: CPU сервера {100 * (cpu_after - cpu_before) / args.idle:.2f}%, "
+                  f"RSS {rss:.0f} МБ ({rss * 1024 / len(subscribers):.1f} КБ на подписчика)")
+
+        for country in COUNTRIES[:2]:
+            targets = [s for s in subscribers if s.country == country]
+            before = sum(s.events for s in targets)
+            sent = time.perf_counter()
+            publish(country, 'chat', {'id': 0, 'username': 'loadgen', 'message': 'ping'})
+            while sum(s.events for s in targets) - before < len(targets) and time.perf_counter() - sent < 10:
+                await asyncio.sleep(0.005)
+            got = sum(s.events for s in targets) - before
+            slowest = max((s.last_event_at or sent) for s in targets) - sent
+            print(f"📨 {country}: событие получили {got}/{len(targets)} за {slowest * 1000:.0f} мс")
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочная проверка /api/stream')
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--idle', type=float, default=10, help='сек простоя для замера CPU')
+    parser.add_argument('--url', help='уже запущенный event_server, например http://127.0.0.1:5001')
+    parser.add_argument('--pid', type=int, help='pid уже запущенного event_server для замера CPU')
+    parser.add_argument('--port', type=int, default=5051, help='порт для event_server, запущенного здесь')
+    asyncio.run(main(parser.parse_args()))
@@ -1,6 +1,6 @@
 import os
 import asyncio
-import requests
+import http_client
 import json
 
 BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -20,7 +20,7 @@ def send_message(chat_id, text, reply_markup=None):
     }
     if reply_markup:
         data['reply_markup'] = json.dumps(reply_markup)
-    return requests.post(url, data=data).json()
+    return http_client.post(url, data=data).json()
 
 def set_bot_commands():
     url = f'https://api.telegram.org/bot{BOT_TOKEN}/setMyCommands'
@@ -32,7 +32,7 @@ def set_bot_commands():
         {"command": "help", "description": "Помощь"}
     ]
     data = {'commands': json.dumps(commands)}
-    return requests.post(url, data=data).json()
+    return http_client.post(url, data=data).json()
 
 def set_menu_button():
     url = f'https://api.telegram.org/bot{BOT_TOKEN}/setChatMenuButton'
@@ -43,7 +43,7 @@ def set_menu_button():
         "web_app": {"url": webapp_url}
     }
     data = {'menu_button': json.dumps(menu_button)}
-    return requests.post(url, data=data).json()
+    return http_client.post(url, data=data).json()
 
 def handle_start(chat_id, user_name):
     webapp_url = get_webapp_url()
@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+import http_client
+
+# Фото объявлений в Telegram-канале TELEGRAM_PHOTO_CHANNEL: загрузка через Bot API,
+# file_id скопированных туда сообщений и свежие ссылки getFile.
+# Общие для app.py и backfill_worker.py.
+TELEGRAM_PHOTO_CHANNEL = '-1003577636318'
+# Ссылка getFile действует не меньше часа: держим её чуть меньше, чтобы /api/listings
+# не делал getFile на каждое фото (и на каждое фото альбома) при каждом запросе
+PHOTO_URL_TTL = int(os.environ.get('PHOTO_URL_TTL', 50 * 60))
+PHOTO_URL_RETRY = 60  # сек до повторного getFile после ошибки
+PHOTO_URL_CACHE_SIZE = 20000
+
+_url_cache = {}  # file_id -> (годен до, ссылка или None)
+_url_cache_lock = threading.Lock()
+
+
+def send_photo_to_channel(image_data, caption=''):
+    """Отправить фото в Telegram канал и получить file_id для постоянного хранения"""
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        print("TELEGRAM: Bot token not found!")
+        return None
+
+    try:
+        url = f"https://api.telegram.org/bot{bot_token}/sendPhoto"
+
+        files = {'photo': ('photo.jpg', image_data, 'image/jpeg')}
+        data = {
+            'chat_id': TELEGRAM_PHOTO_CHANNEL,
+            'caption': caption[:1024] if caption else ''
+        }
+
+        print(f"TELEGRAM: Sending photo to channel {TELEGRAM_PHOTO_CHANNEL}, size: {len(image_data)} bytes")
+        response = http_client.post(url, files=files, data=data, timeout=30)
+        result = response.json()
+        print(f"TELEGRAM: Response: {result}")
+
+        if result.get('ok'):
+            photo = result['result'].get('photo', [])
+            if photo:
+                largest = max(photo, key=lambda x: x.get('file_size', 0))
+                file_id = largest.get('file_id')
+                print(f"TELEGRAM: Photo uploaded! file_id: {file_id[:50]}...")
+                return file_id
+        else:
+            print(f"TELEGRAM: Failed to send photo: {result.get('description', 'Unknown error')}")
+
+        return None
+    except Exception as e:
+        print(f"TELEGRAM: Error sending photo to channel: {e}")
+        return None
+
+
+def get_channel_photo_file_id(message_id):
+    """file_id фото из сообщения, уже лежащего в TELEGRAM_PHOTO_CHANNEL (его туда скопировал
+    user-аккаунт бэкфилла). Бот пересылает сообщение в тот же канал, берёт file_id из ответа
+    и сразу удаляет копию - байты фото через наш сервер не проходят."""
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token or not message_id:
+        return None
+
+    api = f"https://api.telegram.org/bot{bot_token}"
+    try:
+        result = http_client.post(f"{api}/forwardMessage", json={
+            'chat_id': TELEGRAM_PHOTO_CHANNEL,
+            'from_chat_id': TELEGRAM_PHOTO_CHANNEL,
+            'message_id': message_id,
+            'disable_notification': True
+        }, timeout=15).json()
+        if not result.get('ok'):
+            print(f"TELEGRAM: forwardMessage failed: {result.get('description', 'Unknown error')}")
+            return None
+        forwarded = result['result']
+        http_client.post(f"{api}/deleteMessage", json={
+            'chat_id': TELEGRAM_PHOTO_CHANNEL,
+            'message_id': forwarded['message_id']
+        }, timeout=15)
+        photo = forwarded.get('photo', [])
+        if photo:
+            return max(photo, key=lambda x: x.get('file_size', 0)).get('file_id')
+    except Exception as e:
+        print(f"TELEGRAM: Error getting channel photo file_id: {e}")
+    return None
+
+
+def _fetch_photo_url(bot_token, file_id):
+    try:
+        file_url = f"https://api.telegram.org/bot{bot_token}/getFile?file_id={file_id}"
+        file_response = http_client.get(file_url, timeout=10).json()
+
+        if file_response.get('ok'):
+            file_path = file_response['result'].get('file_path')
+            return f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
+    except:
+        pass
+    return None
+
+
+def get_telegram_photo_url(file_id):
+    """Получить актуальный URL фото по file_id (из кэша, пока ссылка не протухла)"""
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token or not file_id:
+        return None
+
+    now = time.time()
+    cached = _url_cache.get(file_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    url = _fetch_photo_url(bot_token, file_id)
+    with _url_cache_lock:
+        if len(_url_cache) >= PHOTO_URL_CACHE_SIZE:
+            for key in [key for key, (expires, _) in _url_cache.items() if expires <= now]:
+                del _url_cache[key]
+            if len(_url_cache) >= PHOTO_URL_CACHE_SIZE:
+                _url_cache.clear()
+        _url_cache[file_id] = (now + (PHOTO_URL_TTL if url else PHOTO_URL_RETRY), url)
+    return url
@@ -0,0 +1,129 @@
+import io
+import os
+import glob
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+
+# Уменьшенные WebP-копии фото: карточке шириной 150 px не нужен JPEG на 2-3 МБ.
+# Варианты создаются один раз при загрузке/парсинге; API отдаёт ссылку на подходящий по ширине.
+# Ключ варианта - его настоящая ширина: из превью 800 px получится "800", а не "1080".
+# Pillow отпускает GIL при декодировании, ресайзе и кодировании, поэтому пул потоков
+# действительно параллелит работу и не держит event loop парсера / воркер Flask.
+THUMB_SIZES = (160, 480, 1080)
+THUMB_QUALITY = int(os.environ.get('THUMB_QUALITY', 80))
+THUMB_WORKERS = int(os.environ.get('THUMB_WORKERS', 2))
+
+_pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix='thumbs')
+
+
+def render_thumbnails(data, sizes=THUMB_SIZES):
+    """Байты фото -> [(ширина варианта, webp-байты, width, height)], от большего к меньшему.
+    Больше оригинала не увеличиваем: размеры шире фото пропускаются, вместо них один вариант
+    в исходной ширине (и под ней же в ключе)."""
+    img = Image.open(io.BytesIO(data))
+    img.draft('RGB', (max(sizes), max(sizes)))  # JPEG декодируется сразу уменьшенным
+    img = ImageOps.exif_transpose(img)
+    img = img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    result = []
+    for size in sorted(sizes, reverse=True):
+        if img.width > size:
+            # Каждый следующий вариант режется из предыдущего - меньше пикселей на входе
+            img = img.resize((size, max(1, round(img.height * size / img.width))), Image.LANCZOS)
+        elif result:
+            continue
+        out = io.BytesIO()
+        img.save(out, 'WEBP', quality=THUMB_QUALITY, method=4)
+        result.append((img.width, out.getvalue(), img.width, img.height))
+    return result
+
+
+async def render_thumbnails_async(data, sizes=THUMB_SIZES):
+    """То же для парсеров - в пуле, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool, render_thumbnails, data, sizes)
+
+
+def thumbnail_path(path, size):
+    stem, _ = os.path.splitext(path)
+    return f"{stem}_{size}.webp"
+
+
+def _write_thumbnails(path, sizes=THUMB_SIZES):
+    try:
+        with open(path, 'rb') as f:
+            variants = render_thumbnails(f.read(), sizes)
+    except Exception as e:
+        print(f"⚠️ thumbnails {path}: {e}")
+        return {}
+    thumbnails = {}
+    for size, webp, width, height in variants:
+        thumb_file = thumbnail_path(path, size)
+        with open(thumb_file, 'wb') as f:
+            f.write(webp)
+        thumbnails[str(size)] = {'url': '/' + thumb_file.lstrip('/'), 'width': width, 'height': height}
+    return thumbnails
+
+
+def save_thumbnails(path, sizes=THUMB_SIZES):
+    """Создать варианты рядом с файлом static/...; вернуть {"160": {url, width, height}, ...}"""
+    return _pool.submit(_write_thumbnails, path, sizes).result()
+
+
+def save_thumbnails_later(path, on_done=None, sizes=THUMB_SIZES):
+    """То же в фоне для загрузок из админки: ответ не ждёт перекодирования.
+    on_done(thumbnails) вызывается в потоке пула, когда варианты записаны"""
+    def run():
+        thumbnails = _write_thumbnails(path, sizes)
+        if on_done:
+            try:
+                on_done(thumbnails)
+            except Exception as e:
+                print(f"⚠️ thumbnails {path}: {e}")
+        return thumbnails
+    return _pool.submit(run)
+
+
+def pick_thumbnail(thumbnails, width):
+    """URL самого маленького варианта не уже width (или самого большого, если все уже)"""
+    if not thumbnails:
+        return None
+    ready = sorted((int(size), v['url']) for size, v in thumbnails.items() if v.get('url'))
+    for size, url in ready:
+        if size >= width:
+            return url
+    return ready[-1][1] if ready else None
+
+
+def local_thumbnail(url, width):
+    """Для /static/... без сохранённых метаданных (баннеры): ищем варианты <имя>_<ширина>.webp на диске"""
+    if not url or not url.startswith('/static/'):
+        return url
+    stem = os.path.splitext(url.lstrip('/'))[0]
+    variants = {}
+    for thumb_file in glob.glob(f"{glob.escape(stem)}_*.webp"):
+        size = thumb_file[len(stem) + 1:-len('.webp')]
+        if size.isdigit():
+            variants[size] = {'url': '/' + thumb_file}
+    return pick_thumbnail(variants, width) or url
+
+
+def backfill(root='static', min_bytes=50 * 1024):
+    """Создать недостающие варианты для уже загруженных картинок: python thumbnails.py"""
+    created = 0
+    for folder, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(folder, name)
+            ext = os.path.splitext(path)[1]
+            if ext.lower() not in ('.jpg', '.jpeg', '.png') or os.path.getsize(path) < min_bytes:
+                continue
+            if os.path.exists(thumbnail_path(path, min(THUMB_SIZES))):
+                continue
+            if save_thumbnails(path):
+                created += 1
+    print(f"🖼️ Созданы варианты для {created} файлов")
+
+
+if __name__ == '__main__':
+    backfill()